@@ -40,7 +40,66 @@ SLEEP_TIME = 0.5
 """
 This is the number of seconds between each deletion of a directory or file.
 The sleep avoids overloading the system and allows the operator to interrupt a deletion.
-The default is 0.5.
+The default is 0.5. It is only used if DELETE_RATE is not set.
+"""
+
+
+DELETE_RATE = None
+"""
+The most directories or files deleted each second.
+A value of 0 deletes as fast as possible.
+The default is None, which is one deletion every SLEEP_TIME seconds.
+"""
+
+
+DELETE_MAX_IN_FLIGHT = 1
+"""
+The number of deletions that can happen at the same time.
+The default is 1.
+"""
+
+
+MANIFEST_FILE = None
+"""
+If set, listing directories also writes the size, number of files and subdirectories,
+and latest modification time of each deletable directory to this manifest.
+It is an SQLite database if the name ends with .sqlite, .sqlite3, or .db,
+and a file with one JSON object on each line otherwise.
+The default is None, which writes no manifest.
+"""
+
+
+DELETE_ORDER = 'file'
+"""
+The order of the deletions when there is a MANIFEST_FILE.
+This is 'file' for the order of the DELETION_FILE, 'path',
+'largest' for the most bytes first, or 'oldest' for the oldest first.
+The default is 'file'.
+"""
+
+
+HADOOP_SKIP_TRASH = False
+"""
+If True, directories deleted when STORAGE_TYPE is 'hadoop' are removed
+right away instead of being moved to the HDFS trash.
+The default is False.
+"""
+
+
+UNLINK_THREADS = 1
+"""
+The number of threads unlinking the files of one large directory at the same time,
+when deleting directories on 'posix' storage.
+The default is 1, which unlinks one file at a time.
+"""
+
+
+UNLINK_SIZES = False
+"""
+If True, each file is looked up before it is unlinked when deleting directories
+on 'posix' storage, so the bytes freed are counted in the journal and metrics.
+This is one more call to the storage for each file.
+The default is False.
 """
 
 
@@ -61,6 +120,143 @@ Directories with an age less than this, in seconds, will not be deleted.
 STORAGE_TYPE = 'posix'
 """
 This defines the storage type of the site. This may be necessary for the script to run
-correctly or optimally. Acceptable values are 'posix' and 'hadoop'.
+correctly or optimally. Acceptable values are 'posix', 'hadoop',
+'webhdfs', 'dcache', 'memory', and 'replay',
+or the dotted path to a backend class, like 'mysite.storage.MyBackend'.
 The default is 'posix'.
 """
+
+
+WEBHDFS_URL = None
+"""
+The location of the WebHDFS or HttpFS server used when STORAGE_TYPE is 'webhdfs',
+like 'http://namenode:9870'. The default is None.
+"""
+
+
+WEBHDFS_USER = None
+"""
+The user name sent to the WebHDFS server.
+The default is None, which does not send a user name.
+"""
+
+
+TRACE_FILE = None
+"""
+If set, every call to the storage is recorded to this file, with its result
+and latency. The file is gzipped if its name ends with .gz.
+The default is None, which records nothing.
+"""
+
+
+REPLAY_FILE = None
+"""
+The trace recorded with TRACE_FILE that is served when STORAGE_TYPE
+is 'replay'. The default is None.
+"""
+
+
+REPLAY_LATENCY_SCALE = 1.0
+"""
+When STORAGE_TYPE is 'replay', each call waits as long as it took when
+it was recorded, times this. Use 0 to not wait at all.
+The default is 1.0.
+"""
+
+
+SCAN_THREADS = 1
+"""
+The number of threads listing directories at the same time.
+Sibling directories are listed concurrently, which helps on filesystems
+where each listing waits on the network, like NFS or FUSE mounts.
+The default is 1, which lists one directory at a time.
+"""
+
+
+SCAN_CACHE = None
+"""
+The location of a file that caches the directory listings between scans.
+Directories that have not been modified since the last scan are not listed again.
+Pass --full-scan to list everything anyway.
+The default is None, which does not use a cache.
+"""
+
+
+ESTIMATE_FRACTION = 0.05
+"""
+With --estimate, each directory has at least this chance to be listed,
+so about this fraction of the unmerged directory is read.
+The default is 0.05.
+"""
+
+
+ESTIMATE_MIN_SAMPLE = 3
+"""
+With --estimate, at least this many subdirectories of each directory are listed.
+It must be at least 2 for the confidence intervals.
+The default is 3.
+"""
+
+
+SORT_CHUNK_SIZE = 1000000
+"""
+When WHICH_LIST is 'files', this many files are sorted in memory at once.
+Longer lists are sorted in chunks in temporary files next to the DELETION_FILE.
+The default is 1000000.
+"""
+
+
+DAEMON_SOCKET = None
+"""
+When running with --daemon, a new deletion file is written when
+a line with write is sent to a Unix socket at this location.
+The default is None, which only listens for SIGUSR1.
+"""
+
+
+DAEMON_RESCAN_TIME = 3600
+"""
+When running with --daemon, the deletion file is written after this many seconds
+without a request. Directories that cannot be watched for changes are listed again
+after this long. The default corresponds to one hour.
+"""
+
+
+DUMP_FORMAT = None
+"""
+The format of the namespace dump given with --dump. Possible values are
+'csv', 'tsv', or 'ndjson'. The default is None,
+which guesses the format from the file name.
+"""
+
+
+DUMP_COLUMNS = {'path': 'path', 'type': 'type', 'size': 'size', 'mtime': 'mtime'}
+"""
+Where the path, type, size, and modification time are in the namespace dump.
+Values are header names or JSON keys, or column numbers starting at 0
+for CSV or TSV dumps without a header. The type can be left out.
+"""
+
+
+METRICS_PROM_FILE = None
+"""
+While scanning or deleting, progress and throughput counters are written to this file
+in the Prometheus text format. Point it into the directory of the node exporter's
+textfile collector, with a name ending in .prom.
+The default is None, which writes no file.
+"""
+
+
+METRICS_JSON_FILE = None
+"""
+While scanning or deleting, the same counters as METRICS_PROM_FILE
+are written to this JSON status file.
+The default is None, which writes no file.
+"""
+
+
+METRICS_INTERVAL = 10
+"""
+The number of seconds between writes of METRICS_PROM_FILE and METRICS_JSON_FILE.
+The default is 10.
+"""
@@ -0,0 +1,698 @@
+"""
+This module holds the storage backends of the :ref:`unmerged-ref`.
+The directory walk and the deletions only talk to the storage through
+the methods of :py:class:`StorageBackend`:
+
+- :py:meth:`StorageBackend.list_dir` lists one directory, with the metadata of its files
+- :py:meth:`StorageBackend.stat_many` gets the metadata of several paths
+- :py:meth:`StorageBackend.delete_many` deletes several paths
+
+Each storage system can implement these with its own bulk operations.
+A backend can also group the deletions it is given with :py:meth:`StorageBackend.batches`,
+and list a whole tree at once with :py:meth:`StorageBackend.list_files`.
+
+The backend is picked by **STORAGE_TYPE**.
+This is either the name of a backend registered with :py:func:`register`,
+or the dotted path to a class in another module, like ``'mysite.storage.MyBackend'``.
+A backend class is made with the configuration module as its only argument.
+"""
+
+import os
+import re
+import stat
+import time
+import datetime
+import logging
+import threading
+import subprocess
+
+from . import rmtree
+from . import webhdfs
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+LOG = logging.getLogger(__name__)
+
+BACKENDS = {}
+"""The registered backend classes, by name."""
+
+DELETED = 'deleted'
+"""The outcome of a path that was deleted."""
+
+MISSING = 'missing'
+"""The outcome of a path that was already gone."""
+
+FAILED = 'failed'
+"""The outcome of a path that could not be deleted."""
+
+
+class StatEntry(object):
+    """
+    Stands in for :py:class:`os.DirEntry` where there is no ``scandir``.
+    Each entry is stat-ed once, when it is made.
+    """
+
+    def __init__(self, directory, name):
+        """
+        :param str directory: The directory that was listed
+        :param str name: The name of the entry
+        """
+        self.name = name
+        self._info = os.stat(os.path.join(directory, name))
+
+    def is_dir(self):
+        """
+        :returns: If the entry is a directory
+        :rtype: bool
+        """
+        return stat.S_ISDIR(self._info.st_mode)
+
+    def is_file(self):
+        """
+        :returns: If the entry is a regular file
+        :rtype: bool
+        """
+        return stat.S_ISREG(self._info.st_mode)
+
+    def stat(self):
+        """
+        :returns: The status of the entry
+        :rtype: os.stat_result
+        """
+        return self._info
+
+
+def scan_entries(directory):
+    """
+    :param str directory: A directory
+    :returns: The entries of the directory, from ``scandir`` if there is one
+    :rtype: iterable
+    """
+    if scandir is None:
+        return (StatEntry(directory, name) for name in os.listdir(directory))
+
+    return scandir(directory)
+
+
+def register(name):
+    """
+    A decorator that makes a backend class selectable by a **STORAGE_TYPE** of *name*.
+
+    :param str name: The name of the backend
+    :returns: The decorator
+    :rtype: function
+    """
+
+    def add(cls):
+        """Adds the class to the registry"""
+        BACKENDS[name] = cls
+        return cls
+
+    return add
+
+
+def get_backend(config):
+    """
+    :param module config: The configuration, with **STORAGE_TYPE**
+    :returns: A new backend for **STORAGE_TYPE**
+    :rtype: StorageBackend
+    :raises ValueError: If **STORAGE_TYPE** is not a registered backend or an importable class
+    """
+
+    name = config.STORAGE_TYPE
+    cls = BACKENDS.get(name)
+
+    if cls is None and '.' in name:
+        module_name, class_name = name.rsplit('.', 1)
+        error = None
+        try:
+            cls = getattr(__import__(module_name, fromlist=[class_name]), class_name)
+        except (ImportError, AttributeError) as err:
+            error = err
+
+        # Raised outside of the except block, since Python 2 has no "raise from"
+        if error is not None:
+            raise ValueError('Cannot load the storage backend %s: %s' % (name, error))
+
+    if cls is None:
+        raise ValueError('Unknown STORAGE_TYPE %s. Choose from %s or give a class.' %
+                         (name, ', '.join(sorted(BACKENDS))))
+
+    backend = cls(config)
+    backend.storage_type = name
+    return backend
+
+
+class StorageBackend(object):
+    """
+    The operations that the unmerged cleaner needs from a storage system.
+    All paths given to and returned from a backend are PFNs.
+    """
+
+    storage_type = None
+
+    def __init__(self, config):
+        """
+        :param module config: The configuration of the cleaner
+        """
+        self.config = config
+
+    def list_dir(self, pfn):
+        """
+        :param str pfn: A directory
+        :returns: a tuple of the subdirectory names and a list of
+                  ``(name, mtime, size)`` tuples for the files inside the directory
+        :rtype: tuple
+        """
+        raise NotImplementedError
+
+    def stat_many(self, pfns):
+        """
+        :param list pfns: Directories or files
+        :returns: A ``(mtime, size)`` tuple for each path, or None for paths that do not exist
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def delete_many(self, pfns, recursive):
+        """
+        :param list pfns: Directories or files to delete
+        :param bool recursive: If True, the paths are directories to delete with everything in them
+        :returns: An ``(outcome, bytes)`` tuple for each path.
+                  The outcome is :py:data:`DELETED`, :py:data:`MISSING`, or :py:data:`FAILED`.
+                  The bytes removed are None if the backend does not know them.
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def batches(self, pfns, recursive):    # pylint: disable=unused-argument
+        """
+        Groups the paths to delete into the lists given to :py:meth:`delete_many`.
+        By default, each path is deleted by itself.
+
+        :param pfns: The paths to delete
+        :type pfns: iterable
+        :param bool recursive: If the paths are directories
+        :returns: Lists of paths
+        :rtype: generator
+        """
+        for pfn in pfns:
+            yield [pfn]
+
+    def list_files(self, pfn):    # pylint: disable=unused-argument, redundant-returns-doc
+        """
+        Lists every file below a directory at once, if the storage can do that
+        faster than listing each directory.
+
+        :param str pfn: The top directory
+        :returns: ``(pfn, mtime, size)`` for each file, or None if not supported
+        :rtype: iterable
+        """
+        return None
+
+    def flush(self):
+        """Writes out anything the backend holds in buffers"""
+        pass
+
+    def close(self):
+        """Releases anything held by the backend"""
+        pass
+
+    def pfn_to_lfn(self, pfn):
+        """
+        :param str pfn: A path inside **UNMERGED_DIR_LOCATION**
+        :returns: The same path inside **LFN_TO_CLEAN**
+        :rtype: str
+        """
+        return self.config.LFN_TO_CLEAN + pfn[len(self.config.UNMERGED_DIR_LOCATION):]
+
+    def lfn_to_pfn(self, lfn):
+        """
+        :param str lfn: A path inside **LFN_TO_CLEAN**
+        :returns: The same path inside **UNMERGED_DIR_LOCATION**
+        :rtype: str
+        """
+        return lfn.replace(self.config.LFN_TO_CLEAN, self.config.UNMERGED_DIR_LOCATION)
+
+
+@register('posix')
+class PosixBackend(StorageBackend):
+    """
+    A mounted filesystem.
+    Directories are listed in a single pass with :py:func:`os.scandir`,
+    and deleted by :py:func:`cmstoolbox.unmergedcleaner.rmtree.rmtree`
+    with **UNLINK_THREADS** threads.
+    The bytes removed from directories are only known if **UNLINK_SIZES** is True.
+    """
+
+    def __init__(self, config):
+        super(PosixBackend, self).__init__(config)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def list_dir(self, pfn):
+        subdirs = []
+        files = []
+
+        for entry in scan_entries(pfn):
+            # DirEntry caches the type from the listing and the result of stat()
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                info = entry.stat()
+                files.append((entry.name, info.st_mtime, info.st_size))
+
+        return subdirs, files
+
+    def stat_many(self, pfns):
+        output = []
+        for pfn in pfns:
+            try:
+                info = os.stat(pfn)
+                output.append((info.st_mtime, info.st_size))
+            except OSError:
+                output.append(None)
+
+        return output
+
+    def delete_many(self, pfns, recursive):
+        if recursive:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = rmtree.make_pool(getattr(self.config, 'UNLINK_THREADS', 1))
+
+        output = []
+        for pfn in pfns:
+            if not os.path.lexists(pfn):
+                output.append((MISSING, 0))
+            elif recursive:
+                LOG.warning('About to delete %s', pfn)
+                counts = rmtree.rmtree(pfn, self._pool,
+                                       getattr(self.config, 'UNLINK_SIZES', False))
+                LOG.info('Deleted %s: %i files, %i directories', pfn, counts.files, counts.dirs)
+                output.append((DELETED, counts.bytes))
+            elif os.path.isfile(pfn):
+                LOG.warning('About to delete %s', pfn)
+                size = os.stat(pfn).st_size
+                os.remove(pfn)
+                output.append((DELETED, size))
+            else:
+                output.append((FAILED, 0))
+
+        return output
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+@register('dcache')
+class DcacheBackend(PosixBackend):
+    """
+    dCache, through its NFS mount of the namespace.
+    Directories are listed through the mount, and files are deleted through it.
+    Directories are not deleted yet, so each one is logged and fails.
+    """
+
+    def delete_many(self, pfns, recursive):
+        if not recursive:
+            return super(DcacheBackend, self).delete_many(pfns, recursive)
+
+        for pfn in pfns:
+            LOG.error('Not implemented yet. %s has not been deleted.', pfn)
+        LOG.error('Try posix or write a backend for dCache. See STORAGE_TYPE.')
+
+        return [(FAILED, None)] * len(pfns)
+
+
+HDFS_MAX_ARG_LENGTH = 100000
+"""The most characters of paths given to one ``hdfs dfs -rm`` command."""
+
+
+def hdfs_paths(pfn, mount_point='/mnt/hadoop'):
+    """
+    :param str pfn: The PFN of a directory on the Hadoop mount
+    :param str mount_point: The location of the hadoop mount point.
+    :returns: The HDFS paths of the checksums and of the directory itself
+    :rtype: list
+    """
+
+    paths = [pfn.replace(mount_point, '/cksums'), pfn.replace(mount_point, '')]
+    return paths[1:] if paths[0] == paths[1] else paths
+
+
+def hadoop_batches(deletions, max_length=None):
+    """
+    Groups PFNs so that each group can be deleted by one ``hdfs`` command.
+
+    :param deletions: The PFNs to delete
+    :type deletions: iterable
+    :param int max_length: The most characters of HDFS paths in each group.
+                           If None, :py:data:`HDFS_MAX_ARG_LENGTH` is used.
+    :returns: Lists of PFNs
+    :rtype: generator
+    """
+
+    max_length = max_length or HDFS_MAX_ARG_LENGTH
+
+    batch = []
+    length = 0
+    for pfn in deletions:
+        pfn_length = sum(len(path) + 1 for path in hdfs_paths(pfn))
+        if batch and length + pfn_length > max_length:
+            yield batch
+            batch = []
+            length = 0
+
+        batch.append(pfn)
+        length += pfn_length
+
+    if batch:
+        yield batch
+
+
+def parse_hdfs_rm(output):
+    """
+    Reads which paths were removed from the output of ``hdfs dfs -rm``.
+
+    :param str output: The combined stdout and stderr of the command
+    :returns: The HDFS paths that were deleted or moved to the trash,
+              and the paths that did not exist
+    :rtype: tuple of sets
+    """
+
+    def hdfs_path(path):
+        """Removes the scheme and NameNode from a path"""
+        return '/' + path.split('://', 1)[1].split('/', 1)[-1] if '://' in path else path
+
+    deleted = set()
+    missing = set()
+    for line in output.splitlines():
+        if line.startswith('Deleted '):
+            deleted.add(hdfs_path(line[len('Deleted '):].strip()))
+            continue
+
+        quoted = re.search(r"[`']([^`']+)'", line)
+        if quoted is None:
+            continue
+
+        if line.startswith('Moved: '):
+            deleted.add(hdfs_path(quoted.group(1)))
+        elif 'No such file or directory' in line:
+            missing.add(hdfs_path(quoted.group(1)))
+
+    return deleted, missing
+
+
+def parse_hdfs_ls(line):
+    """
+    Reads a file from one line of the output of ``hdfs dfs -ls -R``.
+
+    :param str line: A line of the output
+    :returns: The HDFS path, modification time, and size of the file,
+              or None if the line is not a file
+    :rtype: tuple
+    """
+
+    # The permissions, replication, owner, group, size, date, time, and path,
+    # keeping any spaces in the path
+    fields = line.rstrip('\n').split(None, 7)
+    if len(fields) < 8 or fields[0].startswith('d'):
+        return None
+
+    mtime = time.mktime(datetime.datetime.strptime(
+        '%s %s' % (fields[5], fields[6]), '%Y-%m-%d %H:%M').timetuple())
+    return fields[7], mtime, int(fields[4])
+
+
+@register('hadoop')
+class HadoopBackend(PosixBackend):
+    """
+    HDFS, listed through its FUSE mount at ``/mnt/hadoop``.
+    Files are listed with one ``hdfs dfs -ls -R`` command.
+    Directories are deleted, with their checksums stored under ``/cksums``,
+    in as few ``hdfs dfs -rm -r`` commands as possible.
+    """
+
+    def hdfs_rm(self, paths):
+        """
+        Runs one ``hdfs dfs -rm -r`` command.
+
+        :param list paths: The HDFS paths to delete
+        :returns: The paths that were deleted, and the paths that were already gone
+        :rtype: tuple of sets
+        """
+
+        command = ['hdfs', 'dfs', '-rm', '-r']
+        if getattr(self.config, 'HADOOP_SKIP_TRASH', False):
+            command.append('-skipTrash')
+
+        LOG.info('Will do: %s with %i paths, starting with %s',
+                 ' '.join(command), len(paths), paths[0])
+
+        proc = subprocess.Popen(command + paths, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = proc.communicate()
+        return parse_hdfs_rm(output.decode('utf-8', 'replace'))
+
+    def batches(self, pfns, recursive):
+        if not recursive:
+            return super(HadoopBackend, self).batches(pfns, recursive)
+
+        return hadoop_batches(pfns)
+
+    def delete_many(self, pfns, recursive):
+        """
+        Paths that fail in a batch are tried again one at a time.
+        Files are deleted through the mount.
+        The bytes removed from directories are not known.
+        """
+
+        if not recursive:
+            return super(HadoopBackend, self).delete_many(pfns, recursive)
+
+        paths = [path for pfn in pfns for path in hdfs_paths(pfn)]
+        deleted, missing = self.hdfs_rm(paths)
+
+        failed = set()
+        for path in paths:
+            if path not in deleted and path not in missing:
+                retry_deleted, retry_missing = self.hdfs_rm([path])
+                deleted |= retry_deleted
+                missing |= retry_missing
+                if path not in retry_deleted and path not in retry_missing:
+                    LOG.error('Could not delete %s', path)
+                    failed.add(path)
+
+        output = []
+        for pfn in pfns:
+            # The outcome is for the directory itself, which is the last path
+            pfn_paths = hdfs_paths(pfn)
+            if failed.intersection(pfn_paths):
+                output.append((FAILED, None))
+            elif pfn_paths[-1] in missing:
+                output.append((MISSING, 0))
+            else:
+                output.append((DELETED, None))
+
+        return output
+
+    def list_files(self, pfn):
+        """
+        The output of ``hdfs dfs -ls -R`` is read as it comes,
+        so the listing is never held in memory.
+
+        :raises subprocess.CalledProcessError: If the command fails
+        """
+
+        command = ['hdfs', 'dfs', '-ls', '-R', self.pfn_to_lfn(pfn)]
+        LOG.info('About to run: %s', ' '.join(command))
+
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            for line in proc.stdout:
+                listed = parse_hdfs_ls(line.decode('utf-8', 'replace'))
+                if listed is not None:
+                    yield (self.lfn_to_pfn(listed[0]), listed[1], listed[2])
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                # The reader stopped early
+                proc.kill()
+            status = proc.wait()
+
+        if status:
+            raise subprocess.CalledProcessError(status, command)
+
+
+@register('webhdfs')
+class WebHdfsBackend(StorageBackend):
+    """
+    HDFS, through the :py:mod:`cmstoolbox.unmergedcleaner.webhdfs` client
+    for **WEBHDFS_URL**.
+    The HDFS path of the unmerged directory is taken to be **LFN_TO_CLEAN**.
+    Like the ``'hadoop'`` backend, the checksums stored under ``/cksums`` are deleted too.
+    """
+
+    def __init__(self, config):
+        super(WebHdfsBackend, self).__init__(config)
+        self.client = webhdfs.WebHdfsClient(config.WEBHDFS_URL, config.WEBHDFS_USER)
+
+    def list_dir(self, pfn):
+        subdirs = []
+        files = []
+        for status in self.client.list_status(self.pfn_to_lfn(pfn)):
+            if status['type'] == 'DIRECTORY':
+                subdirs.append(status['pathSuffix'])
+            elif status['type'] == 'FILE':
+                files.append((status['pathSuffix'], status['modificationTime'] / 1000.0,
+                              status['length']))
+
+        return subdirs, files
+
+    def stat_many(self, pfns):
+        output = []
+        for pfn in pfns:
+            try:
+                status = self.client.get_file_status(self.pfn_to_lfn(pfn))
+                output.append((status['modificationTime'] / 1000.0, status['length']))
+            except webhdfs.WebHdfsError as err:
+                if err.status != 404:
+                    raise
+                output.append(None)
+
+        return output
+
+    def delete_many(self, pfns, recursive):
+        """
+        The checksums are only deleted with directories, like the ``'hadoop'`` backend.
+        A path that cannot be deleted fails by itself, without stopping the others.
+        The bytes removed from directories are not known.
+        """
+
+        output = []
+        for pfn in pfns:
+            lfn = self.pfn_to_lfn(pfn)
+            try:
+                for path in ('/cksums' + lfn, lfn) if recursive else (lfn,):
+                    LOG.info('Will delete: %s', path)
+                    existed = self.client.delete(path, recursive)
+                    if not existed:
+                        LOG.info('%s was already gone', path)
+            except webhdfs.WebHdfsError as err:
+                LOG.error('Could not delete %s: %s', pfn, err)
+                output.append((FAILED, None))
+                continue
+
+            # The outcome is for the directory itself, which is deleted last
+            output.append((DELETED, None) if existed else (MISSING, 0))
+
+        return output
+
+    def close(self):
+        self.client.close()
+
+
+@register('memory')
+class MemoryBackend(StorageBackend):
+    """
+    A namespace held in memory, for tests and dry runs.
+    It starts empty and is filled with :py:meth:`add`.
+    """
+
+    def __init__(self, config):
+        super(MemoryBackend, self).__init__(config)
+        # Maps each directory to a dict of its entries,
+        # which are either None for a subdirectory or (mtime, size) for a file
+        self.dirs = {}
+        self.mtimes = {}
+
+    def add(self, pfn, is_dir, mtime, size=0):
+        """
+        Adds a directory or file, and any missing parent directories.
+
+        :param str pfn: The path to add
+        :param bool is_dir: If the path is a directory
+        :param float mtime: The modification time
+        :param int size: The size of a file
+        """
+
+        pfn = pfn.rstrip('/')
+        if is_dir:
+            self.dirs.setdefault(pfn, {})
+            self.mtimes[pfn] = mtime
+
+        info = None if is_dir else (mtime, size)
+        parent, name = os.path.split(pfn)
+        while name:
+            known = parent in self.dirs
+            self.dirs.setdefault(parent, {})[name] = info
+            if known:
+                break
+
+            # Parents made here get the same modification time
+            self.mtimes[parent] = mtime
+            info = None
+            parent, name = os.path.split(parent)
+
+    def list_dir(self, pfn):
+        entries = self.dirs.get(pfn.rstrip('/'))
+        if entries is None:
+            raise OSError(2, 'No such directory', pfn)
+
+        return ([name for name, info in entries.items() if info is None],
+                [(name, info[0], info[1]) for name, info in entries.items() if info is not None])
+
+    def stat_many(self, pfns):
+        output = []
+        for pfn in pfns:
+            pfn = pfn.rstrip('/')
+            parent, name = os.path.split(pfn)
+            info = self.dirs.get(parent, {}).get(name, False)
+            if info is None:
+                output.append((self.mtimes[pfn], 0))
+            else:
+                output.append(info or None)
+
+        return output
+
+    def delete_many(self, pfns, recursive):
+        output = []
+        for pfn in pfns:
+            pfn = pfn.rstrip('/')
+            parent, name = os.path.split(pfn)
+            siblings = self.dirs.get(parent, {})
+            if name not in siblings:
+                output.append((MISSING, 0))
+                continue
+
+            size = 0
+            if siblings[name] is None:
+                if not recursive:
+                    output.append((FAILED, 0))
+                    continue
+                # Only the directories inside this one are visited
+                pending = [pfn]
+                while pending:
+                    path = pending.pop()
+                    self.mtimes.pop(path, None)
+                    for sub_name, info in self.dirs.pop(path, {}).items():
+                        if info is None:
+                            pending.append(os.path.join(path, sub_name))
+                        else:
+                            size += info[1]
+            else:
+                size = siblings[name][1]
+
+            del siblings[name]
+            output.append((DELETED, size))
+
+        return output
@@ -0,0 +1,237 @@
+"""
+This module saves the progress of a directory scan of the :ref:`unmerged-ref`,
+so that a scan that stops part of the way through can be resumed with ``--resume``.
+
+After each top level directory is filled, its deletable directories are added to
+a checkpoint file next to the **DELETION_FILE**, one JSON line at a time.
+The file starts with a fingerprint of the protected list and configuration,
+and with the time the scan started.
+A resumed scan only uses the checkpoint if the fingerprint is the same,
+and it uses the saved start time, so its deletion file and totals are the same as
+a scan that was never stopped.
+The checkpoint is removed when the scan finishes.
+
+A scan with ``--shard`` keeps its checkpoint instead, marked as complete,
+as the partial result that ``--merge`` reads with :py:func:`read_shard`.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+from .journal import load_lines
+
+
+LOG = logging.getLogger(__name__)
+
+FINGERPRINT_KEYS = ['UNMERGED_DIR_LOCATION', 'LFN_TO_CLEAN', 'DIRS_TO_AVOID',
+                    'MIN_AGE', 'WHICH_LIST', 'STORAGE_TYPE']
+"""The configuration that changes which directories can be deleted."""
+
+
+def fingerprint(config, protected):
+    """
+    :param module config: The configuration
+    :param list protected: The protected LFNs
+    :returns: A hash of everything that changes the result of a scan
+    :rtype: str
+    """
+
+    values = dict((key, getattr(config, key, None)) for key in FINGERPRINT_KEYS)
+    values['PROTECTED'] = sorted(protected)
+
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SavedNode(object):    # pylint: disable=too-few-public-methods
+    """
+    The parts of a deletable :py:class:`listdeletable.DataNode`
+    that are written to the deletion file and manifest.
+    Checkpoints from before the manifest have no latest time,
+    which needs a default, so this is not a namedtuple.
+    """
+
+    def __init__(self, path_name, nsubnodes, nsubfiles, size, latest=0):
+        self.path_name = path_name
+        self.nsubnodes = nsubnodes
+        self.nsubfiles = nsubfiles
+        self.size = size
+        self.latest = latest
+
+
+class SavedTop(object):
+    """
+    A top level directory read back from a checkpoint.
+    It can be written like a filled :py:class:`listdeletable.DataNode`.
+    """
+
+    def __init__(self, path_name, nodes):
+        """
+        :param str path_name: The name of the top level directory
+        :param list nodes: The deletable directories, as :py:class:`SavedNode` objects
+        """
+        self.path_name = path_name
+        self.nodes = nodes
+
+    def traverse_tree(self, list_to_del):
+        """
+        :param list list_to_del: Gets the deletable directories appended
+        """
+        list_to_del.extend(self.nodes)
+
+
+def _saved_top(content):
+    """
+    :param dict content: A line of a checkpoint with a top level directory
+    :returns: The saved directory
+    :rtype: SavedTop
+    """
+    return SavedTop(content['top'], [SavedNode(*node) for node in content['nodes']])
+
+
+def read_shard(file_name):
+    """
+    :param str file_name: The checkpoint of a scan with ``--shard``
+    :returns: The header of the checkpoint, and the top level directories in it
+    :rtype: tuple
+    :raises ValueError: If the scan did not finish
+    """
+
+    tops = []
+    complete = False
+    with open(file_name, 'r') as shard_file:
+        header = json.loads(next(shard_file))
+        for line in shard_file:
+            content = json.loads(line)
+            if 'top' in content:
+                tops.append(_saved_top(content))
+            elif content.get('complete'):
+                complete = True
+
+    if not complete:
+        raise ValueError('The scan of %s did not finish' % file_name)
+
+    return header, tops
+
+
+class Checkpoint(object):
+    """
+    The checkpoint file of one scan.
+    """
+
+    def __init__(self, file_name, scan_id, now, resume=False, shard=None):
+        """
+        Opens the checkpoint file. Unless resuming a scan with the same fingerprint and shard,
+        any old checkpoint is replaced.
+
+        :param str file_name: The location of the checkpoint
+        :param str scan_id: The :py:func:`fingerprint` of this scan
+        :param int now: The time this scan started
+        :param bool resume: If True, the top level directories in an old checkpoint are kept
+        :param tuple shard: The index of this shard and the number of shards, if sharded
+        """
+
+        self.file_name = file_name
+        self.now = now
+        self.shard = list(shard) if shard else None
+        self.saved = {}
+
+        if resume and os.path.exists(file_name):
+            self._load(scan_id)
+
+        if self.saved:
+            self._file = open(file_name, 'a')
+        else:
+            self._file = open(file_name, 'w')
+            header = {'fingerprint': scan_id, 'now': now}
+            if self.shard:
+                header['shard'] = self.shard
+            self._write(header)
+
+    def _load(self, scan_id):
+        """
+        Reads an old checkpoint, if it has the same fingerprint.
+        A line that was only partly written is removed.
+        """
+
+        headers = []
+
+        def use_header(header):
+            """Only uses a checkpoint of the same scan"""
+            if header.get('fingerprint') != scan_id or header.get('shard') != self.shard:
+                LOG.warning('The protected list, configuration, or shard changed '
+                            'since %s was written. Starting the scan from the beginning.',
+                            self.file_name)
+                return False
+            headers.append(header)
+            return True
+
+        def add(top):
+            """Keeps a saved top level directory"""
+            if 'top' in top:
+                self.saved[top['top']] = _saved_top(top)
+
+        if load_lines(self.file_name, use_header, add) and self.saved:
+            self.now = headers[0]['now']
+            LOG.info('Resuming the scan started at %i, with %i top level directories done',
+                     self.now, len(self.saved))
+
+    def _write(self, content):
+        """Adds a line to the checkpoint, and makes sure it is on disk"""
+        self._file.write(json.dumps(content) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def get(self, top_dir):
+        """
+        :param str top_dir: The name of a top level directory
+        :returns: The saved directory, or None if it was not done
+        :rtype: SavedTop
+        """
+        return self.saved.get(top_dir)
+
+    def add(self, top_node):
+        """
+        :param listdeletable.DataNode top_node: A filled top level directory
+        """
+
+        list_to_del = []
+        top_node.traverse_tree(list_to_del)
+
+        self._write({'top': top_node.path_name,
+                     'nodes': [[node.path_name, int(node.nsubnodes), int(node.nsubfiles),
+                                int(node.size), int(node.latest)] for node in list_to_del]})
+
+    def fill_tops(self, top_dirs, make_node, metrics):
+        """
+        :param list top_dirs: The top level directories to fill, in order
+        :param function make_node: Takes the name of a top level directory
+                                   and gives the filled node, like a
+                                   :py:class:`listdeletable.DataNode`
+        :param metrics.Metrics metrics: Gets the progress through the top level directories
+        :returns: The saved directory or the newly filled node of each top level directory.
+                  New nodes are added to the checkpoint as they are filled.
+        :rtype: generator
+        """
+        for num, top_dir in enumerate(top_dirs):
+            metrics.set_progress(float(num) / len(top_dirs), top_dir)
+            top_node = self.get(top_dir)
+            if top_node is None:
+                top_node = make_node(top_dir)
+                self.add(top_node)
+            yield top_node
+
+    def finish(self):
+        """Removes the checkpoint after a full scan"""
+        self._file.close()
+        os.remove(self.file_name)
+
+    def complete(self):
+        """Marks a sharded scan as finished, and keeps the checkpoint for the merge"""
+        self._write({'complete': True})
+        self._file.close()
+
+    def close(self):
+        """Closes the checkpoint, keeping it for a later resume"""
+        self._file.close()
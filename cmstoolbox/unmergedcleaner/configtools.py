@@ -132,6 +132,30 @@ DEFAULTS = {
     'MIN_AGE':       60 * 60 * 24 * 7 * 2,    # Corresponds to two weeks
     'WHICH_LIST':    'directories',
     'SLEEP_TIME':    0.5,
+    'DELETE_RATE':   None,
+    'DELETE_MAX_IN_FLIGHT': 1,
+    'MANIFEST_FILE': None,
+    'DELETE_ORDER':  'file',
+    'HADOOP_SKIP_TRASH': False,
+    'UNLINK_THREADS': 1,
+    'UNLINK_SIZES':  False,
+    'WEBHDFS_URL':   None,
+    'WEBHDFS_USER':  None,
+    'TRACE_FILE':    None,
+    'REPLAY_FILE':   None,
+    'REPLAY_LATENCY_SCALE': 1.0,
+    'SCAN_THREADS':  1,
+    'SCAN_CACHE':    None,
+    'ESTIMATE_FRACTION': 0.05,
+    'ESTIMATE_MIN_SAMPLE': 3,
+    'SORT_CHUNK_SIZE': 1000000,
+    'DAEMON_SOCKET': None,
+    'DAEMON_RESCAN_TIME': 60 * 60,    # Corresponds to one hour
+    'DUMP_FORMAT':   None,
+    'DUMP_COLUMNS':  {'path': 'path', 'type': 'type', 'size': 'size', 'mtime': 'mtime'},
+    'METRICS_PROM_FILE': None,
+    'METRICS_JSON_FILE': None,
+    'METRICS_INTERVAL': 10,
 }
 
 DOCS = {
@@ -148,8 +172,28 @@ DOCS = {
          'retrieved from Phedex (default) or given explicitly.'),
     'STORAGE_TYPE':
         ('This defines the storage type of the site. This may be necessary for the script to run\n'
-         'correctly or optimally. Acceptable values are ``\'posix\'`` and ``\'hadoop\'``.\n'
+         'correctly or optimally. Acceptable values are ``\'posix\'``, ``\'hadoop\'``,\n'
+         '``\'webhdfs\'``, ``\'dcache\'``, ``\'memory\'``, and ``\'replay\'``,\n'
+         'or the dotted path to a backend class, like ``\'mysite.storage.MyBackend\'``.\n'
          'The default is ``\'%s\'``.' % DEFAULTS['STORAGE_TYPE']),
+    'WEBHDFS_URL':
+        ('The location of the WebHDFS or HttpFS server used when **STORAGE_TYPE** is\n'
+         '``\'webhdfs\'``, like ``\'http://namenode:9870\'``. The default is ``%s``.'
+         % DEFAULTS['WEBHDFS_URL']),
+    'WEBHDFS_USER':
+        ('The user name sent to the WebHDFS server. The default is ``%s``,\n'
+         'which does not send a user name.' % DEFAULTS['WEBHDFS_USER']),
+    'TRACE_FILE':
+        ('If set, every call to the storage is recorded to this file, with its result\n'
+         'and latency. The file is gzipped if its name ends with ``.gz``.\n'
+         'The default is ``%s``, which records nothing.' % DEFAULTS['TRACE_FILE']),
+    'REPLAY_FILE':
+        ('The trace recorded with **TRACE_FILE** that is served when **STORAGE_TYPE**\n'
+         'is ``\'replay\'``. The default is ``%s``.' % DEFAULTS['REPLAY_FILE']),
+    'REPLAY_LATENCY_SCALE':
+        ('When **STORAGE_TYPE** is ``\'replay\'``, each call waits as long as it took when\n'
+         'it was recorded, times this. Use ``0`` to not wait at all.\n'
+         'The default is ``%s``.' % DEFAULTS['REPLAY_LATENCY_SCALE']),
     'DELETION_FILE':
         ('The list of directory or file PFNs to delete are placed this file.\n'
          'The default is ``\'/tmp/<WHICH_LIST>_to_delete.txt\'``.'),
@@ -170,7 +214,93 @@ DOCS = {
         ('This is the number of seconds between each deletion of a directory or file.\n'
          'The sleep avoids overloading the system and '
          'allows the operator to interrupt a deletion.\n'
-         'The default is ``%s``.' % DEFAULTS['SLEEP_TIME']),
+         'The default is ``%s``. It is only used if **DELETE_RATE** is not set.'
+         % DEFAULTS['SLEEP_TIME']),
+    'DELETE_RATE':
+        ('The most directories or files deleted each second.\n'
+         'A value of ``0`` deletes as fast as possible.\n'
+         'The default is ``%s``, which is one deletion every **SLEEP_TIME** seconds.'
+         % DEFAULTS['DELETE_RATE']),
+    'DELETE_MAX_IN_FLIGHT':
+        ('The number of deletions that can happen at the same time.\n'
+         'The default is ``%s``.' % DEFAULTS['DELETE_MAX_IN_FLIGHT']),
+    'MANIFEST_FILE':
+        ('If set, listing directories also writes the size, number of files and subdirectories,\n'
+         'and latest modification time of each deletable directory to this manifest.\n'
+         'It is an SQLite database if the name ends with ``.sqlite``, ``.sqlite3``, or ``.db``,\n'
+         'and a file with one JSON object on each line otherwise.\n'
+         'The default is ``%s``, which writes no manifest.' % DEFAULTS['MANIFEST_FILE']),
+    'DELETE_ORDER':
+        ('The order of the deletions when there is a **MANIFEST_FILE**.\n'
+         'This is ``\'file\'`` for the order of the **DELETION_FILE**, ``\'path\'``,\n'
+         '``\'largest\'`` for the most bytes first, or ``\'oldest\'`` for the oldest first.\n'
+         'The default is ``\'%s\'``.' % DEFAULTS['DELETE_ORDER']),
+    'HADOOP_SKIP_TRASH':
+        ('If True, directories deleted when **STORAGE_TYPE** is ``\'hadoop\'`` are removed\n'
+         'right away instead of being moved to the HDFS trash.\n'
+         'The default is ``%s``.' % DEFAULTS['HADOOP_SKIP_TRASH']),
+    'UNLINK_THREADS':
+        ('The number of threads unlinking the files of one large directory at the same time,\n'
+         'when deleting directories on ``\'posix\'`` storage.\n'
+         'The default is ``%s``, which unlinks one file at a time.' % DEFAULTS['UNLINK_THREADS']),
+    'UNLINK_SIZES':
+        ('If True, each file is looked up before it is unlinked when deleting directories\n'
+         'on ``\'posix\'`` storage, so the bytes freed are counted in the journal and metrics.\n'
+         'This is one more call to the storage for each file.\n'
+         'The default is ``%s``.' % DEFAULTS['UNLINK_SIZES']),
+    'SCAN_THREADS':
+        ('The number of threads listing directories at the same time.\n'
+         'Sibling directories are listed concurrently, which helps on filesystems\n'
+         'where each listing waits on the network, like NFS or FUSE mounts.\n'
+         'The default is ``%s``, which lists one directory at a time.' % DEFAULTS['SCAN_THREADS']),
+    'SCAN_CACHE':
+        ('The location of a file that caches the directory listings between scans.\n'
+         'Directories that have not been modified since the last scan are not listed again.\n'
+         'Pass ``--full-scan`` to list everything anyway.\n'
+         'The default is ``%s``, which does not use a cache.' % DEFAULTS['SCAN_CACHE']),
+    'ESTIMATE_FRACTION':
+        ('With ``--estimate``, each directory has at least this chance to be listed,\n'
+         'so about this fraction of the unmerged directory is read.\n'
+         'The default is ``%s``.' % DEFAULTS['ESTIMATE_FRACTION']),
+    'ESTIMATE_MIN_SAMPLE':
+        ('With ``--estimate``, at least this many subdirectories of each directory are listed.\n'
+         'It must be at least 2 for the confidence intervals.\n'
+         'The default is ``%s``.' % DEFAULTS['ESTIMATE_MIN_SAMPLE']),
+    'SORT_CHUNK_SIZE':
+        ('When WHICH_LIST is ``\'files\'``, this many files are sorted in memory at once.\n'
+         'Longer lists are sorted in chunks in temporary files next to the **DELETION_FILE**.\n'
+         'The default is ``%s``.' % DEFAULTS['SORT_CHUNK_SIZE']),
+    'DAEMON_SOCKET':
+        ('When running with ``--daemon``, a new deletion file is written when\n'
+         'a line with ``write`` is sent to a Unix socket at this location.\n'
+         'The default is ``%s``, which only listens for ``SIGUSR1``.' % DEFAULTS['DAEMON_SOCKET']),
+    'DAEMON_RESCAN_TIME':
+        ('When running with ``--daemon``, the deletion file is written after this many seconds\n'
+         'without a request. Directories that cannot be watched for changes are listed again\n'
+         'after this long. The default (``%s``) corresponds to one hour.'
+         % DEFAULTS['DAEMON_RESCAN_TIME']),
+    'DUMP_FORMAT':
+        ('The format of the namespace dump given with ``--dump``. Possible values are\n'
+         '``\'csv\'``, ``\'tsv\'``, or ``\'ndjson\'``. The default is ``%s``,\n'
+         'which guesses the format from the file name.' % DEFAULTS['DUMP_FORMAT']),
+    'DUMP_COLUMNS':
+        ('Where the path, type, size, and modification time are in the namespace dump.\n'
+         'Values are header names or JSON keys, or column numbers starting at 0\n'
+         'for CSV or TSV dumps without a header. The type can be left out.\n'
+         'The default is ``%s``.' % DEFAULTS['DUMP_COLUMNS']),
+    'METRICS_PROM_FILE':
+        ('While scanning or deleting, progress and throughput counters are written to this file\n'
+         'in the Prometheus text format. Point it into the directory of the node exporter\'s\n'
+         'textfile collector, with a name ending in ``.prom``.\n'
+         'The default is ``%s``, which writes no file.' % DEFAULTS['METRICS_PROM_FILE']),
+    'METRICS_JSON_FILE':
+        ('While scanning or deleting, the same counters as **METRICS_PROM_FILE**\n'
+         'are written to this JSON status file.\n'
+         'The default is ``%s``, which writes no file.' % DEFAULTS['METRICS_JSON_FILE']),
+    'METRICS_INTERVAL':
+        ('The number of seconds between writes of **METRICS_PROM_FILE**\n'
+         'and **METRICS_JSON_FILE**.\n'
+         'The default is ``%s``.' % DEFAULTS['METRICS_INTERVAL']),
 }
 
 VAR_ORDER = [
@@ -180,9 +310,33 @@ VAR_ORDER = [
     'WHICH_LIST',
     'DELETION_FILE',
     'SLEEP_TIME',
+    'DELETE_RATE',
+    'DELETE_MAX_IN_FLIGHT',
+    'MANIFEST_FILE',
+    'DELETE_ORDER',
+    'HADOOP_SKIP_TRASH',
+    'UNLINK_THREADS',
+    'UNLINK_SIZES',
     'DIRS_TO_AVOID',
     'MIN_AGE',
     'STORAGE_TYPE',
+    'WEBHDFS_URL',
+    'WEBHDFS_USER',
+    'TRACE_FILE',
+    'REPLAY_FILE',
+    'REPLAY_LATENCY_SCALE',
+    'SCAN_THREADS',
+    'SCAN_CACHE',
+    'ESTIMATE_FRACTION',
+    'ESTIMATE_MIN_SAMPLE',
+    'SORT_CHUNK_SIZE',
+    'DAEMON_SOCKET',
+    'DAEMON_RESCAN_TIME',
+    'DUMP_FORMAT',
+    'DUMP_COLUMNS',
+    'METRICS_PROM_FILE',
+    'METRICS_JSON_FILE',
+    'METRICS_INTERVAL',
     ]
 
 
@@ -240,3 +394,51 @@ def generate_default_config():
                 config_file.write('\n#' + '-' * 99 + '\n')
                 config_file.write('# ' + DOCS[var].replace('\n', '\n# ').replace('``', '') + '\n\n')
                 config_file.write(get_default(var) + '\n')
+
+
+def load_config(path=None, key=None):
+    """
+    Loads the configuration, either from a static JSON file or from a dynamic module.
+    The module must lie in the sys.path and be named config.py.
+    Options missing from older configuration files are filled in from :py:data:`DEFAULTS`.
+
+    :param str path: Path to JSON file. If None (default),
+                     loads the first module found called config,
+                     or generates a module in the working directory and quits.
+    :param str key: The key to search for the unmerged cleaner configuration.
+                    This allows nesting inside other configuration files.
+    :returns: The configuration module
+    :rtype: module
+    """
+
+    if path:
+        from . import _config as config # pylint: disable = import-outside-toplevel
+
+        with open(path, 'r') as infile:
+            fileconfig = json.load(infile)
+        if key:
+            fileconfig = fileconfig[key]
+
+        # Now overwrite the defaults
+        for variable, value in fileconfig.items():
+            setattr(config, variable, value)
+
+    else:
+        try:
+            import config                   # pylint: disable = import-outside-toplevel
+
+        except ImportError:
+            print('Generating default configuration...')
+            generate_default_config()
+
+            print('\nConfiguration created at config.py.')
+            print('Please correct the default values to match your site')
+            print('and run this script again.')
+            sys.exit()
+
+    # Fill in options that are missing from older configuration files
+    for variable, value in DEFAULTS.items():
+        if not hasattr(config, variable):
+            setattr(config, variable, value)
+
+    return config
@@ -0,0 +1,329 @@
+"""
+This module runs the event loop of ``listdeletable.py --daemon`` for the :ref:`unmerged-ref`.
+The directory listings are kept current by a :py:class:`residentscan.WatchedListings`,
+the filled trees are kept by :py:class:`ResidentTrees`,
+and the deletion file is written again when asked.
+
+A write is asked for by the signal ``SIGUSR1``, by sending ``write`` to a Unix socket,
+or by the rescan time passing since the last write.
+The loop stops on ``SIGTERM``, ``SIGINT``, or when ``stop`` is sent to the socket.
+A request sent to the socket ends with a newline or when the client stops sending.
+A client that does not finish its request within :py:data:`CLIENT_TIMEOUT` seconds
+gets an error, so it cannot hold up the loop.
+Each request sent to the socket gets a reply of one line:
+``ok`` and the number of directories written for a write,
+or ``error`` and the reason the request failed.
+Signals are only handled when the loop is run from the main thread.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import logging
+
+
+LOG = logging.getLogger(__name__)
+
+HANDLED_SIGNALS = (signal.SIGUSR1, signal.SIGTERM, signal.SIGINT)
+"""The signals that are turned into requests."""
+
+CLIENT_TIMEOUT = 5
+"""The most seconds a client connected to the socket has to send its request."""
+
+MAX_REQUEST = 64
+"""The most bytes read for one request."""
+
+
+def read_request(client):
+    """
+    :param socket.socket client: A client connected to the socket
+    :returns: The request, up to the first newline, or None if it was not sent in time
+    :rtype: str
+    """
+
+    deadline = time.time() + CLIENT_TIMEOUT
+    data = b''
+    try:
+        while b'\n' not in data and len(data) < MAX_REQUEST:
+            client.settimeout(max(deadline - time.time(), 0.001))
+            chunk = client.recv(MAX_REQUEST - len(data))
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        LOG.warning('A client did not send its request within %s seconds', CLIENT_TIMEOUT)
+        return None
+
+    return data.split(b'\n')[0].decode('utf-8', 'replace').strip()
+
+
+def send_reply(client, reply):
+    """
+    Sends a reply and closes the client. A client that went away is only logged.
+
+    :param socket.socket client: A client connected to the socket
+    :param str reply: The reply
+    """
+
+    try:
+        client.settimeout(CLIENT_TIMEOUT)
+        client.sendall(reply.encode())
+    except socket.error as err:
+        LOG.warning('Could not reply to a client: %s', err)
+    finally:
+        client.close()
+
+
+def wakeup_pipe():
+    """
+    :returns: The read and write ends of a non-blocking pipe,
+              used to wake up the loop when a signal arrives
+    :rtype: tuple
+    """
+    ends = os.pipe()
+    for pipe_end in ends:
+        fcntl.fcntl(pipe_end, fcntl.F_SETFL,
+                    fcntl.fcntl(pipe_end, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return ends
+
+
+class Daemon(object):
+    """
+    Waits for inotify events and requests, and answers the requests until asked to stop.
+    """
+
+    def __init__(self, listings, refresh, rescan_time, socket_path=None):
+        """
+        :param residentscan.WatchedListings listings: The listings to keep current
+        :param function refresh: Brings the trees up to date and writes the deletion file.
+                                 It returns the number of directories written.
+        :param int rescan_time: The most seconds between writes
+        :param str socket_path: If given, requests are also taken from a Unix socket here
+        """
+        self.listings = listings
+        self.refresh = refresh
+        self.rescan_time = rescan_time
+        self.socket_path = socket_path
+        self.requests = []
+        self.running = False
+        self.last_refresh = 0
+
+        self._wake = None
+        self._server = None
+        self._old_handlers = {}
+        self._old_wakeup = None
+
+    def run(self):
+        """
+        Writes the deletion file once, and then answers requests until asked to stop.
+        The listings are not closed.
+        """
+
+        try:
+            self._start()
+            self.refresh()
+            self.last_refresh = time.time()
+            self.running = True
+
+            while self.running:
+                client = self._wait()
+                while self.requests:
+                    reply = self._answer(self.requests.pop(0))
+                    if client is not None:
+                        send_reply(client, reply)
+                        client = None
+
+        finally:
+            self._stop()
+
+    def _handle_signal(self, signum, _):
+        """Queues the request for a signal. The wakeup file descriptor ends the select."""
+        self.requests.append('write' if signum == signal.SIGUSR1 else 'stop')
+
+    def _start(self):
+        """Starts handling signals, if this is the main thread, and opens the socket"""
+
+        self._wake = wakeup_pipe()
+        try:
+            for signum in HANDLED_SIGNALS:
+                self._old_handlers[signum] = signal.signal(signum, self._handle_signal)
+            self._old_wakeup = signal.set_wakeup_fd(self._wake[1])
+        except ValueError:
+            LOG.warning('Not running in the main thread. Signals are not handled.')
+
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(self.socket_path)
+            self._server.listen(5)
+
+    def _stop(self):
+        """Closes the socket and gives the signals back to their old handlers"""
+
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            os.remove(self.socket_path)
+
+        for signum, handler in self._old_handlers.items():
+            signal.signal(signum, handler)
+        self._old_handlers = {}
+        if self._old_wakeup is not None:
+            signal.set_wakeup_fd(self._old_wakeup)
+            self._old_wakeup = None
+
+        if self._wake is not None:
+            for pipe_end in self._wake:
+                os.close(pipe_end)
+            self._wake = None
+
+    def _wait(self):
+        """
+        Waits until there are events, a signal, or a request, or until a write is due.
+        Events are processed, and requests are added to :py:attr:`requests`.
+
+        :returns: The client connection that sent a request, if any
+        :rtype: socket.socket
+        """
+
+        waiting = [self.listings, self._wake[0]]
+        if self._server is not None:
+            waiting.append(self._server)
+        ready = self._select(waiting, max(0, self.last_refresh + self.rescan_time - time.time()))
+
+        if self._wake[0] in ready:
+            self._drain_wake()
+
+        if self.listings in ready:
+            self.listings.process_events()
+
+        client = None
+        if self._server is not None and self._server in ready:
+            client = self._accept()
+
+        if time.time() >= self.last_refresh + self.rescan_time and \
+                'write' not in self.requests:
+            self.requests.append('write')
+
+        return client
+
+    @staticmethod
+    def _select(waiting, timeout):
+        """
+        :param list waiting: The files to wait for
+        :param float timeout: The most seconds to wait
+        :returns: The files that are ready, which is none if a signal ended the wait
+        :rtype: list
+        """
+        try:
+            return select.select(waiting, [], [], timeout)[0]
+        except (select.error, OSError) as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def _drain_wake(self):
+        """Empties the wakeup pipe after a signal"""
+        try:
+            os.read(self._wake[0], 512)
+        except OSError:
+            pass
+
+    def _accept(self):
+        """
+        Reads the request of a new client and adds it to :py:attr:`requests`.
+
+        :returns: The client, or None if it did not send its request in time
+        :rtype: socket.socket
+        """
+        client = self._server.accept()[0]
+        request = read_request(client)
+        if request is None:
+            send_reply(client, 'error timed out\n')
+            return None
+
+        self.requests.append(request)
+        return client
+
+    def _answer(self, request):
+        """
+        Does what a request asks.
+
+        :param str request: ``'write'`` or ``'stop'``
+        :returns: The reply to the request
+        :rtype: str
+        """
+
+        if request == 'write':
+            self.last_refresh = time.time()
+            try:
+                return 'ok %i\n' % self.refresh()
+            except Exception as err:     # pylint: disable=broad-except
+                # Keep the old deletion file and try again on the next request
+                LOG.exception('Could not write the deletion file')
+                return 'error %s\n' % err
+
+        if request == 'stop':
+            self.running = False
+            return 'ok\n'
+
+        return 'error unknown command %s\n' % request
+
+
+class ResidentTrees(object):
+    """
+    The filled trees of the top level directories, kept between writes.
+    Only the top level directories with changes are filled again.
+    The other trees only have the ages of their directories checked against the current time.
+    """
+
+    def __init__(self, listings, make_node, min_age):
+        """
+        :param residentscan.WatchedListings listings: The listings of the unmerged location
+        :param function make_node: Takes the name of a top level directory
+                                   and gives a node that can be filled from *listings*,
+                                   like a :py:class:`listdeletable.DataNode`
+        :param int min_age: The least age of a directory that can be deleted
+        """
+        self.listings = listings
+        self.make_node = make_node
+        self.min_age = min_age
+        self.top_nodes = {}
+
+    def clear(self):
+        """Drops every tree, so that they are all filled again"""
+        self.top_nodes.clear()
+
+    def refresh(self, subdirs, now):
+        """
+        :param list subdirs: The current top level directories, in the order to write them
+        :param int now: The time ages are measured from
+        :returns: The filled node of each top level directory
+        :rtype: list
+        """
+
+        start = time.time()
+        self.listings.process_events()
+        dirty = self.listings.take_dirty()
+
+        for subdir in list(self.top_nodes):
+            if subdir not in subdirs:
+                del self.top_nodes[subdir]
+
+        for subdir in subdirs:
+            top_node = self.top_nodes.get(subdir)
+            if top_node is None or subdir in dirty:
+                top_node = self.make_node(subdir)
+                top_node.fill(cache=self.listings)
+                self.top_nodes[subdir] = top_node
+            else:
+                top_node.tree.update_flags(now, self.min_age)
+
+        LOG.info('Refreshed %i of %i top level directories in %.2f seconds',
+                 len(dirty.intersection(subdirs)), len(subdirs), time.time() - start)
+        return [self.top_nodes[subdir] for subdir in subdirs]
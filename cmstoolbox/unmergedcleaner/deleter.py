@@ -0,0 +1,498 @@
+"""
+This module runs the deletions of the :ref:`unmerged-ref` with a pool of worker threads.
+The load on the storage is set by two numbers instead of a fixed sleep between deletions:
+
+- the rate, in deletions per second, enforced by a token bucket shared by the workers
+- the number of deletions in flight at the same time, which is the number of workers
+
+The list of deletions is read as the workers take them, so it is never held in memory.
+When the list stops early, because of ``Ctrl-C`` or an error while reading it,
+no new deletions are started and the ones in flight are allowed to finish.
+
+:py:func:`delete_listed` deletes the entries of a deletion file this way.
+The entries are read by :py:func:`deletion_entries`,
+in the order of the deletion file or of the manifest.
+Each finished entry is written to the journal by :py:class:`JournaledDeletions`,
+which also measures the progress.
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+from . import backends
+from . import journal
+from . import manifest
+
+
+LOG = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    A token bucket that can be shared between threads.
+    Each caller of :py:meth:`wait` takes a token, sleeping until one is available.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param float rate: The number of tokens added each second.
+                           If zero or None, there is no limit.
+        :param int burst: The most tokens that can be saved up while no one is waiting
+        """
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._last = time.time()
+
+    def reserve(self, count=1):
+        """
+        Takes tokens, which can be tokens that are not there yet.
+
+        :param int count: The number of tokens to take
+        :returns: How long to wait, in seconds, until the tokens are there
+        :rtype: float
+        """
+
+        if not self.rate:
+            return 0
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= count
+
+            return max(0, -self._tokens / self.rate)
+
+    def wait(self, stop=None, count=1):
+        """
+        Takes tokens, sleeping until they are there.
+
+        :param threading.Event stop: If given, stop waiting when this is set
+        :param int count: The number of tokens to take
+        :returns: False if *stop* was set while waiting
+        :rtype: bool
+        """
+
+        delay = self.reserve(count)
+        if stop is None:
+            time.sleep(delay)
+            return True
+
+        # Event.wait returns None before Python 2.7, so the flag is checked instead
+        if delay:
+            stop.wait(delay)
+        return not stop.is_set()
+
+
+class DeletionStats(object):
+    """
+    Counts the finished deletions, for reporting the throughput.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.deleted = 0
+        self.failed = 0
+        self.interrupted = False
+        self._lock = threading.Lock()
+
+    def add(self, deleted=0, failed=0):
+        """
+        :param int deleted: The number of deletions that worked
+        :param int failed: The number of deletions that failed
+        """
+        with self._lock:
+            self.deleted += deleted
+            self.failed += failed
+
+    def rate(self):
+        """
+        :returns: The deletions per second since the start
+        :rtype: float
+        """
+        elapsed = time.time() - self.start
+        return (self.deleted + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    def log(self, message='Progress'):
+        """
+        Logs the counts and throughput.
+
+        :param str message: What to call this report
+        """
+        LOG.info('%s: %i deleted, %i failed, %.1f per second',
+                 message, self.deleted, self.failed, self.rate())
+
+
+class DeletionPool(object):
+    """
+    A pool of threads that does deletions from a queue.
+    Exceptions raised by *delete* are logged and counted as failures.
+    An entry can be a batch of several deletions, if *size* is given.
+    Then *delete* returns the number of deletions in the batch that failed.
+    """
+
+    def __init__(self, delete, rate=None, max_in_flight=1, size=None):
+        """
+        :param function delete: The function that does one deletion
+        :param float rate: The most deletions to start each second.
+                           If zero or None, there is no limit.
+        :param int max_in_flight: The number of deletions that can happen at the same time
+        :param function size: If given, this gives the number of deletions in each entry,
+                              which are all counted by the rate limit and in the results
+        """
+        max_in_flight = max(1, max_in_flight)
+        self.delete = delete
+        self.size = size
+        self.bucket = TokenBucket(rate)
+        self.stats = DeletionStats()
+        self.stop = threading.Event()
+        self.tasks = Queue(max_in_flight)
+        self.workers = [threading.Thread(target=self._work) for _ in range(max_in_flight)]
+
+    def run(self, entries, report_time=10.0):
+        """
+        Deletes everything in a list.
+        Exceptions raised while reading *entries* stop the deletion and are raised again,
+        after the deletions in flight are finished.
+
+        :param entries: The things to delete, given one at a time to *delete*
+        :type entries: iterable
+        :param float report_time: The number of seconds between logging the progress
+        :returns: The counts of the deletions. If ``Ctrl-C`` was pressed,
+                  ``interrupted`` is True.
+        :rtype: DeletionStats
+        """
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            self._submit(entries, report_time)
+            self._join()
+
+        except KeyboardInterrupt:
+            LOG.warning('Interrupted. Waiting for the deletions in flight to finish.')
+            self.stats.interrupted = True
+
+        finally:
+            self.stop.set()
+            for worker in self.workers:
+                worker.join()
+
+        self.stats.log('Finished' if not self.stats.interrupted else 'Stopped')
+
+        return self.stats
+
+    def _work(self):
+        """Does deletions until the end of the list, or until stopped"""
+        while not self.stop.is_set():
+            try:
+                entry = self.tasks.get(timeout=0.1)
+            except Empty:
+                continue
+
+            if entry is None or not self._collect(entry):
+                return
+
+    def _collect(self, entry):
+        """
+        Does one entry and counts the results.
+
+        :param entry: The entry to delete
+        :returns: False if stopped while waiting for the rate limit
+        :rtype: bool
+        """
+
+        count = 1 if self.size is None else self.size(entry)
+        if not self.bucket.wait(self.stop, count):
+            return False
+
+        try:
+            failed = self.delete(entry) or 0
+            self.stats.add(count - failed, failed)
+        except Exception as err:    # pylint: disable=broad-except
+            LOG.error('Could not delete %s: %s', entry, err)
+            self.stats.add(failed=count)
+
+        return True
+
+    def _put(self, entry):
+        """Waits for room in the queue, without blocking Ctrl-C"""
+        while not self.stop.is_set():
+            try:
+                self.tasks.put(entry, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _submit(self, entries, report_time):
+        """
+        Queues all of the entries, then one None for each worker to stop it.
+
+        :param entries: The things to delete
+        :type entries: iterable
+        :param float report_time: The number of seconds between logging the progress
+        """
+
+        last_report = time.time()
+        for entry in entries:
+            self._put(entry)
+            if time.time() - last_report > report_time:
+                self.stats.log()
+                last_report = time.time()
+
+        for _ in self.workers:
+            self._put(None)
+
+    def _join(self):
+        """Waits for the workers, with a timeout so that Ctrl-C still reaches this thread"""
+        for worker in self.workers:
+            while worker.is_alive():
+                worker.join(0.1)
+
+
+def run_deletions(entries, delete, rate=None, max_in_flight=1, report_time=10.0, size=None):
+    """
+    Deletes everything in a list with a :py:class:`DeletionPool`.
+
+    :param entries: The things to delete, given one at a time to *delete*
+    :type entries: iterable
+    :param function delete: The function that does one deletion
+    :param float rate: The most deletions to start each second.
+                       If zero or None, there is no limit.
+    :param int max_in_flight: The number of deletions that can happen at the same time
+    :param float report_time: The number of seconds between logging the progress
+    :param function size: If given, this gives the number of deletions in each entry
+    :returns: The counts of the deletions. If ``Ctrl-C`` was pressed,
+              ``interrupted`` is True.
+    :rtype: DeletionStats
+    """
+
+    return DeletionPool(delete, rate, max_in_flight, size).run(entries, report_time)
+
+
+def deletion_entries(deletion_file, listing=None, order='file'):
+    """
+    Reads the entries to delete, with the amount of work each one stands for.
+    Without a manifest, the work is the bytes of the deletion file,
+    and with one, it is the number of files and directories removed.
+
+    :param str deletion_file: The deletion file
+    :param manifest.Manifest listing: The manifest of the deletion file, if there is one
+    :param str order: The order of the entries in the manifest, from :py:data:`manifest.ORDERS`
+    :returns: A generator of the line number, path, and work of each entry,
+              and the total work
+    :rtype: tuple
+    """
+
+    if listing is None:
+        def entries():
+            """Gives the line number, path, and bytes of each line of the deletion file"""
+            with open(deletion_file, 'r') as deletions:
+                for line, deleted in enumerate(deletions):
+                    yield line, deleted.strip('\n'), len(deleted)
+
+        return entries(), float(os.path.getsize(deletion_file)) or 1.0
+
+    num_entries, num_bytes, num_files, num_dirs = listing.totals()
+    LOG.info('The manifest lists %i entries, with %i files, %i directories, and %.1f GB',
+             num_entries, num_files, num_dirs, num_bytes / float(1024 ** 3))
+
+    return ((entry.line, entry.path, manifest.weight(entry))
+            for entry in listing.entries(order)), float(num_entries + num_files + num_dirs) or 1.0
+
+
+class JournaledDeletions(object):
+    """
+    Skips the entries that are done already, deletes the others with a storage backend,
+    and writes each finished entry to the journal.
+    The progress is the fraction of the work of the entries that is done.
+    """
+
+    def __init__(self, done, total, metrics, delete_many, check=None):
+        """
+        :param journal.DeletionJournal done: The journal of the deletion file
+        :param float total: The work of all of the entries
+        :param metrics.Metrics metrics: Counts the deletions and the progress
+        :param function delete_many: Takes a list of paths and returns
+                                     an ``(outcome, bytes)`` for each, like
+                                     :py:meth:`backends.StorageBackend.delete_many`
+        :param function check: If given, this is called with each path before it is deleted,
+                               to stop if the path is not safe to delete
+        """
+        self.done = done
+        self.total = total
+        self.metrics = metrics
+        self.delete_many = delete_many
+        self.check = check
+        self.progress = 0
+        # Line numbers and amounts of work of the entries that are in flight, by path
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def advance(self, amount):
+        """
+        :param float amount: The work that was just done
+        """
+        with self._lock:
+            self.progress += amount
+            self.metrics.set_progress(self.progress / self.total)
+
+    def finished(self, deleting):
+        """
+        :param str deleting: The path of an entry that is out of flight
+        :returns: The line number of the entry
+        :rtype: int
+        """
+        with self._lock:
+            lines = self._pending[deleting]
+            line, amount = lines.pop(0)
+            if not lines:
+                del self._pending[deleting]
+        self.advance(amount)
+        return line
+
+    def unfinished(self, entries):
+        """
+        :param entries: The line number, path, and work of each entry,
+                        from :py:func:`deletion_entries`
+        :type entries: iterable
+        :returns: The paths of the entries that are not done yet
+        :rtype: generator
+        """
+        for line, deleting, amount in entries:
+            if self.done.is_done(line) or not deleting:
+                self.advance(amount)
+                continue
+
+            if self.check is not None:
+                self.check(deleting)
+
+            with self._lock:
+                self._pending.setdefault(deleting, []).append((line, amount))
+            yield deleting
+
+    def delete(self, batch):
+        """
+        Deletes a batch and writes the outcomes to the journal.
+
+        :param list batch: The paths to delete
+        :returns: The number of deletions that failed
+        :rtype: int
+        """
+        try:
+            outcomes = self.metrics.timed('delete_many', self.delete_many, batch)
+        except Exception:
+            for deleting in batch:
+                self.done.record(self.finished(deleting), deleting, backends.FAILED)
+                self.metrics.add_deletion(backends.FAILED)
+            raise
+
+        failed = 0
+        for deleting, (outcome, size) in zip(batch, outcomes):
+            self.done.record(self.finished(deleting), deleting, outcome, size)
+            self.metrics.add_deletion(outcome, size)
+            failed += outcome == backends.FAILED
+
+        return failed
+
+
+def delete_rate(config):
+    """
+    :param module config: The configuration of the cleaner
+    :returns: The deletions per second from **DELETE_RATE**,
+              or from **SLEEP_TIME** if **DELETE_RATE** is not set.
+              Zero means there is no limit.
+    :rtype: float
+    """
+
+    if config.DELETE_RATE is not None:
+        return config.DELETE_RATE
+
+    return 1.0 / config.SLEEP_TIME if config.SLEEP_TIME else 0
+
+
+def check_unmerged(deleting, deletion_file):
+    """
+    Ends the process if a path in the deletion file is not in an unmerged directory.
+
+    :param str deleting: A path to delete
+    :param str deletion_file: The deletion file the path is from
+    """
+
+    if '/unmerged/' not in deleting:
+        LOG.error('Something is either wrong with your deletions file or')
+        LOG.error('ListDetetable.do_delete().')
+        LOG.error('Your deletions file is at %s', deletion_file)
+        LOG.error('Refusing to continue.')
+        sys.exit()
+
+
+def delete_listed(config, backend, export_metrics, check=None):
+    """
+    Deletes the entries of the **DELETION_FILE** with a storage backend.
+    Each finished entry is written to a journal next to the deletion file,
+    so that running this again after it stops skips the entries that are done.
+    See :py:mod:`cmstoolbox.unmergedcleaner.journal`.
+
+    If the **MANIFEST_FILE** was written with the deletion file,
+    the entries are deleted in the **DELETE_ORDER**,
+    and the progress counts the files and directories removed.
+    Otherwise, the entries are deleted in the order of the deletion file,
+    and the progress counts the bytes of the deletion file read.
+    See :py:mod:`cmstoolbox.unmergedcleaner.manifest`.
+
+    :param module config: The configuration of the cleaner
+    :param backends.StorageBackend backend: Does the deletions, and is closed at the end
+    :param function export_metrics: Takes the name of a phase, and returns
+                                    a :py:class:`metrics.MetricsExporter` of new counters
+    :param function check: If given, this is called with each path before it is deleted
+    :returns: The counts of the deletions
+    :rtype: DeletionStats
+    """
+
+    rate = delete_rate(config)
+
+    LOG.info('-' * 40)
+    LOG.info('Deleting individual %s.', config.WHICH_LIST)
+    LOG.info('Your deletion rate is set to %s per second, with %s at the same time.',
+             rate or 'unlimited', config.DELETE_MAX_IN_FLIGHT)
+    LOG.info('To change it, edit DELETE_RATE and DELETE_MAX_IN_FLIGHT in your config.py.')
+    LOG.info('-' * 40)
+
+    done = journal.DeletionJournal('%s.journal' % config.DELETION_FILE, config.DELETION_FILE)
+    listing = manifest.open_manifest(config.MANIFEST_FILE, config.DELETION_FILE)
+    if listing is None and config.DELETE_ORDER != 'file':
+        LOG.warning('There is no manifest for this deletion file, '
+                    'so the deletions are in the order of the file.')
+
+    recursive = config.WHICH_LIST == 'directories'
+
+    stats = None
+    try:
+        entries, total = deletion_entries(config.DELETION_FILE, listing, config.DELETE_ORDER)
+        with export_metrics('delete') as exporter:
+            deletions = JournaledDeletions(
+                done, total, exporter.metrics,
+                lambda batch: backend.delete_many(batch, recursive), check)
+            stats = run_deletions(backend.batches(deletions.unfinished(entries), recursive),
+                                  deletions.delete, rate, config.DELETE_MAX_IN_FLIGHT, size=len)
+
+    finally:
+        backend.close()
+        done.finish(stats is None or stats.interrupted)
+        if listing is not None:
+            listing.close()
+
+    return stats
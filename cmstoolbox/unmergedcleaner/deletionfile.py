@@ -0,0 +1,115 @@
+"""
+This module writes the deletion file of the :ref:`unmerged-ref` when listing directories.
+
+Each top level directory is written as soon as it is received,
+and nothing is kept from it afterwards, so a generator that fills
+one top level directory at a time only needs memory for one tree at a time.
+The directories are written to a temporary file that replaces the deletion file at the end,
+so the deletion file is never partially written.
+The manifest is written the same way, if there is one.
+See :py:mod:`cmstoolbox.unmergedcleaner.manifest`.
+
+A summary row of each top level directory is logged as it is written,
+followed by the totals.
+"""
+
+import os
+import logging
+
+from . import manifest
+
+
+LOG = logging.getLogger(__name__)
+
+
+def write_top(top_node, location, del_file, writer=None, first_line=0):
+    """
+    Writes the directories that can be deleted inside one top level directory
+    and logs its summary row.
+
+    :param listdeletable.DataNode top_node: The filled top level directory
+    :param str location: The PFN of the unmerged location
+    :param file del_file: The open deletion file
+    :param manifest.ManifestWriter writer: If given, gets an entry for each directory written
+    :param int first_line: The line of the deletion file the first directory is written to
+    :returns: The number of directories written, the number of directories
+              and files inside of them, and their total size in GB
+    :rtype: tuple
+    """
+
+    list_to_del = []
+    top_node.traverse_tree(list_to_del)
+
+    num_todelete_dirs = 0   # Number of directories to be deleted
+    num_todelete_files = 0  # Number of files to be deleted
+    todelete_size = 0       # Amount of space to be deleted (in GB, eventually)
+
+    for num, item in enumerate(list_to_del):
+        num_todelete_dirs += item.nsubnodes
+        num_todelete_files += item.nsubfiles
+        todelete_size += item.size
+        pfn = os.path.join(location, item.path_name)
+        del_file.write(pfn + '\n')
+        if writer is not None:
+            writer.add(manifest.Entry(pfn, first_line + num, int(item.size), int(item.nsubfiles),
+                                      int(item.nsubnodes), int(item.latest)))
+
+    todelete_size /= (1024 * 1024 * 1024)
+    if list_to_del:
+        LOG.info("  %-8d %-8d %-6d %-9d %-s",
+                 len(list_to_del), num_todelete_dirs, num_todelete_files,
+                 todelete_size, top_node.path_name)
+
+    return len(list_to_del), num_todelete_dirs, num_todelete_files, todelete_size
+
+
+def write_deletions(top_nodes, location, deletion_file, writer=None):
+    """
+    Logs a summary of each filled top level directory
+    and writes the directories that can be deleted to the deletion file.
+
+    :param top_nodes: The filled top level directories
+    :type top_nodes: iterable
+    :param str location: The PFN of the unmerged location
+    :param str deletion_file: The deletion file to write
+    :param manifest.ManifestWriter writer: If given, the manifest to write,
+                                           which is finished with the deletion file
+    :returns: The number of directories written
+    :rtype: int
+    """
+
+    LOG.info("Some statistics about what is going to be deleted")
+    LOG.info("# Folders  Total    Total  DiskSize  FolderName")
+    LOG.info("#          Folders  Files  [GB]                ")
+
+    # The directories written, and the directories, files, and GB inside of them
+    totals = [0, 0, 0, 0]
+    tmp_name = '%s.tmp' % deletion_file
+
+    try:
+        with open(tmp_name, 'w') as del_file:
+            for top_node in top_nodes:
+                written = write_top(top_node, location, del_file, writer, totals[0])
+
+                # Let the tree go before the next one is filled
+                del top_node
+
+                totals = [total + num for total, num in zip(totals, written)]
+
+            if not totals[0]:
+                # Matches the single empty line written by older versions
+                del_file.write('\n')
+
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    os.rename(tmp_name, deletion_file)
+    if writer is not None:
+        writer.finish(deletion_file)
+
+    LOG.info("-" * 30)
+    LOG.info("  %-8d %-8d %-6d %-9d TOTALS", *totals)
+
+    return totals[0]
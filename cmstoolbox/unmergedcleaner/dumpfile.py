@@ -0,0 +1,131 @@
+"""
+This module reads the unmerged area from a namespace dump, for the :ref:`unmerged-ref`.
+Many sites already dump their namespace regularly for consistency checks,
+for example from dCache/Chimera, EOS, Lustre (``lfs find``), or XRootD.
+Reading one of those dumps gives the same trees as listing the directories,
+without touching the storage at all.
+
+A dump has one record for each file or directory, holding its path, type, size,
+and modification time. It can be a CSV or TSV file, with or without a header line,
+or a file with one JSON object on each line (NDJSON). Any of these can be gzipped.
+The columns or keys holding each field are set by **DUMP_COLUMNS**.
+
+- The path can start with either **UNMERGED_DIR_LOCATION** or **LFN_TO_CLEAN**.
+  Records for other paths are skipped.
+- The type is optional. Directories are marked by ``d``, ``dir``, or ``directory``,
+  in any case. Without a type, every record is a file.
+- The modification time is in seconds since the epoch.
+  Values too large to be seconds are taken to be milliseconds.
+"""
+
+import csv
+import json
+
+from .fsimage import open_text
+
+
+FORMATS = {
+    '.csv': 'csv',
+    '.tsv': 'tsv',
+    '.txt': 'tsv',
+    '.json': 'ndjson',
+    '.jsonl': 'ndjson',
+    '.ndjson': 'ndjson',
+}
+"""The format of a dump, guessed from the end of its file name."""
+
+DIR_TYPES = set(['d', 'dir', 'directory'])
+"""Values in the type field that mark a directory, in lower case."""
+
+MAX_SECONDS = 1e11
+"""Larger modification times are taken to be in milliseconds."""
+
+
+def guess_format(file_name):
+    """
+    :param str file_name: The name of a dump file
+    :returns: The format of the file, ``'csv'``, ``'tsv'``, or ``'ndjson'``
+    :rtype: str
+    :raises ValueError: If the format cannot be guessed
+    """
+    name = file_name[:-3] if file_name.endswith('.gz') else file_name
+    for ending, dump_format in FORMATS.items():
+        if name.endswith(ending):
+            return dump_format
+
+    raise ValueError('Cannot tell the format of %s. Set DUMP_FORMAT.' % file_name)
+
+
+def parse_mtime(value):
+    """
+    :param value: A modification time, in seconds or milliseconds
+    :type value: str or float
+    :returns: The modification time, in seconds
+    :rtype: float
+    """
+    mtime = float(value)
+    return mtime / 1000.0 if mtime > MAX_SECONDS else mtime
+
+
+def read_rows(stream, dump_format, columns):
+    """
+    :param stream: The opened dump
+    :type stream: file
+    :param str dump_format: ``'csv'``, ``'tsv'``, or ``'ndjson'``
+    :param dict columns: Maps ``'path'``, ``'type'``, ``'size'``, and ``'mtime'``
+                         to a column name, key, or index. ``'type'`` can be missing.
+    :returns: Tuples of the path, type (or None), size, and modification time of each record
+    :rtype: generator
+    """
+
+    fields = [columns.get(field) for field in ('path', 'type', 'size', 'mtime')]
+
+    if dump_format == 'ndjson':
+        for line in stream:
+            if line.strip():
+                record = json.loads(line)
+                yield tuple(None if key is None else record.get(key) for key in fields)
+        return
+
+    reader = csv.reader(stream, delimiter='\t' if dump_format == 'tsv' else ',')
+
+    indices = fields
+    if not all(isinstance(col, int) for col in fields if col is not None):
+        # Named columns come from the header
+        header = next(reader, None)
+        if header is None:
+            return
+        indices = [None if col is None else header.index(col) for col in fields]
+
+    for row in reader:
+        if row:
+            yield tuple(None if index is None else row[index] for index in indices)
+
+
+def read_dump(file_name, location, lfn, dump_format=None, columns=None):
+    """
+    Reads the records of a dump that are inside the unmerged area.
+
+    :param str file_name: The dump file
+    :param str location: The PFN of the unmerged area
+    :param str lfn: The LFN of the unmerged area
+    :param str dump_format: ``'csv'``, ``'tsv'``, or ``'ndjson'``.
+                            If None, it is guessed from the file name.
+    :param dict columns: Where each field is in the dump. See **DUMP_COLUMNS**.
+    :returns: Tuples of the path relative to the unmerged area, whether it is a directory,
+              the modification time, and the size
+    :rtype: generator
+    """
+
+    dump_format = dump_format or guess_format(file_name)
+    columns = columns or {'path': 'path', 'type': 'type', 'size': 'size', 'mtime': 'mtime'}
+    prefixes = [location.rstrip('/') + '/', lfn.rstrip('/') + '/']
+
+    with open_text(file_name) as stream:
+        for path, entry_type, size, mtime in read_rows(stream, dump_format, columns):
+            for prefix in prefixes:
+                if path.startswith(prefix):
+                    is_dir = entry_type is not None and str(entry_type).lower() in DIR_TYPES
+                    yield (path[len(prefix):].rstrip('/'), is_dir,
+                           parse_mtime(mtime), 0 if is_dir else int(size or 0))
+                    break
@@ -0,0 +1,318 @@
+"""
+This module estimates how much the :ref:`unmerged-ref` can delete without listing everything,
+for ``ListDeletable.py --estimate``.
+
+Starting from the unmerged location, each directory that is visited is listed,
+and a random sample of its subdirectories is visited in turn.
+Every directory has at least the chance **ESTIMATE_FRACTION** to be visited,
+so about that fraction of the directories is listed.
+The depth of the tree is found first by following one random path to the bottom,
+and the sampling is spread evenly over the levels, so that a few large subtrees
+near the top do not stand for everything.
+Each directory keeps at least **ESTIMATE_MIN_SAMPLE** of its subdirectories,
+which leaves less to sample at the levels below.
+Everything found in a sampled directory stands for the subdirectories that were not sampled
+next to it, so totals are extrapolated with the Horvitz-Thompson estimator,
+weighting each directory by the inverse of its chance to be visited.
+
+The variance of each total is estimated the usual way for sampling in several stages:
+the spread between the sampled subdirectories of a directory,
+corrected for the fraction that was sampled, plus the variances estimated inside of them.
+The confidence intervals are the normal intervals from these variances.
+
+The same rules as a full scan decide what can be deleted.
+Protected directories are not visited, directories above protected ones are kept,
+and a directory can only be deleted if nothing in it is newer than **MIN_AGE**.
+Protection is known exactly from the protected list,
+but the age of a directory can only be checked against its sampled subdirectories,
+so a directory above a single new subdirectory that was not sampled is counted as deletable.
+This only changes the bytes and files directly inside such a directory, which are usually none
+in the unmerged area, and the directory itself in the number of directories.
+"""
+
+import math
+import random
+
+
+FIELDS = ['bytes', 'files', 'directories', 'total_bytes', 'total_files', 'total_directories']
+"""The totals that are estimated. The first three are what can be deleted."""
+
+Z_95 = 1.959964
+"""The number of standard deviations in a 95% confidence interval."""
+
+
+def sample_size(num, fraction, minimum):
+    """
+    :param int num: The number of subdirectories
+    :param float fraction: The fraction to sample
+    :param int minimum: The least number to sample
+    :returns: The number of subdirectories to sample
+    :rtype: int
+    """
+    return min(num, max(minimum, int(math.ceil(fraction * num))))
+
+
+class Estimate(object):
+    """
+    The estimated totals of a tree, with the variance of each estimate.
+    """
+
+    def __init__(self, values, variances, listed):
+        """
+        :param list values: The estimate of each of the :py:data:`FIELDS`
+        :param list variances: The variance of each estimate
+        :param int listed: The number of directories that were listed
+        """
+        self.values = dict(zip(FIELDS, values))
+        self.variances = dict(zip(FIELDS, variances))
+        self.listed = listed
+
+    def error(self, field, z_value=Z_95):
+        """
+        :param str field: One of the :py:data:`FIELDS`
+        :param float z_value: The number of standard deviations in the interval
+        :returns: The half width of the confidence interval
+        :rtype: float
+        """
+        return z_value * math.sqrt(max(self.variances[field], 0.0))
+
+    def interval(self, field, z_value=Z_95):
+        """
+        :param str field: One of the :py:data:`FIELDS`
+        :param float z_value: The number of standard deviations in the interval
+        :returns: The low and high ends of the confidence interval, which are never below zero
+        :rtype: tuple
+        """
+        value = self.values[field]
+        error = self.error(field, z_value)
+        return max(0.0, value - error), value + error
+
+    def summary(self):
+        """
+        :returns: The lines of a table of the estimates and their 95% confidence intervals,
+                  with bytes in TB
+        :rtype: list
+        """
+        total_dirs = self.values['total_directories']
+        percent = 100.0 * self.listed / total_dirs if total_dirs else 100.0
+        lines = ['Listed %i of about %i directories (%.1f%%)' % (self.listed, total_dirs, percent),
+                 '%-24s %14s %14s %14s' % ('', 'Estimate', '95% low', '95% high')]
+        for label, field, unit in [('Deletable [TB]', 'bytes', 1024 ** 4),
+                                   ('Deletable files', 'files', 1),
+                                   ('Deletable directories', 'directories', 1),
+                                   ('Unprotected [TB]', 'total_bytes', 1024 ** 4),
+                                   ('Unprotected files', 'total_files', 1),
+                                   ('Unprotected directories', 'total_directories', 1)]:
+            low, high = self.interval(field)
+            lines.append('%-24s %14.2f %14.2f %14.2f' %
+                         (label, self.values[field] / unit, low / unit, high / unit))
+        return lines
+
+
+class _Visit(object):    # pylint: disable=too-few-public-methods
+    """
+    One directory in the sampled walk.
+    This is a record that is filled in as the walk goes, so it cannot be a namedtuple.
+    """
+
+    def __init__(self, path, parent, upper, probability):
+        self.path = path
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        # The chance this directory was visited
+        self.probability = probability
+        # If this is above a protected directory
+        self.upper = upper
+        self.num_subdirs = 0
+        self.local = None
+        self.old = True
+        # The estimate, variance, and deletability of each sampled subdirectory
+        self.results = []
+
+
+def combine(visit):
+    """
+    Extrapolates the sampled subdirectories of a directory to all of them.
+
+    :param _Visit visit: A directory whose sampled subdirectories are all combined
+    :returns: The estimate and variance of each of the :py:data:`FIELDS` in the directory,
+              and whether it can be deleted
+    :rtype: tuple
+    """
+
+    num = visit.num_subdirs
+    count = len(visit.results)
+    values = [0.0] * len(FIELDS)
+    variances = [0.0] * len(FIELDS)
+
+    if count:
+        scale = float(num) / count
+        for field in range(len(FIELDS)):
+            sampled = [result[0][field] for result in visit.results]
+            mean = sum(sampled) / count
+            values[field] = num * mean
+            variances[field] = scale * sum(result[1][field] for result in visit.results)
+            if 1 < count < num:
+                spread = sum((value - mean) ** 2 for value in sampled) / (count - 1)
+                variances[field] += num ** 2 * (1.0 - 1.0 / scale) * spread / count
+
+    vanish = visit.local is not None and not visit.upper and visit.old and \
+        all(result[2] for result in visit.results)
+
+    if visit.local is not None:
+        size, nfiles = visit.local
+        values[3] += size
+        values[4] += nfiles
+        values[5] += 1
+        if vanish:
+            values[0] += size
+            values[1] += nfiles
+            values[2] += 1
+
+    return values, variances, vanish
+
+
+class TreeEstimator(object):
+    """
+    Does the sampled walk of :py:func:`estimate_tree`.
+    """
+
+    def __init__(self, list_dir, protection, fraction, minimum, rand):
+        """
+        :param function list_dir: Takes the path of a directory and returns the names of its
+                                  subdirectories and a list of ``(name, mtime, size)``
+                                  for its files
+        :param function protection: Takes the path of a directory and returns None
+                                    if it is protected, True if it is above a protected
+                                    directory, and False otherwise
+        :param float fraction: The least chance of each directory to be visited
+        :param int minimum: The least number of subdirectories of each directory to sample
+        :param random.Random rand: The random numbers to sample with
+        """
+        self.list_dir = list_dir
+        self.protection = protection
+        self.fraction = fraction
+        self.minimum = minimum
+        self.rand = rand
+        self.listed = 0
+        self.depth = 0
+        # Listings made while probing, kept for when the walk gets to them
+        self.probed = {}
+
+    def listing(self, path):
+        """
+        :param str path: A directory
+        :returns: The listing of the directory, which is only listed if it was not probed
+        :rtype: tuple
+        """
+        if path in self.probed:
+            return self.probed.pop(path)
+
+        self.listed += 1
+        return self.list_dir(path)
+
+    def probe(self, top_dirs):
+        """
+        Follows one random path to the bottom, to learn how deep the tree is.
+
+        :param list top_dirs: The top level directories
+        """
+        path = ''
+        names = sorted(top_dirs)
+        while names:
+            path = '/'.join((path, self.rand.choice(names))) if path else self.rand.choice(names)
+            self.depth += 1
+            self.probed[path] = self.list_dir(path)
+            self.listed += 1
+            names = sorted(self.probed[path][0])
+
+    def sample(self, visit, names):
+        """
+        :param _Visit visit: A directory that was listed
+        :param list names: Its subdirectories
+        :returns: A random sample of the subdirectories to visit next.
+                  Protected ones are counted as results right away.
+        :rtype: list
+        """
+        names = sorted(names)
+        visit.num_subdirs = len(names)
+        # Spread the sampling over the levels left, so no one level has all of it
+        levels = max(1, self.depth - visit.depth)
+        rate = min(1.0, (self.fraction / visit.probability) ** (1.0 / levels))
+        chosen = self.rand.sample(names, sample_size(len(names), rate, self.minimum))
+        probability = visit.probability * len(chosen) / max(len(names), 1)
+        output = []
+        for name in chosen:
+            path = '/'.join((visit.path, name)) if visit.path else name
+            upper = self.protection(path)
+            if upper is None:
+                # Protected directories are not listed, and count for nothing
+                visit.results.append(([0.0] * len(FIELDS), [0.0] * len(FIELDS), False))
+            else:
+                output.append(_Visit(path, visit, upper, probability))
+        return output
+
+    def walk(self, top_dirs, is_old):
+        """
+        :param list top_dirs: The directories to estimate
+        :param function is_old: Takes a visited directory and its listing,
+                                and returns if nothing in it is too new to delete
+        :returns: The estimate and variance of each of the :py:data:`FIELDS`
+        :rtype: tuple
+        """
+
+        root = _Visit('', None, True, 1.0)
+        # Each directory is on the stack twice: once to list it,
+        # and once to combine its sampled subdirectories after they are all done
+        pending = [(visit, False) for visit in self.sample(root, top_dirs)]
+        while pending:
+            visit, listed_already = pending.pop()
+            if listed_already:
+                visit.parent.results.append(combine(visit))
+                visit.results = None
+                continue
+
+            subdirs, files = self.listing(visit.path)
+            visit.local = (sum(size for _, _, size in files), len(files))
+            visit.old = is_old(visit.path, subdirs, files)
+
+            pending.append((visit, True))
+            pending.extend((child, False) for child in self.sample(visit, subdirs))
+
+        return combine(root)[:2]
+
+
+def estimate_tree(top_dirs, list_dir, get_mtime, protection, cutoff, fraction, minimum,
+                  rand=None):
+    """
+    Estimates what can be deleted in some top level directories, without recursion.
+
+    :param list top_dirs: The directories to estimate. These are sampled like any others.
+    :param function list_dir: Takes the path of a directory and returns the names of its
+                              subdirectories and a list of ``(name, mtime, size)`` for its files
+    :param function get_mtime: Takes the path of an empty directory and returns
+                               its modification time
+    :param function protection: Takes the path of a directory and returns None
+                                if it is protected, True if it is above a protected directory,
+                                and False otherwise
+    :param float cutoff: Everything inside a deletable directory is at least this old
+    :param float fraction: The least chance of each directory to be visited
+    :param int minimum: The least number of subdirectories of each directory to sample.
+                        Variances can only be estimated if this is at least two.
+    :param random.Random rand: The random numbers to sample with
+    :returns: The estimates
+    :rtype: Estimate
+    """
+
+    def is_old(path, subdirs, files):
+        """Checks the files of a directory, or its own time if it is empty"""
+        if files:
+            return max(mtime for _, mtime, _ in files) <= cutoff
+        if not subdirs:
+            return get_mtime(path) <= cutoff
+        return True
+
+    estimator = TreeEstimator(list_dir, protection, fraction, minimum, rand or random.Random())
+    estimator.probe(top_dirs)
+    values, variances = estimator.walk(top_dirs, is_old)
+    return Estimate(values, variances, estimator.listed)
@@ -0,0 +1,91 @@
+"""
+This module sorts path lists that may not fit in memory,
+for the files mode of the :ref:`unmerged-ref`.
+Paths are sorted in chunks. If there is more than one chunk, each sorted chunk
+is written to a temporary file and the files are merged back together as they are read,
+so only one chunk is ever held in memory.
+"""
+
+import os
+import shutil
+import heapq
+import tempfile
+
+
+_fsencode = getattr(os, 'fsencode', lambda path: path)
+_fsdecode = getattr(os, 'fsdecode', lambda path: path)
+
+
+def _write_chunk(chunk, tmp_dir):
+    """
+    Sorts a chunk and writes it to a new temporary file.
+
+    :param list chunk: The paths in the chunk
+    :param str tmp_dir: The directory to write the file in
+    :returns: The name of the file
+    :rtype: str
+    """
+    chunk.sort()
+    handle, name = tempfile.mkstemp(dir=tmp_dir)
+    with os.fdopen(handle, 'wb') as chunk_file:
+        for path in chunk:
+            chunk_file.write(_fsencode(path) + b'\n')
+
+    return name
+
+
+def _read_chunk(name):
+    """
+    :param str name: The name of a file written by :py:func:`_write_chunk`
+    :returns: The paths in the file, in order
+    :rtype: generator
+    """
+    with open(name, 'rb') as chunk_file:
+        for line in chunk_file:
+            yield _fsdecode(line[:-1])
+
+
+def sorted_paths(paths, chunk_size, tmp_dir=None):
+    """
+    Sorts paths in the same order as :py:func:`sorted`.
+    Paths cannot contain newlines.
+
+    :param paths: The paths to sort
+    :type paths: iterable
+    :param int chunk_size: The number of paths sorted in memory at once
+    :param str tmp_dir: Where to make the directory for the sorted chunks.
+                        If None, the default temporary directory is used.
+    :returns: The sorted paths
+    :rtype: generator
+    """
+
+    chunk = []
+    chunk_dir = None
+
+    try:
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) >= chunk_size:
+                if chunk_dir is None:
+                    chunk_dir = tempfile.mkdtemp(prefix='sort_', dir=tmp_dir)
+                _write_chunk(chunk, chunk_dir)
+                chunk = []
+
+        if chunk_dir is None:
+            # Everything fit in one chunk
+            chunk.sort()
+            for path in chunk:
+                yield path
+            return
+
+        if chunk:
+            _write_chunk(chunk, chunk_dir)
+            chunk = []
+
+        for path in heapq.merge(*[_read_chunk(os.path.join(chunk_dir, name))
+                                  for name in os.listdir(chunk_dir)]):
+            yield path
+
+    finally:
+        if chunk_dir is not None:
+            shutil.rmtree(chunk_dir)
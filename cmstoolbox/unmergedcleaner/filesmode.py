@@ -0,0 +1,314 @@
+"""
+This module lists the files that the :ref:`unmerged-ref` can delete
+when **WHICH_LIST** is ``'files'``, and writes them to the deletion file.
+
+A file can be deleted if it is old enough and not protected.
+Old files come from a walk of the unmerged location by :py:class:`FileLister`,
+from a listing of every file given by the storage backend,
+or from the records of a namespace dump.
+Files with a newline in their name are skipped,
+since they cannot be written to the deletion file.
+The deletion file is sorted by :py:mod:`cmstoolbox.unmergedcleaner.externalsort`,
+so the number of files does not change the memory used.
+"""
+
+import os
+import sys
+import logging
+import threading
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from . import pathtrie
+from . import externalsort
+
+
+LOG = logging.getLogger(__name__)
+
+
+def is_writable(path):
+    """
+    :param str path: The path of a file
+    :returns: False, with a warning, if the path cannot be written on one line
+    :rtype: bool
+    """
+    if '\n' in path:
+        LOG.warning('Skipping file with a newline in its name: %r', path)
+        return False
+    return True
+
+
+def listed_old_files(listed, cutoff):
+    """
+    :param listed: ``(pfn, mtime, size)`` for each file,
+                   from :py:meth:`backends.StorageBackend.list_files`
+    :type listed: iterable
+    :param float cutoff: Files modified after this time are not given
+    :returns: The PFNs of the files old enough to delete
+    :rtype: generator
+    """
+    for pfn, mtime, _ in listed:
+        if mtime <= cutoff and is_writable(pfn):
+            yield pfn
+
+
+def records_old_files(records, location, cutoff):
+    """
+    :param records: Tuples of the path relative to the unmerged location,
+                    whether it is a directory, the modification time, and the size
+    :type records: iterable
+    :param str location: The PFN of the unmerged location
+    :param float cutoff: Files modified after this time are not given
+    :returns: The PFNs of the files old enough to delete
+    :rtype: generator
+    """
+    for path, is_dir, mtime, _ in records:
+        if not is_dir and mtime <= cutoff:
+            path = os.path.join(location, path)
+            if is_writable(path):
+                yield path
+
+
+class FileLister(object):
+    """
+    Walks the unmerged location for the files that are old enough to delete.
+    Each top level directory is walked by one of a pool of worker threads,
+    and files are given back as soon as their directory is listed.
+    Directories that are protected or avoided are not walked.
+    """
+
+    def __init__(self, location, lfn, scan, protected, cutoff, metrics):
+        """
+        :param str location: The PFN of the unmerged location
+        :param str lfn: The LFN of the unmerged location
+        :param function scan: Lists a directory like :py:meth:`backends.StorageBackend.list_dir`
+        :param pathtrie.PathTrie protected: The index of protected and avoided LFNs
+        :param float cutoff: Files modified after this time are not given
+        :param metrics.Metrics metrics: Counts the directories and files listed
+        """
+        self.location = location
+        self.lfn = lfn
+        self.scan = scan
+        self.protected = protected
+        self.cutoff = cutoff
+        self.metrics = metrics
+
+    def old_files(self, full_path_name, files):
+        """
+        :param str full_path_name: The PFN of a directory
+        :param list files: ``(name, mtime, size)`` of the files in the directory
+        :returns: The PFNs of the old files
+        :rtype: list
+        """
+        output = []
+        for name, mtime, _ in files:
+            path = os.path.join(full_path_name, name)
+            if mtime <= self.cutoff and is_writable(path):
+                output.append(path)
+
+        return output
+
+    def walk_top(self, num, top_dirs):
+        """
+        :param int num: The index of the top level directory to walk
+        :param list top_dirs: All of the top level directories, for the progress
+        :returns: The old files of each directory inside of it that has any
+        :rtype: generator
+        """
+        self.metrics.set_progress(float(num) / len(top_dirs), top_dirs[num])
+        pending = [top_dirs[num]]
+        while pending:
+            path_name = pending.pop()
+            if self.protected.lookup(os.path.join(self.lfn, path_name)) in \
+                    (pathtrie.PROTECTED, pathtrie.INSIDE):
+                continue
+
+            full_path_name = os.path.join(self.location, path_name)
+            dirs, files = self.scan(full_path_name)
+            self.metrics.add(1, len(files), sum(size for _, _, size in files))
+            pending.extend(os.path.join(path_name, subdir) for subdir in dirs)
+
+            output = self.old_files(full_path_name, files)
+            if output:
+                yield output
+
+    def files(self, threads=1):
+        """
+        :param int threads: The number of threads listing directories
+        :returns: The PFNs of the old files
+        :rtype: generator
+        :raises Exception: The first exception raised while listing
+        """
+
+        top_dirs, top_files = self.scan(self.location)
+        for unmerged_file in self.old_files(self.location, top_files):
+            yield unmerged_file
+
+        if threads <= 1:
+            outputs = (output for num in range(len(top_dirs))
+                       for output in self.walk_top(num, top_dirs))
+        else:
+            outputs = self._threaded(top_dirs, threads)
+
+        for output in outputs:
+            for unmerged_file in output:
+                yield unmerged_file
+
+    def _threaded(self, top_dirs, threads):
+        """
+        Walks top level directories with a pool of threads.
+        If the reader stops early, the workers are stopped.
+
+        :param list top_dirs: The top level directories
+        :param int threads: The number of threads
+        :returns: The lists of old files from each directory
+        :rtype: generator
+        :raises Exception: The first exception raised while listing
+        """
+
+        tasks = Queue()
+        for num in range(len(top_dirs)):
+            tasks.put(num)
+
+        # Bounded, so that the workers cannot get far ahead of the reader
+        results = Queue(threads * 16)
+        stop = threading.Event()
+
+        workers = [threading.Thread(target=self._worker, args=(top_dirs, tasks, results, stop))
+                   for _ in range(threads)]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        running = [len(workers)]
+        try:
+            for output in _read_results(results, running):
+                yield output
+
+        finally:
+            _stop_workers(results, running, stop)
+
+    def _worker(self, top_dirs, tasks, results, stop):
+        """
+        Walks top level directories from the queue until it is empty or the walk is stopped.
+        An exception is put in the results and stops the other workers.
+        None is put in the results when the worker finishes.
+
+        :param list top_dirs: The top level directories
+        :param Queue tasks: The indices of the top level directories left to walk
+        :param Queue results: Gets the lists of old files from each directory
+        :param threading.Event stop: Set when the walk is stopped
+        """
+
+        try:
+            while not stop.is_set():
+                try:
+                    num = tasks.get_nowait()
+                except Empty:
+                    break
+                for output in self.walk_top(num, top_dirs):
+                    results.put(output)
+                    if stop.is_set():
+                        break
+        except Exception:     # pylint: disable=broad-except
+            stop.set()
+            results.put(sys.exc_info()[1])
+        finally:
+            results.put(None)
+
+
+def _stop_workers(results, running, stop):
+    """
+    Stops the workers, and lets them finish if the reader stopped early.
+
+    :param Queue results: The outputs of the workers
+    :param list running: Holds the number of workers still running, which is updated
+    :param threading.Event stop: Set to stop the workers
+    """
+    stop.set()
+    while running[0]:
+        if results.get() is None:
+            running[0] -= 1
+
+
+def _read_results(results, running):
+    """
+    :param Queue results: The outputs of the workers.
+                          Each worker puts None when it finishes.
+    :param list running: Holds the number of workers still running, which is updated
+    :returns: The outputs, until every worker is finished
+    :rtype: generator
+    :raises Exception: An exception put by a worker
+    """
+    while running[0]:
+        output = results.get()
+        if output is None:
+            running[0] -= 1
+        elif isinstance(output, Exception):
+            raise output
+        else:
+            yield output
+
+
+def in_location(paths, location, kind='File'):
+    """
+    :param paths: The PFNs to check
+    :type paths: iterable
+    :param str location: The PFN of the unmerged location
+    :param str kind: What the paths are, for the error message
+    :returns: The PFNs, each checked as it is read
+    :rtype: generator
+    :raises ValueError: If a PFN is not in the unmerged location
+    """
+    for path in paths:
+        if not path.startswith(location):
+            raise ValueError('\n%s %s\nis not in your configured unmerged location:\n%s' %
+                             (kind, path, location))
+        yield path
+
+
+def write_deletions(unmerged_files, is_protected, deletion_file, chunk_size):
+    """
+    Sorts files and writes the ones that are not protected to the deletion file.
+    The list is written to a temporary file that replaces the deletion file at the end,
+    so the deletion file is never partially written.
+
+    :param unmerged_files: The PFNs of the files
+    :type unmerged_files: iterable
+    :param function is_protected: Takes a PFN and returns True if the file is protected
+    :param str deletion_file: The deletion file to write
+    :param int chunk_size: The number of files sorted in memory at once
+    :returns: The number of files written and the number of files protected
+    :rtype: tuple
+    """
+
+    n_delete = 0
+    n_protect = 0
+    tmp_name = '%s.tmp' % deletion_file
+
+    try:
+        with open(tmp_name, 'w') as deletions:
+            # Keep the deletion list sorted
+            for unmerged_file in externalsort.sorted_paths(
+                    unmerged_files, chunk_size, os.path.dirname(deletion_file) or None):
+
+                if is_protected(unmerged_file):
+                    n_protect += 1
+                else:
+                    deletions.write(('\n' if n_delete else '') + unmerged_file)
+                    n_delete += 1
+
+    except Exception:
+        os.remove(tmp_name)
+        raise
+
+    os.rename(tmp_name, deletion_file)
+
+    LOG.info('Got %i deletion candidates', n_delete + n_protect)
+    LOG.info('Number to delete: %i', n_delete)
+    LOG.info('Number protected/avoided: %i', n_protect)
+
+    return n_delete, n_protect
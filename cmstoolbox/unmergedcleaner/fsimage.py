@@ -0,0 +1,245 @@
+"""
+This module reads the unmerged area from an HDFS fsimage,
+for the :ref:`unmerged-ref` at Hadoop sites.
+The fsimage must first be fetched and converted to text by the site admin, for example with::
+
+    hdfs dfsadmin -fetchImage /tmp/fsimage
+    hdfs oiv -p Delimited -i /tmp/fsimage/fsimage_<txid> -o /tmp/fsimage.txt
+
+Both the ``Delimited`` and ``XML`` outputs of ``hdfs oiv`` can be read, optionally gzipped.
+The NameNode is never contacted, so a scan from an fsimage puts no load on it.
+
+Both formats are read as a stream. For ``Delimited``, only the entries inside the unmerged area
+are kept, so memory does not depend on the size of the rest of the namespace.
+The ``XML`` format only gives the parent of each inode in a later section,
+so its inodes are first copied into a temporary SQLite file and the unmerged area is then
+read back from it, one directory at a time.
+The trees are built by :py:class:`namespacetree.TreeBuilder`, which sums the files
+into their directories as they are read, so the files themselves are never held in memory.
+"""
+
+import os
+import sys
+import gzip
+import time
+import sqlite3
+import collections
+import tempfile
+import datetime
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+
+DELIMITED_COLUMNS = ['Path', 'Replication', 'ModificationTime', 'AccessTime',
+                     'PreferredBlockSize', 'BlocksCount', 'FileSize', 'NSQUOTA',
+                     'DSQUOTA', 'Permission', 'UserName', 'GroupName']
+"""The columns written by ``hdfs oiv -p Delimited``, used if the file has no header."""
+
+
+def open_text(file_name):
+    """
+    :param str file_name: The name of a text file, which is decompressed if it ends with ``.gz``
+    :returns: The opened file
+    :rtype: file
+    """
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rt' if sys.version_info[0] > 2 else 'rb')
+
+    return open(file_name, 'r')
+
+
+def parse_time(value):
+    """
+    :param str value: A modification time from ``hdfs oiv``, either in milliseconds
+                      or formatted as ``yyyy-MM-dd HH:mm`` in local time
+    :returns: The time, in seconds since the epoch
+    :rtype: float
+    """
+    if value.isdigit():
+        return int(value) / 1000.0
+
+    return time.mktime(datetime.datetime.strptime(value, '%Y-%m-%d %H:%M').timetuple())
+
+
+def read_delimited(lines, root, delimiter='\t'):
+    """
+    Reads the output of ``hdfs oiv -p Delimited``.
+
+    :param lines: The lines of the file
+    :type lines: iterable
+    :param str root: The HDFS path of the directory to read
+    :param str delimiter: The delimiter given to ``hdfs oiv``
+    :returns: Tuples of the path relative to *root*, whether it is a directory,
+              the modification time, and the size, for everything inside *root*
+    :rtype: generator
+    """
+
+    prefix = root.rstrip('/') + '/'
+    columns = None
+    num_columns = len(DELIMITED_COLUMNS)
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+
+        fields = line.split(delimiter)
+
+        if columns is None:
+            header = fields if fields[0] == 'Path' else DELIMITED_COLUMNS
+            columns = [header.index(name) for name in
+                       ('Path', 'ModificationTime', 'FileSize', 'Permission')]
+            num_columns = len(header)
+            if header is fields:
+                continue
+
+        # Paths can contain the delimiter, so count the other columns from the end
+        extra = len(fields) - num_columns
+        path = delimiter.join(fields[columns[0]:columns[0] + extra + 1])
+        if not path.startswith(prefix):
+            continue
+
+        mtime, size, permission = [fields[col + extra] for col in columns[1:]]
+        yield (path[len(prefix):], permission.startswith('d'), parse_time(mtime), int(size))
+
+
+def _load_inodes(stream, conn):
+    """
+    Copies the inodes and their parents from ``hdfs oiv -p XML`` into an SQLite database.
+    Elements are dropped as soon as they are read.
+
+    :param file stream: The opened XML file
+    :param sqlite3.Connection conn: The database, with empty ``inodes`` and ``parents`` tables
+    """
+
+    section = None
+    for event, elem in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag in ('INodeSection', 'INodeDirectorySection'):
+                section = elem
+
+        elif elem.tag in ('INodeSection', 'INodeDirectorySection'):
+            section = None
+            elem.clear()
+
+        elif section is None:
+            continue
+
+        elif elem.tag == 'inode' and section.tag == 'INodeSection':
+            conn.execute('INSERT INTO inodes VALUES (?, ?, ?, ?, ?)',
+                         (int(elem.findtext('id')), elem.findtext('type') == 'DIRECTORY',
+                          elem.findtext('name') or '',
+                          int(elem.findtext('mtime') or 0) / 1000.0,
+                          sum(int(num_bytes.text) for num_bytes in elem.iter('numBytes'))))
+            # Everything read so far can be dropped
+            section.clear()
+
+        elif elem.tag == 'directory':
+            parent = int(elem.findtext('parent'))
+            conn.executemany('INSERT OR REPLACE INTO parents VALUES (?, ?)',
+                             [(int(child.text), parent) for child in elem.findall('child')])
+            section.clear()
+
+
+def _find_inode(conn, root):
+    """
+    :param sqlite3.Connection conn: The database filled by :py:func:`_load_inodes`
+    :param str root: An HDFS path
+    :returns: The id of the inode at *root*, or None if it is not in the fsimage
+    :rtype: int
+    """
+
+    # The root inode is the directory without a parent
+    top = conn.execute('SELECT id FROM inodes WHERE dir AND id NOT IN '
+                       '(SELECT child FROM parents) ORDER BY id LIMIT 1').fetchone()
+
+    for name in [part for part in root.split('/') if part]:
+        if top is None:
+            break
+        top = conn.execute('SELECT inodes.id FROM parents JOIN inodes ON inodes.id = child '
+                           'WHERE parent = ? AND name = ?', (top[0], name)).fetchone()
+
+    return None if top is None else top[0]
+
+
+def read_xml(stream, root, tmp_dir=None):
+    """
+    Reads the output of ``hdfs oiv -p XML``.
+
+    :param file stream: The opened XML file
+    :param str root: The HDFS path of the directory to read
+    :param str tmp_dir: Where to make the temporary SQLite file.
+                        If None, the default temporary directory is used.
+    :returns: Tuples of the path relative to *root*, whether it is a directory,
+              the modification time, and the size, for everything inside *root*
+    :rtype: generator
+    """
+
+    handle, db_name = tempfile.mkstemp(suffix='.db', dir=tmp_dir)
+    os.close(handle)
+    conn = sqlite3.connect(db_name)
+
+    try:
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('CREATE TABLE inodes (id INTEGER PRIMARY KEY, dir INTEGER, '
+                     'name TEXT, mtime REAL, size INTEGER)')
+        conn.execute('CREATE TABLE parents (child INTEGER PRIMARY KEY, parent INTEGER)')
+
+        _load_inodes(stream, conn)
+        conn.execute('CREATE INDEX parent_index ON parents (parent)')
+
+        top = _find_inode(conn, root)
+        if top is None:
+            return
+
+        # Walk down by parent, since SQLite before 3.8.3 has no recursive queries
+        paths = {top: ''}
+        pending = collections.deque([top])
+        while pending:
+            parent = pending.popleft()
+            parent_path = paths.pop(parent)
+            rows = conn.execute('SELECT inodes.id, dir, name, mtime, size FROM parents '
+                                'JOIN inodes ON inodes.id = child WHERE parent = ?',
+                                (parent,)).fetchall()
+
+            for inode, is_dir, name, mtime, size in rows:
+                path = os.path.join(parent_path, name)
+                if is_dir:
+                    paths[inode] = path
+                    pending.append(inode)
+                yield path, bool(is_dir), mtime, size
+
+    finally:
+        conn.close()
+        os.remove(db_name)
+
+
+def read_fsimage(file_name, root, tmp_dir=None):
+    """
+    Reads a text fsimage, guessing the format from the first character.
+
+    :param str file_name: The output of ``hdfs oiv``
+    :param str root: The HDFS path of the directory to read
+    :param str tmp_dir: Where to make temporary files
+    :returns: Tuples of the path relative to *root*, whether it is a directory,
+              the modification time, and the size, for everything inside *root*
+    :rtype: generator
+    """
+
+    with open_text(file_name) as stream:
+        is_xml = stream.read(1) == '<'
+
+    if is_xml:
+        opener = gzip.open if file_name.endswith('.gz') else open
+        with opener(file_name, 'rb') as stream:
+            for record in read_xml(stream, root, tmp_dir):
+                yield record
+
+    else:
+        with open_text(file_name) as stream:
+            for record in read_delimited(stream, root):
+                yield record
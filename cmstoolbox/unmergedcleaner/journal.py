@@ -0,0 +1,231 @@
+"""
+This module keeps a journal of the deletions done by the :ref:`unmerged-ref`,
+so that a deletion that stops part of the way through continues where it left off.
+
+The journal is written next to the **DELETION_FILE**, one JSON line at a time.
+It starts with the size and modification time of the deletion file it belongs to.
+Each finished entry of the deletion file then gets a line with its line number,
+path, outcome (``'deleted'``, ``'missing'``, or ``'failed'``), and the bytes removed, if known.
+At the end of each run, a line with the summary of the whole deletion is added.
+
+When ``--delete`` is run again on the same deletion file,
+entries that were deleted or missing are skipped without touching the storage.
+Failed entries are tried again.
+A new deletion file starts a new journal.
+
+Since several deletions are in flight at once, entries can finish out of order.
+Only the line numbers finished after the first unfinished entry are held in memory,
+so the journal of a long deletion file can be read back without holding all of it.
+"""
+
+import os
+import json
+import time
+import threading
+import logging
+
+from .backends import DELETED, MISSING, FAILED
+
+
+LOG = logging.getLogger(__name__)
+
+
+def load_lines(file_name, use_header, add):
+    """
+    Reads back a file written one JSON line at a time, like a journal or a checkpoint.
+    A line that was only partly written is removed from the file.
+
+    :param str file_name: The file to read
+    :param function use_header: Takes the JSON object of the first line,
+                                and returns False if the rest of the file cannot be used
+    :param function add: Called with the JSON object of each complete line after the first
+    :returns: True if the header could be used, and the lines were read
+    :rtype: bool
+    """
+
+    good_length = 0
+    with open(file_name, 'rb') as old_file:
+        try:
+            first = next(old_file)
+            header = json.loads(first.decode('utf-8'))
+        except (StopIteration, ValueError):
+            return False
+
+        if not use_header(header):
+            return False
+
+        good_length = len(first)
+        for line in old_file:
+            try:
+                content = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+
+            good_length += len(line)
+            add(content)
+
+    # Drop anything after the last complete line before appending
+    with open(file_name, 'r+') as old_file:
+        old_file.truncate(good_length)
+
+    return True
+
+
+def describe(deletion_file):
+    """
+    :param str deletion_file: A deletion file
+    :returns: What identifies this version of the deletion file
+    :rtype: dict
+    """
+    info = os.stat(deletion_file)
+    return {'deletion_file': os.path.abspath(deletion_file),
+            'size': info.st_size, 'mtime': info.st_mtime}
+
+
+class DeletionJournal(object):
+    """
+    The journal of the deletions from one deletion file.
+    """
+
+    def __init__(self, file_name, deletion_file):
+        """
+        Opens the journal. If the old journal is for a different deletion file, it is replaced.
+
+        :param str file_name: The location of the journal
+        :param str deletion_file: The deletion file being worked through
+        """
+
+        header = describe(deletion_file)
+
+        self.file_name = file_name
+        self.start = time.time()
+        self.counts = {DELETED: 0, MISSING: 0, FAILED: 0}
+        self.bytes = 0
+        self.unknown_bytes = 0
+        self.resumed = 0
+
+        # Every line before this one is finished
+        self._first_unfinished = 0
+        # Finished lines after the first unfinished one
+        self._finished = set()
+        self._lock = threading.Lock()
+
+        if os.path.exists(file_name) and self._load(header):
+            self._file = open(file_name, 'a')
+        else:
+            self._file = open(file_name, 'w')
+            self._write(header)
+
+    def _load(self, header):
+        """
+        Reads an old journal, if it is for the same deletion file.
+        A line that was only partly written is removed.
+
+        :returns: True if the old journal can be continued
+        :rtype: bool
+        """
+
+        def add(entry):
+            """Counts a finished entry. Failed entries are counted again when tried again."""
+            if 'line' in entry and entry['outcome'] != FAILED:
+                self._count(entry['outcome'], entry['bytes'])
+                self._mark(entry['line'])
+
+        if not load_lines(self.file_name, lambda old: old == header, add):
+            return False
+
+        self.resumed = self.counts[DELETED] + self.counts[MISSING]
+        if self.resumed:
+            LOG.info('Continuing the deletion from %s, with %i entries done',
+                     self.file_name, self.resumed)
+
+        return True
+
+    def _write(self, content):
+        """Adds a line to the journal"""
+        self._file.write(json.dumps(content) + '\n')
+        self._file.flush()
+
+    def _count(self, outcome, size):
+        """Adds a finished entry to the totals"""
+        self.counts[outcome] += 1
+        if outcome == DELETED:
+            if size is None:
+                self.unknown_bytes += 1
+            else:
+                self.bytes += size
+
+    def _mark(self, line):
+        """Marks a line number as finished"""
+        if line == self._first_unfinished:
+            self._first_unfinished += 1
+            while self._first_unfinished in self._finished:
+                self._finished.remove(self._first_unfinished)
+                self._first_unfinished += 1
+        elif line > self._first_unfinished:
+            self._finished.add(line)
+
+    def is_done(self, line):
+        """
+        :param int line: The line number of an entry in the deletion file, starting from 0
+        :returns: True if the entry was already deleted or found missing
+        :rtype: bool
+        """
+        return line < self._first_unfinished or line in self._finished
+
+    def record(self, line, path, outcome, size=None):
+        """
+        Adds a finished entry to the journal. This can be called from several threads.
+
+        :param int line: The line number of the entry in the deletion file
+        :param str path: The entry
+        :param str outcome: :py:data:`backends.DELETED`, :py:data:`backends.MISSING`,
+                            or :py:data:`backends.FAILED`
+        :param int size: The bytes removed, or None if not known
+        """
+
+        with self._lock:
+            self._write({'line': line, 'path': path, 'outcome': outcome, 'bytes': size})
+            self._count(outcome, size)
+            if outcome != FAILED:
+                self._mark(line)
+
+    def summary(self):
+        """
+        :returns: The totals of the whole deletion file, including earlier runs.
+                  Failed entries are only the ones that failed in this run.
+        :rtype: dict
+        """
+        with self._lock:
+            output = dict(self.counts)
+            output.update({'bytes': self.bytes,
+                           'unknown_bytes': self.unknown_bytes,
+                           'resumed': self.resumed,
+                           'seconds': time.time() - self.start})
+        return output
+
+    def finish(self, interrupted=False):
+        """
+        Writes the summary to the journal, logs it, and closes the journal.
+
+        :param bool interrupted: If this run was stopped before the end of the deletion file
+        :returns: The summary
+        :rtype: dict
+        """
+
+        summary = self.summary()
+        summary['interrupted'] = interrupted
+
+        with self._lock:
+            self._write({'summary': summary})
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+        LOG.info('%i deleted, %i already missing, %i failed, %i bytes removed%s',
+                 summary[DELETED], summary[MISSING], summary[FAILED], summary['bytes'],
+                 ' (not counting %i entries of unknown size)' % summary['unknown_bytes']
+                 if summary['unknown_bytes'] else '')
+
+        return summary
@@ -40,20 +40,37 @@ We expect most site admins to have tools to correctly remove those directories.
 However, available tools for removing directories or files in this list are given under
 :ref:`unmerged-delete-ref`.
 
+The directories in the deletion file are grouped by their top level directory,
+and the top level directories are in the order of their names.
+Earlier versions wrote them in the order the storage listed them,
+so a deletion file can come out in a different order than before, with the same lines.
+
+A large unmerged directory can be listed by several nodes that see the same storage.
+Run ``./ListDeletable.py --shard INDEX/COUNT --now SECONDS`` on each of COUNT nodes,
+with INDEX from ``0`` to ``COUNT - 1`` and the same SECONDS everywhere,
+so that each node lists its share of the top level directories.
+When the results of every shard are next to the **DELETION_FILE**,
+``./ListDeletable.py --merge COUNT`` writes the same deletion file and summary
+as a scan of everything on one node.
+
 .. _listdel-optim-ref:
 
 Potential Optimization
 ++++++++++++++++++++++
 
 This script was originally developed on a Hadoop system and unit tested on POSIX.
-There are three different functions that interact with the file system which could potentially
-be broken or unoptimized for other types of file systems.
-These functions are :py:func:`list_folder`, :py:func:`get_file_size`,
-:py:func:`do_delete`, and :py:func:`get_mtime`.
-Anyone who wants to contribute optimized versions of these functions,
-depending on the value of :py:data:`config.STORAGE_TYPE`
-(as it is called from within ``ListDeletable.py``)
-is welcome to make pull requests.
+Everything that touches the storage goes through a backend from
+:py:mod:`cmstoolbox.unmergedcleaner.backends`, picked by **STORAGE_TYPE**.
+The directory walk itself goes through :py:func:`scan_folder`, which lists a directory
+in a single pass and gets the type, modification time, and size of each entry at the same time.
+The functions :py:func:`list_folder`, :py:func:`get_file_size`, and :py:func:`get_mtime`
+are also used, and :py:func:`do_delete` hands the deletions to the backend in batches.
+With **STORAGE_TYPE** set to ``'webhdfs'``, the backend uses the
+:py:mod:`cmstoolbox.unmergedcleaner.webhdfs` client instead of a mounted filesystem,
+and the HDFS path of the unmerged directory is taken to be **LFN_TO_CLEAN**.
+Anyone who wants to contribute an optimized backend for another storage system
+is welcome to make pull requests. A site can also use its own backend class
+without changing this package, by setting **STORAGE_TYPE** to the dotted path of the class.
 
 :authors: Christoph Wissing <christoph.wissing@desy.de> \n
           Max Goncharov <maxi@mit.edu> \n
@@ -62,43 +79,43 @@ is welcome to make pull requests.
 
 from __future__ import print_function
 
-import json
 import os
+import errno
 import sys
 import time
-import datetime
-import subprocess
-import shutil
 import logging
+import contextlib
+import random
 from bisect import bisect_left
-from optparse import OptionParser
 
 from ..webtools import get_json
 
+from . import backends
+from . import checkpoint
 from . import configtools
+from . import daemon
+from . import deleter
+from . import deletionfile
+from . import dumpfile
+from . import estimate
+from . import filesmode
+from . import fsimage
+from . import manifest
+from . import metrics
+from . import namespacetree
+from . import options
+from . import pathtrie
+from . import residentscan
+from . import scancache
+from . import shards
+from . import trace
 
 
 LOG = logging.getLogger(__name__)
 
 
 if __name__ == '__main__':
-    PARSER = OptionParser('Usage: ./%prog [options]\n\n'
-                          '  This script can list and delete directories over the course of\n'
-                          '  multiple runs. The first time is it run, it generates a file,\n'
-                          '  config.py. Edit config.py so that it points to the correct LFN and\n'
-                          '  PFN names, along with targets the proper storage type. The second\n'
-                          '  time it runs, this script creates a list of directories to delete.\n'
-                          '  These directories can then be deleted with this script by passing\n'
-                          '  the --delete flag.\n\n'
-                          ' See http://cms-comp-ops-tools.readthedocs.io/en/latest/'
-                          'siteadmintoolkit.html#module-ListDeletable for more details.')
-
-    PARSER.add_option('--delete', action='store_true', dest='do_delete',
-                      help=('This flag cause the script to operate in deletion mode. '
-                            'The script has to create the deletion file before this mode '
-                            'can be activated so that the site admin can take a look by '
-                            'hand at the deletion list.'))
-
+    PARSER = options.make_parser()
     (OPTS, ARGS) = PARSER.parse_args()
 
     logging.basicConfig(level=logging.INFO,
@@ -109,9 +126,8 @@ config = None
 
 def set_config(path=None, key=None):
     """
-    Sets the configuration up.
+    Sets the configuration up, with :py:func:`configtools.load_config`.
     This can either be from a static JSON file, or a dynamic module.
-    The module must lie in the sys.path and be named config.py.
     This function only does anything the first time it's called.
 
     :param str path: Path to JSON file. If None (default),
@@ -124,30 +140,7 @@ def set_config(path=None, key=None):
     global config
 
     if config is None:
-        if path:
-            from . import _config as config # pylint: disable = import-outside-toplevel
-
-            with open(path, 'r') as infile:
-                fileconfig = json.load(infile)
-            if key:
-                fileconfig = fileconfig[key]
-
-            # Now overwrite the defaults
-            for variable, value in fileconfig.iteritems():
-                setattr(config, variable, value)
-
-        else:
-            try:
-                import config               # pylint: disable = import-outside-toplevel
-
-            except ImportError:
-                print('Generating default configuration...')
-                configtools.generate_default_config()
-
-                print('\nConfiguration created at config.py.')
-                print('Please correct the default values to match your site')
-                print('and run this script again.')
-                sys.exit()
+        config = configtools.load_config(path, key)
 
 
 class SuspiciousConditions(Exception):
@@ -157,97 +150,86 @@ class SuspiciousConditions(Exception):
     pass
 
 
-class DataNode(object):
+class DataNode(namespacetree.TreeNode):
     """
     An object that holds other DataNodes inside of it.
     If a single DataNode is removable, then all nodes under it are removable too.
     Removability is determined by the list of protected directories and the directory age.
+
+    The tree itself is stored in a :py:class:`namespacetree.NamespaceTree`.
+    A DataNode is only a view of one directory in that tree.
     """
 
-    def __init__(self, path_name):
+    def fill(self, threads=None, cache=None):
         """
-        Initializes the DataNode.
-        :param str path_name: is the path to the directory that defines this DataNode
+        Fills this DataNode's tree with all of the subdirectories.
+        Builds the full tree without recursion.
+        The directories are listed first, with sibling subtrees listed concurrently
+        when using more than one thread. The ages and sizes are then summed from the bottom up.
+
+        :param int threads: The number of threads listing directories.
+                            If None, **SCAN_THREADS** from the configuration is used.
+        :param scancache.ScanCache cache: If given, directories that have not been modified
+                                          since the cached scan are not listed again.
+                                          This can also be a
+                                          :py:class:`residentscan.WatchedListings`.
         """
-        self.path_name = path_name
-        self.sub_nodes = []
-        self.can_vanish = None
-        self.latest = 0
-        self.nsubnodes = 0
-        self.nsubfiles = 0
-        self.size = 0
-
-    def fill(self):
-        """
-        Fills this DataNode's sub_node member with all DataNodes made by subdirectories.
-        Recursively builds the full tree.
-        """
-
-        lfn_path_name = os.path.join(config.LFN_TO_CLEAN, self.path_name)
 
-        # If protected, cannot delete this DataNode, and stop filling
-        if bi_search(ALL_LENGTHS, len(lfn_path_name)) and \
-                bi_search(PROTECTED_LIST, lfn_path_name):
-            self.can_vanish = False
+        protected = compile_protected(PROTECTED_LIST) if PROTECTED_TRIE is None else PROTECTED_TRIE
 
-        else:
-            full_path_name = os.path.join(config.UNMERGED_DIR_LOCATION, self.path_name)
-
-            # Here we invoke method that might not work on all storage systems
-            # Check list_folder()
-
-            dirs = list_folder(full_path_name, 'subdirs')
-            all_files = list_folder(full_path_name, 'files')
+        location = config.UNMERGED_DIR_LOCATION
+        filler = namespacetree.TreeFiller(
+            lambda path_name: scan_folder(os.path.join(location, path_name)),
+            lambda path_name: get_mtime(os.path.join(location, path_name)),
+            lambda path_name: protection_flags(protected, path_name), METRICS, cache)
+        tree = filler.fill(self.path_name, config.SCAN_THREADS if threads is None else threads)
 
-            for subdir in dirs:
-                sub_node = DataNode(os.path.join(self.path_name, subdir))
-                sub_node.fill()
-                self.sub_nodes.append(sub_node)
+        tree.aggregate(NOW, config.MIN_AGE)
 
-            # Get the latest modification start for all files
-            for file_name in all_files:
-                modtime = get_mtime(full_path_name + '/' + file_name)
-                self.size = self.size + get_file_size(full_path_name + '/' + file_name)
-                if modtime > self.latest:
-                    self.latest = modtime
+        self.tree = tree
+        self.index = 0
 
-            self.can_vanish = True
 
-            for sub_node in self.sub_nodes:
-                # Add one to include the subnode in the loop
-                self.nsubnodes += sub_node.nsubnodes + 1
-                self.nsubfiles += sub_node.nsubfiles
-                self.size += sub_node.size
-
-                if not sub_node.can_vanish:
-                    self.can_vanish = False
+def protection_flags(protected, path_name):
+    """
+    :param pathtrie.PathTrie protected: the index of protected LFNs
+    :param str path_name: the path of a directory, relative to the unmerged location
+    :returns: the flags of the directory in a :py:class:`namespacetree.NamespaceTree`,
+              or None if the directory is protected or inside a protected directory
+    :rtype: int
+    """
 
-                if sub_node.latest > self.latest:
-                    self.latest = sub_node.latest
+    protection = protected.lookup(os.path.join(config.LFN_TO_CLEAN, path_name))
+    if protection in (pathtrie.PROTECTED, pathtrie.INSIDE):
+        return None
 
-            self.nsubfiles += len(all_files)
+    return namespacetree.UPPER if protection == pathtrie.ANCESTOR else 0
 
-            if self.nsubnodes == 0 and self.nsubfiles == 0:
-                # Check that this time function works for your system as well
-                self.latest = get_mtime(full_path_name)
 
-            if (NOW - self.latest) < config.MIN_AGE or lfn_path_name in PROTECTED_UPPER_DIRS:
-                self.can_vanish = False
+def fill_from_records(records):
+    """
+    Fills the top level directories from a dump of the unmerged location,
+    instead of listing the directories.
+
+    :param records: tuples of the path relative to the unmerged location,
+                    whether it is a directory, the modification time, and the size
+    :type records: iterable
+    :returns: the filled DataNodes of the top level directories that are not avoided
+    :rtype: generator
+    """
 
-    def traverse_tree(self, list_to_del):
-        """
-        Searches the tree for directories that can be deleted
-        and appends them to a list of directories to delete.
+    protected = compile_protected(PROTECTED_LIST) if PROTECTED_TRIE is None else PROTECTED_TRIE
 
-        :param list list_to_del: is a list of directories that
-                                can be deleted by a cleaner.
-        """
+    builder = namespacetree.TreeBuilder()
+    for path, is_dir, mtime, size in records:
+        builder.add(path, is_dir, mtime, size)
+        METRICS.add(int(is_dir), int(not is_dir), size)
 
-        if self.can_vanish:
-            list_to_del.append(self)
-        else:
-            for sub_node in self.sub_nodes:
-                sub_node.traverse_tree(list_to_del)
+    for subdir, tree in builder.build_tops(
+            lambda path_name: protection_flags(protected, path_name),
+            config.DIRS_TO_AVOID, METRICS):
+        tree.aggregate(NOW, config.MIN_AGE)
+        yield DataNode(subdir, tree)
 
 
 def bi_search(thelist, item):
@@ -271,13 +253,55 @@ def bi_search(thelist, item):
     return False
 
 
-def list_folder(name, opt):
+def scan_folder(name):
+    """
+    Lists the contents of a directory in a single pass,
+    through :py:meth:`backends.StorageBackend.list_dir` of the storage backend.
+    For ``'posix'`` storage, the type of each entry comes from the directory listing itself
+    and each file is only stat-ed once for both its modification time and size.
+
+    :param str name: is the name of the directory to list.
+    :returns: a tuple of the subdirectory names and a list of
+              ``(name, mtime, size)`` tuples for the files inside directory *name*.
+    :rtype: tuple
+    """
+
+    return METRICS.timed('list_dir', storage().list_dir, name)
+
+
+def compile_protected(protected):
+    """
+    Builds the index of paths that cannot be deleted.
+    This holds the protected LFNs and the directories in **DIRS_TO_AVOID**,
+    so a single lookup tells if a path is protected, inside a protected directory,
+    or above a protected directory.
+
+    :param list protected: the list of protected LFNs.
+    :returns: the index of protected LFNs
+    :rtype: pathtrie.PathTrie
     """
-    Lists the directories or files in a parent directory.
 
-    .. Note::
+    index = pathtrie.PathTrie(protected)
+    for root_dir in config.DIRS_TO_AVOID:
+        index.add(os.path.join(config.LFN_TO_CLEAN, root_dir))
 
-       This can potentially be optimized for different filesystems.
+    return index
+
+
+def pfn_to_lfn(pfn):
+    """
+    :param str pfn: is the PFN of a file in the unmerged location
+    :returns: the LFN
+    :rtype: str
+    """
+
+    return config.LFN_TO_CLEAN + pfn[len(config.UNMERGED_DIR_LOCATION):]
+
+
+def list_folder(name, opt):
+    """
+    Lists the directories or files in a parent directory.
+    This is kept for compatibility, the directory walk uses :py:func:`scan_folder`.
 
     :param str name: is the name of the directory to list.
     :param str opt: determines what to list inside the directory.
@@ -288,51 +312,47 @@ def list_folder(name, opt):
     :rtype: list
     """
 
-    # This is where the call is made depending on what
-    # file system the site is running, should add more as we go on
-    if opt == 'subdirs':
-        # Return list of directories
-        the_filter = os.path.isdir
-    else:
-        # Return list of files
-        the_filter = os.path.isfile
+    subdirs, files = scan_folder(name)
+    return subdirs if opt == 'subdirs' else [file_name for file_name, _, _ in files]
 
-    return [listing for listing in os.listdir(name) if
-            the_filter(os.path.join(name, listing))]
+
+def stat_path(name):
+    """
+    :param str name: Name of directory or file
+    :returns: The modification time and size, from the storage backend
+    :rtype: tuple
+    :raises OSError: If the path does not exist
+    """
+
+    info = METRICS.timed('stat', storage().stat_many, [name])[0]
+    if info is None:
+        raise OSError(errno.ENOENT, 'No such file or directory', name)
+
+    return info
 
 
 def get_mtime(name):
     """
     Get the modification time for a directory or file.
 
-    .. Note::
-
-       This can potentially be optimized for different filesystems.
-
     :param str name: Name of directory or file
     :returns: Modification time
     :rtype: int
     """
 
-    return os.stat(name).st_mtime
+    return stat_path(name)[0]
 
 
 def get_file_size(name):
     """
     Get the size of a file.
 
-    .. Note::
-
-       This can potentially be optimized for different filesystems.
-       There's no real use for this function though besides reporting back the user,
-       so go ahead and return 0 or something if you want to.
-
     :param str name: Name of file
     :returns: File size, in bytes
     :rtype: int
     """
 
-    return os.stat(name).st_size
+    return stat_path(name)[1]
 
 
 def get_protected():
@@ -364,32 +384,52 @@ def lfn_to_pfn(lfn):
     return pfn
 
 
-def hadoop_delete(directory, mount_point='/mnt/hadoop'):
+def storage():
     """
-    Does the deletion for Hadoop sites.
-
-    :param str directory: The directory name for hdfs to delete.
-                          This is not exactly the same as the LFN or PFN.
-    :param str mount_point: The location of the hadoop mount point.
+    :returns: the storage backend for **STORAGE_TYPE**,
+              which is made the first time it is needed
+    :rtype: backends.StorageBackend
     """
 
-    # Check if path is still there in case checksum is actually in a different place
-    # than we are expecting at the moment.
-    if os.path.exists(os.path.normpath(os.path.sep.join([mount_point, directory]))):
-        command = 'hdfs dfs -rm -r %s' % directory
-        LOG.info('Will do: %s', command)
-        time.sleep(config.SLEEP_TIME)
-        os.system(command)
+    global BACKEND
+
+    if BACKEND is None or BACKEND.storage_type != config.STORAGE_TYPE or \
+            BACKEND.config is not config:
+        if BACKEND is not None:
+            BACKEND.close()
+        BACKEND = trace.wrap(backends.get_backend(config), config)
 
+    return BACKEND
 
-def dcache_delete(directory):
+
+@contextlib.contextmanager
+def flushing_storage():
+    """
+    Flushes the storage backend after the work inside this context, if one was made.
+    """
+    try:
+        yield
+    finally:
+        if BACKEND is not None:
+            BACKEND.flush()
+
+
+def export_metrics(phase):
     """
-    Does the deletion for dCache sites.
+    Starts new counters for a scan or deletion, in :py:data:`METRICS`.
 
-    :param str directory: The directory name for dCache to delete
+    :param str phase: What is running, ``'scan'``, ``'estimate'``, or ``'delete'``
+    :returns: The exporter that writes the counters to **METRICS_PROM_FILE**
+              and **METRICS_JSON_FILE** every **METRICS_INTERVAL** seconds,
+              to use as a context manager around the work
+    :rtype: metrics.MetricsExporter
     """
-    LOG.error('Not implimented yet. %s has not been deleted.', directory)
-    LOG.error('Try posix or editing dcache_delete() in ListDeletable.py')
+
+    global METRICS
+
+    METRICS = metrics.Metrics(phase)
+    return metrics.MetricsExporter(METRICS, config.METRICS_PROM_FILE, config.METRICS_JSON_FILE,
+                                   config.METRICS_INTERVAL)
 
 
 def do_delete():
@@ -397,10 +437,10 @@ def do_delete():
     Does the deletion for a site based on the deletion file contents.
     If the deletion file does not exist a message is printed to the user
     and the script exits.
-
-    .. Note::
-
-       This can potentially be optimized for different filesystems.
+    The deletions are done by the storage backend, through
+    :py:func:`cmstoolbox.unmergedcleaner.deleter.delete_listed`,
+    at most **DELETE_RATE** each second and **DELETE_MAX_IN_FLIGHT** at the same time.
+    Running this again after it stops skips the entries that are done.
 
     .. Warning::
 
@@ -410,125 +450,164 @@ def do_delete():
        If this is not the case, the cksums will not be deleted.
        Your LFN will still be properly propagated to delete
        the unmerged files themselves.
+       Directories are deleted in batches by :py:class:`backends.HadoopBackend`,
+       and **DELETE_RATE** counts each directory in a batch.
+
+    :returns: The counts of the deletions
+    :rtype: deleter.DeletionStats
     """
 
     if not os.path.isfile(config.DELETION_FILE):
         LOG.error('Deletion file %s has not been created yet.', config.DELETION_FILE)
         sys.exit()
 
-    if config.WHICH_LIST != 'directories':
-        LOG.info('-' * 40)
-        LOG.info('Deleting individual files.')
-        LOG.info('Your sleep time is set to %s seconds.', config.SLEEP_TIME)
-        LOG.info('To change it, edit your config.py.')
-        LOG.info('-' * 40)
-
-    with open(config.DELETION_FILE, 'r') as deletions:
-        for deleted in deletions.readlines():
-            deleting = deleted.strip('\n')
-
-            # Do a check of the directory names. End process if something is wrong.
-            if '/unmerged/' not in deleting:
-                LOG.error('Something is either wrong with your deletions file or')
-                LOG.error('ListDetetable.do_delete().')
-                LOG.error('Your deletions file is at %s', config.DELETION_FILE)
-                LOG.error('Refusing to continue.')
-                sys.exit()
-
-            if config.WHICH_LIST == 'directories':
-
-                if config.STORAGE_TYPE == 'hadoop':
-                    # Hadoop stores also a directory with checksums
-                    hadoop_delete(deleting.replace('/mnt/hadoop', '/cksums'))
-                    # Delete the unmerged directory
-                    hadoop_delete(deleting.replace('/mnt/hadoop', ''))
-
-                elif config.STORAGE_TYPE == 'dcache':
-                    dcache_delete(deleting)
-
-                else:
-                    # The default, 'posix', goes here
-                    LOG.warning('About to delete %s', deleting)
-                    time.sleep(config.SLEEP_TIME)
-                    shutil.rmtree(deleting)
-
-            else:
-                if os.path.isfile(deleting):
-                    LOG.warning('About to delete %s', deleting)
-                    time.sleep(config.SLEEP_TIME)
-                    os.remove(deleting)
-
-
-def get_unmerged_files():
+    if config.DELETE_ORDER not in manifest.ORDERS:
+        LOG.error('DELETE_ORDER must be one of %s, not %s',
+                  ', '.join(sorted(manifest.ORDERS)), config.DELETE_ORDER)
+        sys.exit()
+
+    stats = deleter.delete_listed(
+        config, storage(), export_metrics,
+        lambda deleting: deleter.check_unmerged(deleting, config.DELETION_FILE))
+
+    if stats.interrupted:
+        sys.exit('Deletion interrupted. Run again to continue.')
+
+    return stats
+
+
+def report(depth=4, limit=20):
     """
-    :returns: the old files' PFNs in the unmerged directory
+    Prints the groups of deletable directories in the **MANIFEST_FILE**
+    with the most bytes to free, without touching the storage.
+    With the default depth, each group is a workflow,
+    like ``<era>/<primary dataset>/<tier>/<processing>``.
+
+    :param int depth: the number of levels under the unmerged location in each group
+    :param int limit: the number of groups to print
+    :returns: the rows printed, from :py:func:`manifest.reclaimable`
     :rtype: list
     """
 
-    find_cmd = 'find {0} -type f -not -newermt \'-{1} seconds\' -print'.format(
-        config.UNMERGED_DIR_LOCATION, config.MIN_AGE)
+    set_config()
+
+    rows = manifest.reclaimable(config.MANIFEST_FILE, config.DELETION_FILE,
+                                config.UNMERGED_DIR_LOCATION, depth, limit)
+    if rows is None:
+        LOG.error('There is no manifest for the deletion file %s. '
+                  'Set MANIFEST_FILE and list the directories again.', config.DELETION_FILE)
+        sys.exit()
+
+    print('\n'.join(manifest.format_reclaimable(rows)))
+
+    return rows
+
+
+def estimate_deletions(fraction=None, minimum=None, seed=None):
+    """
+    Estimates how much a scan of the directories would delete,
+    by listing a random sample of the unmerged location.
+    The estimates and their 95% confidence intervals are printed.
+    See :py:mod:`cmstoolbox.unmergedcleaner.estimate`.
+
+    :param float fraction: the least chance of each directory to be listed.
+                           If None, **ESTIMATE_FRACTION** from the configuration is used.
+    :param int minimum: the least number of subdirectories of each directory to list.
+                        If None, **ESTIMATE_MIN_SAMPLE** from the configuration is used.
+    :param int seed: the seed of the random sample, to repeat an estimate
+    :returns: the estimates
+    :rtype: estimate.Estimate
+    :raises SuspiciousConditions: If **WHICH_LIST** is not ``'directories'``
+    """
+
+    set_config()
+
+    if config.WHICH_LIST != 'directories':
+        raise SuspiciousConditions('Estimates only work with WHICH_LIST = \'directories\'')
+
+    check_config()
+
+    def list_dir(path_name):
+        """Lists a directory relative to the unmerged location"""
+        dirs, files = scan_folder(os.path.join(config.UNMERGED_DIR_LOCATION, path_name))
+        METRICS.add(1, len(files), sum(size for _, _, size in files))
+        return dirs, files
 
-    LOG.info('About to run:')
-    LOG.info(find_cmd)
+    def protection(path_name):
+        """Gives None if protected, and whether the directory is above a protected one"""
+        flags = protection_flags(PROTECTED_TRIE, path_name)
+        return None if flags is None else bool(flags & namespacetree.UPPER)
 
-    out = subprocess.Popen(find_cmd, shell=True, stdin=subprocess.PIPE,
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with export_metrics('estimate'), flushing_storage():
+        result = estimate.estimate_tree(
+            list_top_dirs(), list_dir,
+            lambda path_name: get_mtime(os.path.join(config.UNMERGED_DIR_LOCATION, path_name)),
+            protection, NOW - config.MIN_AGE,
+            config.ESTIMATE_FRACTION if fraction is None else fraction,
+            config.ESTIMATE_MIN_SAMPLE if minimum is None else minimum,
+            random.Random(seed))
+        METRICS.set_progress(1.0)
 
-    stdout, _ = out.communicate()
-    return stdout.decode().split()
+    print('\n'.join(result.summary()))
 
+    return result
 
-def get_unmerged_files_hadoop():
+
+def get_unmerged_files(threads=None):
     """
+    Lists the files that are old enough to delete.
+    A file is old enough if it is at least **MIN_AGE** older than :py:data:`NOW`,
+    the same cutoff used for directories.
+    See :py:class:`filesmode.FileLister`.
+
+    :param int threads: The number of threads listing directories.
+                        If None, **SCAN_THREADS** from the configuration is used.
     :returns: the old files' PFNs in the unmerged directory
-    :rtype: list
+    :rtype: generator
+    :raises Exception: The first exception raised while listing
     """
 
-    older_than_timestamp = int(time.time()) - config.MIN_AGE
-    hdfs_cmd = "hdfs dfs -ls -R {0} | grep -v '^d' | sed '1d;s/  */ /g' | cut -d\  -f6-8".format(
-        config.LFN_TO_CLEAN)
+    protected = compile_protected(PROTECTED_LIST) if PROTECTED_TRIE is None else PROTECTED_TRIE
+    lister = filesmode.FileLister(config.UNMERGED_DIR_LOCATION, config.LFN_TO_CLEAN,
+                                  scan_folder, protected, NOW - config.MIN_AGE, METRICS)
 
-    LOG.info('About to run:')
-    LOG.info(hdfs_cmd)
+    return lister.files(config.SCAN_THREADS if threads is None else threads)
 
-    out = subprocess.Popen(hdfs_cmd, shell=True, stdin=subprocess.PIPE,
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    stdout, _ = out.communicate()
-    all_files = stdout.decode().split("\n")
-    unmerged_files = []
-    for file_line in all_files:
-        tmp_line = file_line.split()
-        if not tmp_line:
-            continue
-        file_date = "%s %s" % (tmp_line[0], tmp_line[1])
-        file_date = int(
-            time.mktime(
-                datetime.datetime.strptime(
-                    file_date, "%Y-%m-%d %H:%M").timetuple()))
+def make_deletion_dir():
+    """
+    Makes the directory of the **DELETION_FILE**, if needed.
+
+    :returns: the directory, which is empty for the working directory
+    :rtype: str
+    """
+
+    deletion_dir = os.path.dirname(config.DELETION_FILE)
+    if deletion_dir and not os.path.exists(deletion_dir):
+        os.makedirs(deletion_dir)
 
-        if file_date < older_than_timestamp:
-            unmerged_files.append(file_line[2])
-    return unmerged_files
+    return deletion_dir
 
 
 def filter_protected(unmerged_files, protected):
     """
-    Lists unprotected files
-
-    :param list unmerged_files: the list of files to check and delete, if unprotected.
+    Lists unprotected files.
+    A file is protected if it is inside one of the protected LFNs
+    or inside one of the **DIRS_TO_AVOID** at the top of the unmerged location.
+    The files are sorted in chunks of **SORT_CHUNK_SIZE** and written
+    to the **DELETION_FILE** as they are checked, so the memory used does not grow
+    with the number of files.
+
+    :param unmerged_files: the files to check and delete, if unprotected.
+    :type unmerged_files: iterable
     :param list protected: the list of protected LFNs.
     :raises SuspiciousConditions: If the beginning of the file name does not match the
                                   configured location of ``/store/unmerged``
-                                  or if there is a partial match with a protected LFN
+                                  or if a protected LFN is not in that location
     """
 
-    LOG.info('Got %i deletion candidates', len(unmerged_files))
     LOG.info('Have %i protected dirs', len(protected))
     LOG.info('Have %i avoided dirs', len(config.DIRS_TO_AVOID))
-    n_protect = 0
-    n_delete = 0
-    output = []
 
     # Double check this
     if not protected:
@@ -536,67 +615,35 @@ def filter_protected(unmerged_files, protected):
             '\nNo directories are protected.\n'
             'Check https://cmst2.web.cern.ch/cmst2/unified/listProtectedLFN.txt')
 
-    # Speed up by comparing two sorted lists
-    protected.sort()
-    unmerged_files.sort()
-
-    iter_protect = iter(protected)
-    get_next = iter_protect.next \
-        if 'next' in dir(iter_protect) else \
-        iter_protect.__next__
-
-    pfn = lfn_to_pfn(get_next())      # We should never have 0 protected here
-
-    for unmerged_file in unmerged_files:
-        if not unmerged_file.startswith(config.UNMERGED_DIR_LOCATION):
-            raise SuspiciousConditions(
-                '\nFile %s\nis not in your configured unmerged location:\n%s' %
-                (unmerged_file, config.UNMERGED_DIR_LOCATION))
-
-        protect = False
-        while pfn < unmerged_file:
-
-            if unmerged_file.startswith(pfn):
-                protect = True
-                break
-
-            try:
-                pfn = lfn_to_pfn(get_next())
-            except StopIteration:
-                pfn = 'None'  # Paths start with '/', so this never satisfies pfn < unmerged_file
-                break
-
-            if not pfn.startswith(config.UNMERGED_DIR_LOCATION):
-                raise SuspiciousConditions(
-                    '\nDirectory %s\nis not in your configured unmerged location:\n%s' %
-                    (pfn, config.UNMERGED_DIR_LOCATION))
-
-        if not protect:
-            for root_dir in config.DIRS_TO_AVOID:
-                if os.path.join(config.UNMERGED_DIR_LOCATION, root_dir) in unmerged_file:
-                    protect = True
-                    break
-
-        if not protect:
-            output.append(unmerged_file)
-            n_delete += 1
-        else:
-            n_protect += 1
+    protected_index = compile_protected(protected)
+    make_deletion_dir()
 
-    with open(config.DELETION_FILE, 'w') as deletions:
-        deletions.write('\n'.join(output))
+    error = None
+    try:
+        list(filesmode.in_location([lfn_to_pfn(directory) for directory in protected],
+                                   config.UNMERGED_DIR_LOCATION, 'Directory'))
+        filesmode.write_deletions(
+            filesmode.in_location(unmerged_files, config.UNMERGED_DIR_LOCATION),
+            lambda unmerged_file: protected_index.lookup(pfn_to_lfn(unmerged_file)) is not None,
+            config.DELETION_FILE, config.SORT_CHUNK_SIZE)
+    except ValueError as err:
+        error = err
 
-    LOG.info('Number to delete: %i', n_delete)
-    LOG.info('Number protected/avoided: %i', n_protect)
+    # Raised outside of the except block, since Python 2 has no "raise from"
+    if error is not None:
+        raise SuspiciousConditions(str(error))
 
 
-def main():
+def check_config():
     """
-    Does the full listing for the site given in the :file:`config.py` file.
+    Checks the configuration and protected list before anything is listed,
+    and compiles the protected list into :py:data:`PROTECTED_TRIE`.
+
+    :raises SuspiciousConditions: If the location does not end with ``/unmerged``
+                                  or if nothing is protected
     """
 
-    # Do the old behavior if not set yet
-    set_config()
+    global PROTECTED_TRIE
 
     # Perform some checks of configuration file
     if not config.UNMERGED_DIR_LOCATION.endswith('/unmerged'):
@@ -613,84 +660,278 @@ def main():
             '\nNo directories are protected.\n'
             'Check https://cmst2.web.cern.ch/cmst2/unified/listProtectedLFN.txt')
 
-    # Start checks
-    if config.WHICH_LIST == 'files':
-        unmerged_files = get_unmerged_files_hadoop() \
-            if config.STORAGE_TYPE == 'hadoop' else \
-            get_unmerged_files()
+    PROTECTED_TRIE = compile_protected(PROTECTED_LIST)
+
+
+def list_top_dirs(shard=None):
+    """
+    :param tuple shard: if given, the index of a shard and the number of shards.
+                        Only the directories in that shard are given.
+    :returns: the directories directly inside the unmerged location that are not avoided,
+              sorted, so that every scan writes them in the same order
+    :rtype: list
+    """
+
+    return sorted(subdir for subdir in list_folder(config.UNMERGED_DIR_LOCATION, 'subdirs')
+                  if subdir not in config.DIRS_TO_AVOID and
+                  (shard is None or shards.in_shard(subdir, shard)))
+
+
+def shard_file(shard):
+    """
+    :param tuple shard: the index of a shard and the number of shards
+    :returns: the file the shard writes its results to, next to the **DELETION_FILE**
+    :rtype: str
+    """
+    return shards.shard_file(config.DELETION_FILE, shard)
+
+
+def merge_shards(num_shards):
+    """
+    Combines the results of the scans run with ``--shard`` into the **DELETION_FILE**.
+    The deletion file and the summary are the same as a scan of everything on one node.
+    The results of every shard must be next to the **DELETION_FILE**.
+    See :py:mod:`cmstoolbox.unmergedcleaner.shards`.
+
+    :param int num_shards: the number of shards
+    :returns: the number of directories written
+    :rtype: int
+    :raises SuspiciousConditions: if a shard is missing, did not finish,
+                                  or was run with a different protected list or configuration
+    """
+
+    set_config()
+
+    error = None
+    try:
+        tops = shards.read_shards(config.DELETION_FILE, num_shards)
+    except ValueError as err:
+        error = err
+
+    # Raised outside of the except block, since Python 2 has no "raise from"
+    if error is not None:
+        raise SuspiciousConditions('\n%s' % error)
+
+    return write_deletions(tops)
+
+
+def write_deletions(top_nodes):
+    """
+    Writes the directories that can be deleted to the **DELETION_FILE**,
+    and the **MANIFEST_FILE** if it is set, with a summary of each top level directory.
+    See :py:func:`cmstoolbox.unmergedcleaner.deletionfile.write_deletions`.
+
+    :param top_nodes: the filled DataNodes of the top level directories
+    :type top_nodes: iterable
+    :returns: the number of directories written
+    :rtype: int
+    """
+
+    make_deletion_dir()
+
+    writer = manifest.ManifestWriter(config.MANIFEST_FILE, config.SORT_CHUNK_SIZE) \
+        if config.MANIFEST_FILE else None
+
+    return deletionfile.write_deletions(top_nodes, config.UNMERGED_DIR_LOCATION,
+                                        config.DELETION_FILE, writer)
+
+
+def main(full_scan=False, fsimage_file=None, dump_file=None, resume=False, shard=None,
+         now=None):
+    """
+    Does the full listing for the site given in the :file:`config.py` file.
+
+    :param bool full_scan: If True, every directory is listed,
+                           even if it has not changed since the scan stored in **SCAN_CACHE**
+    :param str fsimage_file: If given, the unmerged location is read from this
+                             ``hdfs oiv`` output instead of being listed.
+                             See :py:mod:`cmstoolbox.unmergedcleaner.fsimage`.
+    :param str dump_file: If given, the unmerged location is read from this
+                          namespace dump instead of being listed.
+                          See :py:mod:`cmstoolbox.unmergedcleaner.dumpfile`.
+    :param bool resume: If True, a directory scan that stopped part of the way through
+                        continues from its checkpoint.
+                        See :py:mod:`cmstoolbox.unmergedcleaner.checkpoint`.
+    :param tuple shard: If given, the index of a shard and the number of shards.
+                        Only the top level directories in this shard are listed,
+                        and the results are written to :py:func:`shard_file`
+                        for :py:func:`merge_shards` instead of to the **DELETION_FILE**.
+    :param int now: If given, ages are measured from this time instead of from the start
+    :raises SuspiciousConditions: If a shard is given for anything but listing directories
+    """
+
+    global NOW
+
+    # Do the old behavior if not set yet
+    set_config()
+
+    if now is not None:
+        NOW = now
+
+    if shard is not None and (config.WHICH_LIST != 'directories' or
+                              fsimage_file is not None or dump_file is not None):
+        raise SuspiciousConditions('Shards only work when listing directories')
 
-        filter_protected(unmerged_files, PROTECTED_LIST)
+    check_config()
 
-    elif config.WHICH_LIST == 'directories':
-        for directory in PROTECTED_LIST:
-            parent = os.path.dirname(directory)
-            while parent and parent != '/':
-                PROTECTED_UPPER_DIRS.add(parent)
-                parent = os.path.dirname(parent)
+    with export_metrics('scan'), flushing_storage():
+        records = None
+        if fsimage_file is not None:
+            records = fsimage.read_fsimage(fsimage_file, config.LFN_TO_CLEAN,
+                                           os.path.dirname(config.DELETION_FILE) or None)
+        elif dump_file is not None:
+            records = dumpfile.read_dump(dump_file, config.UNMERGED_DIR_LOCATION,
+                                         config.LFN_TO_CLEAN,
+                                         config.DUMP_FORMAT, config.DUMP_COLUMNS)
 
-        LOG.info("Some statistics about what is going to be deleted")
-        LOG.info("# Folders  Total    Total  DiskSize  FolderName")
-        LOG.info("#          Folders  Files  [GB]                ")
+        # Start checks
+        if config.WHICH_LIST == 'files':
+            scan_files(records)
 
-        # Get the location of the PFN and the subdirectories there
+        elif config.WHICH_LIST == 'directories' and records is not None:
+            write_deletions(fill_from_records(records))
 
-        dirs = [subdir for subdir in list_folder(config.UNMERGED_DIR_LOCATION, 'subdirs') \
-                    if subdir not in config.DIRS_TO_AVOID]
+        elif config.WHICH_LIST == 'directories':
+            scan_directories(full_scan, resume, shard)
+
+        else:
+            LOG.error('The WHICH_LIST parameter in config.py is not valid.')
+
+        METRICS.set_progress(1.0)
 
-        dirs_to_delete = []
 
-        tot_upper_dirs = 0
-        tot_dirs = 0
-        tot_files = 0
-        tot_site = 0
+def scan_files(records=None):
+    """
+    Writes the old files that are not protected to the **DELETION_FILE**.
 
-        for subdir in dirs:
-            top_node = DataNode(subdir)
-            top_node.fill()
+    :param records: if given, the records of a dump to take the files from,
+                    instead of listing them from the storage
+    :type records: iterable
+    """
 
-            list_to_del = []
-            top_node.traverse_tree(list_to_del)
+    if records is not None:
+        unmerged_files = filesmode.records_old_files(
+            records, config.UNMERGED_DIR_LOCATION, NOW - config.MIN_AGE)
+    else:
+        listed = storage().list_files(config.UNMERGED_DIR_LOCATION)
+        unmerged_files = get_unmerged_files() if listed is None \
+            else filesmode.listed_old_files(listed, NOW - config.MIN_AGE)
 
-            if not list_to_del:
-                continue
+    if config.MANIFEST_FILE:
+        LOG.warning('The MANIFEST_FILE is only written when listing directories')
 
-            num_todelete_dirs = 0   # Number of directories to be deleted
-            num_todelete_files = 0  # Number of files to be deleted
-            todelete_size = 0       # Amount of space to be deleted (in GB, eventually)
+    filter_protected(unmerged_files, PROTECTED_LIST)
 
-            for item in list_to_del:
-                num_todelete_dirs += item.nsubnodes
-                num_todelete_files += item.nsubfiles
-                todelete_size += item.size
 
-            todelete_size /= (1024 * 1024 * 1024)
-            LOG.info("  %-8d %-8d %-6d %-9d %-s",
-                     len(list_to_del), num_todelete_dirs, num_todelete_files,
-                     todelete_size, subdir)
+def scan_directories(full_scan=False, resume=False, shard=None):
+    """
+    Lists the directories and writes the ones that can be deleted to the **DELETION_FILE**,
+    or to the :py:func:`shard_file` of a shard.
 
-            tot_upper_dirs += len(list_to_del)
-            tot_dirs += num_todelete_dirs
-            tot_files += num_todelete_files
-            tot_site += todelete_size
+    :param bool full_scan: if True, every directory is listed, even if it is in the scan cache
+    :param bool resume: if True, the scan continues from its checkpoint
+    :param tuple shard: if given, the index of a shard and the number of shards to list
+    """
 
-            dirs_to_delete.extend(list_to_del)
+    global NOW
 
-        LOG.info("-" * 30)
-        LOG.info("  %-8d %-8d %-6d %-9d TOTALS", tot_upper_dirs, tot_dirs, tot_files, tot_site)
+    cache = scancache.ScanCache(config.SCAN_CACHE, config.UNMERGED_DIR_LOCATION,
+                                full_scan) if config.SCAN_CACHE else None
 
-        deletion_dir = os.path.dirname(config.DELETION_FILE)
-        if not os.path.exists(deletion_dir):
-            os.makedirs(deletion_dir)
+    make_deletion_dir()
+    saved = checkpoint.Checkpoint(
+        '%s.checkpoint' % config.DELETION_FILE if shard is None else shard_file(shard),
+        checkpoint.fingerprint(config, PROTECTED_LIST), NOW, resume, shard)
+    NOW = saved.now
 
-        with open(config.DELETION_FILE, 'w') as del_file:
-            del_file.write(
-                '\n'.join(
-                    [os.path.join(config.UNMERGED_DIR_LOCATION, item.path_name) \
-                         for item in dirs_to_delete]
-                    ) + '\n')
+    def make_node(subdir):
+        """Fills a top level directory that is not in the checkpoint"""
+        top_node = DataNode(subdir)
+        top_node.fill(cache=cache)
+        return top_node
 
+    try:
+        top_nodes = saved.fill_tops(list_top_dirs(shard), make_node, METRICS)
+        if shard is None:
+            write_deletions(top_nodes)
+        else:
+            # The checkpoint holds the results, so the trees are not kept
+            num_tops = sum(1 for _ in top_nodes)
+    except BaseException:
+        saved.close()
+        raise
+
+    if shard is None:
+        saved.finish()
     else:
-        LOG.error('The WHICH_LIST parameter in config.py is not valid.')
+        saved.complete()
+        LOG.info('Shard %i/%i listed %i top level directories into %s',
+                 shard[0], shard[1], num_tops, saved.file_name)
+
+    if cache is not None:
+        # A shard or a resumed scan did not list everything
+        cache.close(merge=shard is not None or resume)
+        LOG.info('The scan cache skipped listing %i of %i directories',
+                 cache.hits, cache.hits + cache.misses)
+
+
+def refresh_tops(trees, protected_source=None):
+    """
+    Brings the trees kept by :py:func:`run_daemon` up to date, and writes the deletion file.
+
+    :param daemon.ResidentTrees trees: the filled top level directories, which are updated
+    :param function protected_source: if given, this is called to get a new list of protected LFNs
+    :returns: the number of directories written
+    :rtype: int
+    """
+
+    global NOW, PROTECTED_LIST
+
+    if protected_source is not None:
+        protected = sorted(protected_source())
+        if protected != PROTECTED_LIST:
+            # Protection is stored in the trees, so they all have to be filled again
+            PROTECTED_LIST = protected
+            check_config()
+            trees.clear()
+
+    NOW = int(time.time())
+    return write_deletions(trees.refresh(list_top_dirs(), NOW))
+
+
+def run_daemon(protected_source=None):
+    """
+    Keeps the tree of the unmerged location in memory and writes the **DELETION_FILE**
+    when asked, instead of walking the whole location each time.
+    Directory listings are kept current through inotify, so only the top level directories
+    with changes are filled again, and only their changed directories are listed again.
+    A new **DELETION_FILE** is written on ``SIGUSR1``, on ``write`` to **DAEMON_SOCKET**,
+    and every **DAEMON_RESCAN_TIME** seconds.
+    See :py:mod:`cmstoolbox.unmergedcleaner.daemon`.
+
+    This only works for ``'directories'`` on POSIX storage on Linux.
+
+    :param function protected_source: If given, this is called before each write
+                                      to get a new list of protected LFNs
+    :raises SuspiciousConditions: If **WHICH_LIST** is not ``'directories'``
+    """
+
+    set_config()
+
+    if config.WHICH_LIST != 'directories':
+        raise SuspiciousConditions('The daemon only works with WHICH_LIST = \'directories\'')
+
+    check_config()
+
+    listings = residentscan.WatchedListings(config.UNMERGED_DIR_LOCATION,
+                                            config.DAEMON_RESCAN_TIME)
+    trees = daemon.ResidentTrees(listings, DataNode, config.MIN_AGE)
+
+    try:
+        daemon.Daemon(listings, lambda: refresh_tops(trees, protected_source),
+                      config.DAEMON_RESCAN_TIME, config.DAEMON_SOCKET).run()
+    finally:
+        listings.close()
 
 
 # Generate documentation for the options in the configuration file.
@@ -699,27 +940,46 @@ __doc__ %= '\n'.join(['- **%s** - %s' % (var, configtools.DOCS[var].replace('\n'
 
 NOW = int(time.time())
 
+# The protected LFNs, sorted, which are filled by the script or by tests
+PROTECTED_LIST = []
+
+# The index of protected paths, compiled from PROTECTED_LIST by main()
+PROTECTED_TRIE = None
+
+# The storage backend, made by storage()
+BACKEND = None
+
+# The counters of the current scan or deletion, made by export_metrics()
+METRICS = metrics.Metrics('scan')
+
 
 if __name__ == '__main__':
 
+    SHARD = None
+    if OPTS.shard:
+        try:
+            SHARD = shards.parse_shard(OPTS.shard)
+        except ValueError as err:
+            PARSER.error('Bad --shard %s: %s' % (OPTS.shard, err))
+
     if OPTS.do_delete:
         do_delete()
 
+    elif OPTS.merge:
+        merge_shards(OPTS.merge)
+
+    elif OPTS.report:
+        report(OPTS.report_depth, OPTS.report_limit)
+
     else:
         # The list of protected directories to not delete
         PROTECTED_LIST = get_protected()
         PROTECTED_LIST.sort()
-        PROTECTED_UPPER_DIRS = set()
-
-        # The lengths of these protected directories for optimization
-        ALL_LENGTHS = list(set(len(protected) for protected in PROTECTED_LIST))
-        ALL_LENGTHS.sort()
-
-        main()
 
-else:
-
-    # Some empty lists that we'll populate for tests.
-
-    PROTECTED_LIST = []
-    ALL_LENGTHS = []
+        if OPTS.estimate:
+            estimate_deletions()
+        elif OPTS.daemon:
+            run_daemon(protected_source=get_protected)
+        else:
+            main(full_scan=OPTS.full_scan, fsimage_file=OPTS.fsimage, dump_file=OPTS.dump,
+                 resume=OPTS.resume, shard=SHARD, now=OPTS.now)
@@ -0,0 +1,353 @@
+"""
+This module writes and reads the deletion manifest of the :ref:`unmerged-ref`.
+
+The **DELETION_FILE** only lists paths.
+When **MANIFEST_FILE** is set, the directories mode also writes a manifest with what the scan
+found for each deletable directory: its line in the deletion file, the bytes and number of files
+inside of it, the number of subdirectories, and the latest modification time inside of it.
+Later steps can use the manifest instead of asking the storage again.
+:py:func:`listdeletable.do_delete` uses it to order the deletions with **DELETE_ORDER**
+and to measure its progress by the number of files and directories removed,
+and :py:func:`listdeletable.report` uses it to list the workflows with the most space to free.
+
+The manifest is an SQLite database if its name ends with ``.sqlite``, ``.sqlite3``, or ``.db``.
+The entries are in a table called ``entries``, with the path as its primary key,
+and the deletion file it belongs to is in a table called ``header``.
+Any other name gives a file with one JSON object on each line.
+The first line is the header, and the entries follow, sorted by path.
+
+Like the journal, the header holds the size and modification time of the deletion file,
+so a manifest left from an older deletion file is not used.
+"""
+
+import os
+import json
+import time
+import heapq
+import logging
+import sqlite3
+import collections
+
+from . import externalsort
+from .journal import describe
+
+
+LOG = logging.getLogger(__name__)
+
+Entry = collections.namedtuple('Entry', ['path', 'line', 'size', 'files', 'dirs', 'latest'])
+"""One deletable directory in the manifest."""
+
+ORDERS = {
+    'file': ('line', lambda entry: entry.line),
+    'path': ('path', lambda entry: entry.path),
+    'largest': ('size DESC, path', lambda entry: (-entry.size, entry.path)),
+    'oldest': ('latest, path', lambda entry: (entry.latest, entry.path)),
+}
+"""The orders entries can be read in, as an SQL ordering and a sort key."""
+
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+
+
+def is_sqlite(file_name):
+    """
+    :param str file_name: The name of a manifest
+    :returns: True if the manifest is an SQLite database
+    :rtype: bool
+    """
+    return file_name.endswith(SQLITE_SUFFIXES)
+
+
+def weight(entry):
+    """
+    :param Entry entry: An entry of the manifest
+    :returns: The number of files and directories removed with the entry
+    :rtype: int
+    """
+    return entry.files + entry.dirs + 1
+
+
+class ManifestWriter(object):
+    """
+    Writes a new manifest. It replaces any old one only when :py:meth:`finish` is called,
+    so the manifest is never partially written.
+    """
+
+    def __init__(self, file_name, chunk_size=1000000):
+        """
+        :param str file_name: The manifest to write
+        :param int chunk_size: For a JSON manifest, the number of entries sorted in memory at once.
+                               See :py:mod:`cmstoolbox.unmergedcleaner.externalsort`.
+        """
+
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        self.tmp_name = '%s.tmp' % file_name
+        self.num_entries = 0
+
+        if os.path.exists(self.tmp_name):
+            os.remove(self.tmp_name)
+
+        if is_sqlite(file_name):
+            self._db = sqlite3.connect(self.tmp_name)
+            self._db.execute('CREATE TABLE header '
+                             '(deletion_file TEXT, size INTEGER, mtime REAL, entries INTEGER)')
+            self._db.execute('CREATE TABLE entries (path TEXT PRIMARY KEY, line INTEGER, '
+                             'size INTEGER, files INTEGER, dirs INTEGER, latest INTEGER)')
+            self._unsorted = None
+        else:
+            self._db = None
+            # Entries are kept unsorted here, and sorted when the manifest is finished
+            self._unsorted = open('%s.unsorted' % self.tmp_name, 'w')
+
+    def add(self, entry):
+        """
+        :param Entry entry: A deletable directory. The path cannot contain newlines.
+        """
+
+        self.num_entries += 1
+        if self._db is not None:
+            self._db.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)', entry)
+        else:
+            # The NUL keeps the sort by path, since paths cannot contain it
+            self._unsorted.write('%s\0%s\n' % (entry.path, json.dumps(entry[1:])))
+
+    def finish(self, deletion_file):
+        """
+        Writes the header and replaces the old manifest.
+
+        :param str deletion_file: The deletion file the entries are from, which is already written
+        """
+
+        header = describe(deletion_file)
+        header['entries'] = self.num_entries
+
+        if self._db is not None:
+            self._db.execute('INSERT INTO header VALUES (?, ?, ?, ?)',
+                             (header['deletion_file'], header['size'], header['mtime'],
+                              header['entries']))
+            self._db.execute('CREATE INDEX entries_size ON entries (size)')
+            self._db.execute('CREATE INDEX entries_latest ON entries (latest)')
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+        else:
+            unsorted_name = self._unsorted.name
+            self._unsorted.close()
+            self._unsorted = None
+
+            try:
+                with open(unsorted_name, 'r') as unsorted:
+                    with open(self.tmp_name, 'w') as output:
+                        output.write(json.dumps(header) + '\n')
+                        for line in externalsort.sorted_paths(
+                                (line[:-1] for line in unsorted), self.chunk_size,
+                                os.path.dirname(self.file_name) or None):
+                            path, values = line.split('\0', 1)
+                            output.write(json.dumps(dict(zip(
+                                Entry._fields, [path] + json.loads(values)))) + '\n')
+            finally:
+                os.remove(unsorted_name)
+
+        os.rename(self.tmp_name, self.file_name)
+        LOG.info('Wrote %i entries to the manifest %s', self.num_entries, self.file_name)
+
+    def abort(self):
+        """Removes the partial manifest, and keeps the old one"""
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if self._unsorted is not None:
+            self._unsorted.close()
+            os.remove(self._unsorted.name)
+            self._unsorted = None
+        if os.path.exists(self.tmp_name):
+            os.remove(self.tmp_name)
+
+
+class Manifest(object):
+    """
+    A manifest written by :py:class:`ManifestWriter`.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param str file_name: The manifest to read
+        """
+
+        self.file_name = file_name
+        if is_sqlite(file_name):
+            self._db = sqlite3.connect(file_name)
+            row = self._db.execute('SELECT * FROM header').fetchone()
+            self.header = dict(zip(['deletion_file', 'size', 'mtime', 'entries'], row))
+        else:
+            self._db = None
+            with open(file_name, 'r') as manifest:
+                self.header = json.loads(manifest.readline())
+
+    def matches(self, deletion_file):
+        """
+        :param str deletion_file: A deletion file
+        :returns: True if the manifest was written with this version of the deletion file
+        :rtype: bool
+        """
+        return dict((key, self.header[key]) for key in ('deletion_file', 'size', 'mtime')) == \
+            describe(deletion_file)
+
+    def _read(self):
+        """Gives the entries in the order they are stored"""
+        if self._db is not None:
+            for row in self._db.execute('SELECT * FROM entries ORDER BY path'):
+                yield Entry(*row)
+            return
+
+        with open(self.file_name, 'r') as manifest:
+            # Skip the header
+            manifest.readline()
+            for line in manifest:
+                values = json.loads(line)
+                yield Entry(*[values[field] for field in Entry._fields])
+
+    def entries(self, order='path'):
+        """
+        Gives the entries in order.
+        A JSON manifest is read into memory to order it by anything but the path.
+
+        :param str order: One of the keys of :py:data:`ORDERS`
+        :returns: The entries
+        :rtype: generator
+        :raises KeyError: If the order is not known
+        """
+
+        sql_order, key = ORDERS[order]
+        if self._db is not None:
+            for row in self._db.execute('SELECT * FROM entries ORDER BY %s' % sql_order):
+                yield Entry(*row)
+
+        elif order == 'path':
+            for entry in self._read():
+                yield entry
+
+        else:
+            for entry in sorted(self._read(), key=key):
+                yield entry
+
+    def totals(self):
+        """
+        :returns: The number of entries, and the bytes, files, and directories inside of them
+        :rtype: tuple
+        """
+
+        if self._db is not None:
+            return tuple(value or 0 for value in self._db.execute(
+                'SELECT COUNT(*), SUM(size), SUM(files), SUM(dirs) FROM entries').fetchone())
+
+        output = [0, 0, 0, 0]
+        for entry in self._read():
+            output[0] += 1
+            output[1] += entry.size
+            output[2] += entry.files
+            output[3] += entry.dirs
+        return tuple(output)
+
+    def close(self):
+        """Closes the database, if there is one"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def open_manifest(file_name, deletion_file):
+    """
+    :param str file_name: The manifest to read
+    :param str deletion_file: The deletion file the manifest should belong to
+    :returns: The manifest, or None if there is none for this version of the deletion file
+    :rtype: Manifest
+    """
+
+    if not file_name or not os.path.exists(file_name):
+        return None
+
+    try:
+        manifest = Manifest(file_name)
+    except (ValueError, KeyError, TypeError, sqlite3.Error) as err:
+        LOG.warning('Could not read the manifest %s: %s', file_name, err)
+        return None
+
+    if not manifest.matches(deletion_file):
+        LOG.warning('The manifest %s is for an older deletion file. Not using it.', file_name)
+        manifest.close()
+        return None
+
+    return manifest
+
+
+def top_reclaimable(entries, location, depth=4, limit=20):
+    """
+    Groups entries by the directory *depth* levels under the unmerged location,
+    which is the workflow for the default depth,
+    and gives the groups with the most bytes to delete.
+
+    :param entries: The entries of a manifest
+    :type entries: iterable
+    :param str location: The unmerged location the paths start with
+    :param int depth: The number of levels in the name of each group
+    :param int limit: The number of groups to give
+    :returns: The name of each group, with its number of entries, bytes, files, and
+              oldest modification time, starting from the most bytes
+    :rtype: list
+    """
+
+    groups = {}
+    prefix = location.rstrip('/') + '/'
+    for entry in entries:
+        relative = entry.path[len(prefix):] if entry.path.startswith(prefix) else entry.path
+        name = '/'.join(relative.split('/')[:depth])
+        group = groups.get(name)
+        if group is None:
+            groups[name] = [1, entry.size, entry.files, entry.latest]
+        else:
+            group[0] += 1
+            group[1] += entry.size
+            group[2] += entry.files
+            group[3] = min(group[3], entry.latest)
+
+    return [(name,) + tuple(values) for name, values in
+            heapq.nlargest(limit, groups.items(), key=lambda item: (item[1][1], item[0]))]
+
+
+def reclaimable(file_name, deletion_file, location, depth=4, limit=20):
+    """
+    :param str file_name: The manifest
+    :param str deletion_file: The deletion file the manifest must belong to
+    :param str location: The unmerged location the paths start with
+    :param int depth: The number of levels in the name of each group
+    :param int limit: The number of groups to give
+    :returns: The groups from :py:func:`top_reclaimable`,
+              or None if there is no manifest for the deletion file
+    :rtype: list
+    """
+
+    listing = open_manifest(file_name, deletion_file)
+    if listing is None:
+        return None
+
+    try:
+        return top_reclaimable(listing.entries(), location, depth, limit)
+    finally:
+        listing.close()
+
+
+def format_reclaimable(rows):
+    """
+    :param list rows: The groups from :py:func:`top_reclaimable`
+    :returns: The lines of a table of the groups, with sizes in GB
+    :rtype: list
+    """
+
+    return ['# Dirs   Files     Size [GB]  Oldest      Group'] + \
+        ['  %-8d %-9d %-10.1f %-11s %s' %
+         (num_entries, num_files, size / float(1024 ** 3),
+          time.strftime('%Y-%m-%d', time.localtime(oldest)), name)
+         for name, num_entries, size, num_files, oldest in rows]
@@ -0,0 +1,295 @@
+"""
+This module tracks the progress of the :ref:`unmerged-ref` while it runs,
+so that a slow scan or deletion can be told apart from a stalled one.
+
+A :py:class:`Metrics` object counts the directories and files accounted for,
+their bytes, the deletions and their outcomes, and the number and total latency
+of the calls made to the storage for each operation.
+It also holds the top level directory being worked on and the fraction of the work done,
+which gives an estimate of the time left.
+
+While the scan or deletion runs, a :py:class:`MetricsExporter` writes these periodically
+to a file for the Prometheus node exporter's textfile collector (**METRICS_PROM_FILE**)
+and to a JSON status file (**METRICS_JSON_FILE**).
+Each file is written to a temporary file first and renamed,
+so readers never see a partly written file.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+PREFIX = 'unmerged_cleaner'
+"""The start of the name of every Prometheus metric."""
+
+
+def escape_label(value):
+    """
+    :param str value: The value of a Prometheus label
+    :returns: The value, escaped for the text format
+    :rtype: str
+    """
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metrics(object):
+    """
+    The counters of one scan or deletion. These can be updated from several threads.
+    """
+
+    def __init__(self, phase):
+        """
+        :param str phase: What is running, ``'scan'``, ``'estimate'``, or ``'delete'``
+        """
+        self.phase = phase
+        self.start = time.time()
+        self.directories = 0
+        self.files = 0
+        self.bytes = 0
+        self.outcomes = {}
+        self.deleted_bytes = 0
+        # Maps each storage operation to its number of calls and total seconds
+        self.calls = {}
+        self.current_top = None
+        self.progress = 0.0
+        self._start_progress = None
+        self._lock = threading.Lock()
+
+    def add(self, directories=0, files=0, size=0):
+        """
+        :param int directories: The number of directories accounted for
+        :param int files: The number of files accounted for
+        :param int size: The bytes in those files
+        """
+        with self._lock:
+            self.directories += directories
+            self.files += files
+            self.bytes += size
+
+    def add_deletion(self, outcome, size=None):
+        """
+        :param str outcome: ``'deleted'``, ``'missing'``, or ``'failed'``
+        :param int size: The bytes removed, if known
+        """
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.deleted_bytes += size or 0
+
+    def observe(self, operation, seconds):
+        """
+        :param str operation: The storage operation that was called
+        :param float seconds: How long the call took
+        """
+        with self._lock:
+            calls, total = self.calls.get(operation, (0, 0.0))
+            self.calls[operation] = (calls + 1, total + seconds)
+
+    def timed(self, operation, func, *args):
+        """
+        Calls a function, and adds its latency to an operation.
+
+        :param str operation: The name of the operation
+        :param function func: The function to call
+        :param args: The arguments to call *func* with
+        :returns: What *func* returns
+        """
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.observe(operation, time.time() - start)
+
+    def set_progress(self, fraction, current_top=None):
+        """
+        :param float fraction: The fraction of the work that is done, between 0 and 1
+        :param str current_top: The top level directory being worked on, if any
+        """
+        with self._lock:
+            if self._start_progress is None:
+                self._start_progress = fraction
+            self.progress = fraction
+            self.current_top = current_top
+
+    def eta(self):
+        """
+        :returns: The seconds left, from the progress made since the start,
+                  or None if there is nothing to go on yet
+        :rtype: float
+        """
+        elapsed = time.time() - self.start
+        made = self.progress - (self._start_progress or 0.0)
+        if made <= 0 or elapsed <= 0:
+            return None
+
+        return elapsed * (1.0 - self.progress) / made
+
+    def snapshot(self):
+        """
+        :returns: The current values, as they are written to the JSON status file
+        :rtype: dict
+        """
+
+        with self._lock:
+            now = time.time()
+            elapsed = now - self.start
+            output = {
+                'phase': self.phase,
+                'start': self.start,
+                'updated': now,
+                'elapsed': elapsed,
+                'directories': self.directories,
+                'files': self.files,
+                'bytes': self.bytes,
+                'directories_per_second': self.directories / elapsed if elapsed > 0 else 0.0,
+                'files_per_second': self.files / elapsed if elapsed > 0 else 0.0,
+                'deletions': dict(self.outcomes),
+                'deleted_bytes': self.deleted_bytes,
+                'storage_calls': dict(
+                    (operation, {'calls': calls, 'seconds': total,
+                                 'mean_latency': total / calls if calls else 0.0})
+                    for operation, (calls, total) in self.calls.items()),
+                'current_top': self.current_top,
+                'progress': self.progress,
+            }
+
+        output['eta'] = self.eta()
+        return output
+
+    def prometheus_text(self):
+        """
+        :returns: The current values in the Prometheus text format
+        :rtype: str
+        """
+
+        snapshot = self.snapshot()
+        phase = 'phase="%s"' % escape_label(self.phase)
+        lines = []
+
+        def add(name, metric_type, help_text, samples):
+            """Adds one metric, with a list of (labels, value) samples"""
+            lines.append('# HELP %s_%s %s' % (PREFIX, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (PREFIX, name, metric_type))
+            for labels, value in samples:
+                lines.append('%s_%s{%s} %s' % (PREFIX, name, ','.join([phase] + labels),
+                                               repr(float(value))))
+
+        add('start_time_seconds', 'gauge', 'When the run started.',
+            [([], snapshot['start'])])
+        add('last_update_time_seconds', 'gauge', 'When these metrics were written.',
+            [([], snapshot['updated'])])
+        add('directories_total', 'counter', 'Directories accounted for.',
+            [([], snapshot['directories'])])
+        add('files_total', 'counter', 'Files accounted for.',
+            [([], snapshot['files'])])
+        add('bytes_total', 'counter', 'Bytes in the files accounted for.',
+            [([], snapshot['bytes'])])
+        add('directories_per_second', 'gauge', 'Directories accounted for each second.',
+            [([], snapshot['directories_per_second'])])
+        add('files_per_second', 'gauge', 'Files accounted for each second.',
+            [([], snapshot['files_per_second'])])
+        add('deletions_total', 'counter', 'Deletions by outcome.',
+            [(['outcome="%s"' % escape_label(outcome)], count)
+             for outcome, count in sorted(snapshot['deletions'].items())])
+        add('deleted_bytes_total', 'counter', 'Bytes removed by deletions.',
+            [([], snapshot['deleted_bytes'])])
+        add('storage_calls_total', 'counter', 'Calls to the storage by operation.',
+            [(['operation="%s"' % escape_label(operation)], calls['calls'])
+             for operation, calls in sorted(snapshot['storage_calls'].items())])
+        add('storage_call_seconds_total', 'counter', 'Time spent in storage calls by operation.',
+            [(['operation="%s"' % escape_label(operation)], calls['seconds'])
+             for operation, calls in sorted(snapshot['storage_calls'].items())])
+        add('progress_ratio', 'gauge', 'Fraction of the work that is done.',
+            [([], snapshot['progress'])])
+        if snapshot['eta'] is not None:
+            add('eta_seconds', 'gauge', 'Estimated seconds until the work is done.',
+                [([], snapshot['eta'])])
+        if snapshot['current_top'] is not None:
+            add('current_top_info', 'gauge', 'The top level directory being worked on.',
+                [(['top="%s"' % escape_label(snapshot['current_top'])], 1)])
+
+        return '\n'.join(lines) + '\n'
+
+
+def write_atomic(file_name, content):
+    """
+    Writes a file through a temporary file, so it is never seen partly written.
+
+    :param str file_name: The file to write
+    :param str content: What to write
+    """
+    tmp_name = '%s.tmp' % file_name
+    with open(tmp_name, 'w') as output:
+        output.write(content)
+    os.rename(tmp_name, file_name)
+
+
+class MetricsExporter(object):
+    """
+    Writes a :py:class:`Metrics` to files every few seconds from a background thread,
+    and once more when stopped. Without any files, this does nothing.
+    This can be used as a context manager around the work being measured.
+    """
+
+    def __init__(self, metrics, prom_file=None, json_file=None, interval=10.0):
+        """
+        :param Metrics metrics: The metrics to write
+        :param str prom_file: The Prometheus textfile to write, if any
+        :param str json_file: The JSON status file to write, if any
+        :param float interval: The seconds between writes
+        """
+        self.metrics = metrics
+        self.prom_file = prom_file
+        self.json_file = json_file
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        """Writes the files now"""
+        try:
+            if self.prom_file:
+                write_atomic(self.prom_file, self.metrics.prometheus_text())
+            if self.json_file:
+                write_atomic(self.json_file, json.dumps(self.metrics.snapshot(), sort_keys=True))
+        except (IOError, OSError) as err:
+            LOG.warning('Could not write the metrics: %s', err)
+
+    def _run(self):
+        """Writes the files until stopped"""
+        # Event.wait returns None before Python 2.7, so the flag is checked instead
+        while not self._stop.is_set():
+            self._stop.wait(self.interval)
+            if not self._stop.is_set():
+                self.write()
+
+    def start(self):
+        """Starts writing in the background"""
+        if not (self.prom_file or self.json_file):
+            return
+
+        self.write()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread, and writes the final values"""
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.write()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
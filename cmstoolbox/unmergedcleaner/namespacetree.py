@@ -0,0 +1,717 @@
+"""
+This module holds the directory tree used by the :ref:`unmerged-ref`.
+Instead of one Python object per directory, the tree is stored in parallel typed arrays.
+Directory names are interned, so repeated names like ``0000`` are only stored once,
+and full paths are only rebuilt for the directories that are written out.
+All of the walks over the tree are iterative, so deep trees do not hit the recursion limit.
+The storage is walked by :py:func:`walk_tree`, which can list directories from several threads.
+
+If NumPy is installed, the subtree totals are summed with array reductions over
+each level of the tree instead of a Python loop over every directory.
+NumPy is optional and the results are the same without it.
+"""
+
+import os
+import sys
+import threading
+from array import array
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    array('q')
+    INT_TYPE = 'q'
+except ValueError:
+    INT_TYPE = 'l'
+
+
+PROTECTED = 1
+"""Flag for a directory that is protected. It is not listed."""
+
+UPPER = 2
+"""Flag for a directory above a protected one."""
+
+PROTECTED_BELOW = 4
+"""Flag for a directory with a protected directory somewhere below it."""
+
+KEPT = PROTECTED | UPPER | PROTECTED_BELOW
+"""Directories with any of these flags cannot be deleted, no matter their age."""
+
+VANISH = 8
+"""Flag for a directory that can be deleted."""
+
+NUMPY_MIN_NODES = 10000
+"""Trees with fewer directories than this are aggregated without NumPy, which is faster for them."""
+
+
+class NamespaceTree(object):
+    """
+    A directory tree stored in arrays.
+    Each directory is an index into the arrays.
+    The top directory has index ``0``, and the subdirectories of a
+    directory have consecutive indices that are larger than the index of their parent.
+
+    Before :py:meth:`aggregate` is called, **latest**, **size**, and **nsubfiles**
+    only hold the values for the files directly inside of each directory.
+    After, they hold the totals for each full subtree.
+    """
+
+    def __init__(self, path_name):
+        """
+        :param str path_name: The path of the top directory of the tree
+        """
+        self.path_name = path_name
+        self.names = []
+        self.parent = array(INT_TYPE)
+        self.name_id = array(INT_TYPE)
+        self.first_child = array(INT_TYPE)
+        self.nchildren = array(INT_TYPE)
+        self.latest = array('d')
+        self.size = array(INT_TYPE)
+        self.nsubfiles = array(INT_TYPE)
+        self.nsubnodes = array(INT_TYPE)
+        self.flags = bytearray()
+
+        self._name_ids = {}
+        self._lock = threading.Lock()
+
+        self._append(-1, -1)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _append(self, parent, name_id):
+        """Adds one empty directory to the arrays"""
+        self.parent.append(parent)
+        self.name_id.append(name_id)
+        self.first_child.append(0)
+        self.nchildren.append(0)
+        self.latest.append(0)
+        self.size.append(0)
+        self.nsubfiles.append(0)
+        self.nsubnodes.append(0)
+        self.flags.append(0)
+
+    def intern(self, name):
+        """
+        :param str name: A directory name
+        :returns: The id of the name in :py:attr:`names`
+        :rtype: int
+        """
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self._name_ids[name] = name_id
+            self.names.append(name)
+
+        return name_id
+
+    def add_children(self, index, names):
+        """
+        Adds the subdirectories of a directory. This can be called from multiple threads.
+
+        :param int index: The index of the parent directory
+        :param list names: The names of the subdirectories
+        :returns: The index of the first subdirectory.
+                  The others follow in the order of *names*.
+        :rtype: int
+        """
+        with self._lock:
+            first = len(self.parent)
+            for name in names:
+                self._append(index, self.intern(name))
+
+        self.first_child[index] = first
+        self.nchildren[index] = len(names)
+        return first
+
+    def set_files(self, index, latest, size, nfiles, flags=0):
+        """
+        Sets the information for the files directly inside a directory.
+
+        :param int index: The index of the directory
+        :param float latest: The latest modification time of the files
+        :param int size: The total size of the files
+        :param int nfiles: The number of files
+        :param int flags: Flags to set, like :py:data:`UPPER`
+        """
+        self.latest[index] = latest
+        self.size[index] = size
+        self.nsubfiles[index] = nfiles
+        self.flags[index] |= flags
+
+    def children(self, index):
+        """
+        :param int index: The index of a directory
+        :returns: The indices of the subdirectories
+        :rtype: range
+        """
+        first = self.first_child[index]
+        return range(first, first + self.nchildren[index])
+
+    def path(self, index):
+        """
+        :param int index: The index of a directory
+        :returns: The path of the directory, starting with the path of the top directory
+        :rtype: str
+        """
+        parts = []
+        while index > 0:
+            parts.append(self.names[self.name_id[index]])
+            index = self.parent[index]
+
+        parts.append(self.path_name)
+        return os.path.join(*reversed(parts))
+
+    def can_vanish(self, index):
+        """
+        :param int index: The index of a directory
+        :returns: If the directory can be deleted
+        :rtype: bool
+        """
+        return bool(self.flags[index] & VANISH)
+
+    def add_files(self, parents, mtimes, sizes):
+        """
+        Adds files to the directories directly containing them.
+        This is the same as :py:meth:`set_files` for metadata that comes as
+        flat arrays with one entry per file, instead of one entry per directory.
+
+        :param parents: The index of the directory of each file
+        :type parents: array or list
+        :param mtimes: The modification time of each file
+        :type mtimes: array or list
+        :param sizes: The size of each file
+        :type sizes: array or list
+        """
+
+        if numpy is not None and len(parents) >= NUMPY_MIN_NODES:
+            parents = numpy.asarray(parents, dtype=numpy.int64)
+            latest, size, nsubfiles = self._numpy_arrays()[1:4]
+
+            numpy.maximum.at(latest, parents, numpy.asarray(mtimes, dtype=numpy.float64))
+            numpy.add.at(size, parents, numpy.asarray(sizes, dtype=size.dtype))
+            numpy.add.at(nsubfiles, parents, 1)
+            return
+
+        latest = self.latest
+        size = self.size
+        nsubfiles = self.nsubfiles
+        for parent, mtime, file_size in zip(parents, mtimes, sizes):
+            if mtime > latest[parent]:
+                latest[parent] = mtime
+            size[parent] += file_size
+            nsubfiles[parent] += 1
+
+    def _numpy_arrays(self):
+        """
+        :returns: NumPy views of the parent, latest, size, nsubfiles, nsubnodes, and flags arrays.
+                  The views share memory with the arrays, so the tree cannot grow while they exist.
+        :rtype: tuple
+        """
+        int_type = numpy.dtype('i%i' % self.parent.itemsize)
+        return (numpy.frombuffer(self.parent, dtype=int_type),
+                numpy.frombuffer(self.latest, dtype=numpy.float64),
+                numpy.frombuffer(self.size, dtype=int_type),
+                numpy.frombuffer(self.nsubfiles, dtype=int_type),
+                numpy.frombuffer(self.nsubnodes, dtype=int_type),
+                numpy.frombuffer(self.flags, dtype=numpy.uint8))
+
+    def aggregate(self, now, min_age):
+        """
+        Sums the subtree totals into every directory
+        and determines which directories can be deleted.
+        A directory can be deleted if it is not protected, is not above a protected directory,
+        all of its subdirectories can be deleted, and nothing in it is newer than *min_age*.
+        This is only done once for each tree.
+        :py:meth:`update_flags` can then be used to check the ages at a later time.
+
+        :param int now: The time that ages are measured from
+        :param int min_age: The minimum age, in seconds, of a directory that can be deleted
+        """
+
+        if numpy is not None and len(self) >= NUMPY_MIN_NODES:
+            self._aggregate_numpy()
+
+        else:
+            latest = self.latest
+            size = self.size
+            nsubfiles = self.nsubfiles
+            nsubnodes = self.nsubnodes
+            flags = self.flags
+            parent = self.parent
+
+            # Subdirectories always have larger indices than their parents
+            for index in range(len(parent) - 1, 0, -1):
+                up_index = parent[index]
+
+                # Add one to include the subnode in the loop
+                nsubnodes[up_index] += nsubnodes[index] + 1
+                nsubfiles[up_index] += nsubfiles[index]
+                size[up_index] += size[index]
+                if latest[index] > latest[up_index]:
+                    latest[up_index] = latest[index]
+                if flags[index] & KEPT:
+                    flags[up_index] |= PROTECTED_BELOW
+
+        self.update_flags(now, min_age)
+
+    def update_flags(self, now, min_age):
+        """
+        Determines which directories of an aggregated tree can be deleted.
+        Since the latest modification time of a directory includes everything below it,
+        a directory is old enough if its own latest time is.
+
+        :param int now: The time that ages are measured from
+        :param int min_age: The minimum age, in seconds, of a directory that can be deleted
+        """
+
+        if numpy is not None and len(self) >= NUMPY_MIN_NODES:
+            latest, flags = self._numpy_arrays()[1::4]
+            vanish = ((flags & KEPT) == 0) & (now - latest >= min_age)
+            flags &= ~VANISH & 0xff
+            flags[vanish] |= VANISH
+            return
+
+        latest = self.latest
+        flags = self.flags
+        for index, flag in enumerate(flags):
+            flag &= ~VANISH
+            if not flag & KEPT and now - latest[index] >= min_age:
+                flag |= VANISH
+            flags[index] = flag
+
+    def _aggregate_numpy(self):
+        """
+        Does the summing of :py:meth:`aggregate`, but one level of the tree at a time,
+        starting from the deepest, using NumPy reductions.
+        """
+
+        parent, latest, size, nsubfiles, nsubnodes, flags = self._numpy_arrays()
+
+        # Find the depth of every directory by following the parents up together
+        depth = numpy.zeros(len(parent), dtype=numpy.int64)
+        above = parent.copy()
+        active = above >= 0
+        while active.any():
+            depth[active] += 1
+            above[active] = parent[above[active]]
+            active &= above >= 0
+
+        order = numpy.argsort(depth, kind='stable')
+        bounds = numpy.searchsorted(depth[order], numpy.arange(depth.max() + 2))
+
+        for level in range(len(bounds) - 2, 0, -1):
+            nodes = order[bounds[level]:bounds[level + 1]]
+            up_nodes = parent[nodes]
+
+            # Add one to include the subnode in the loop
+            numpy.add.at(nsubnodes, up_nodes, nsubnodes[nodes] + 1)
+            numpy.add.at(nsubfiles, up_nodes, nsubfiles[nodes])
+            numpy.add.at(size, up_nodes, size[nodes])
+            numpy.maximum.at(latest, up_nodes, latest[nodes])
+            flags[up_nodes[(flags[nodes] & KEPT) != 0]] |= PROTECTED_BELOW
+
+    def deletable(self, index=0):
+        """
+        Finds the highest directories that can be deleted, in the order of a depth-first walk.
+
+        :param int index: The directory to start searching from
+        :returns: Indices of the directories that can be deleted
+        :rtype: generator
+        """
+        pending = [index]
+        while pending:
+            index = pending.pop()
+            if self.flags[index] & VANISH:
+                yield index
+            else:
+                pending.extend(reversed(self.children(index)))
+
+
+class TreeBuilder(object):
+    """
+    Collects directories and files that come in any order, like the entries of a
+    metadata dump, and builds a :py:class:`NamespaceTree` for each top level directory.
+    Each file is summed into the directory directly containing it when it is added,
+    and directories are only known by their name and the id of their parent,
+    so memory grows with the number of directories, not with the number of files
+    or the length of their paths.
+    """
+
+    def __init__(self):
+        # The id of each directory, by the id of its parent and its name
+        self._dir_ids = {}
+        self._names = ['']
+        self._subdirs = [[]]
+        self._dir_mtime = array('d', [0])
+        self._latest = array('d', [0])
+        self._size = array(INT_TYPE, [0])
+        self._nfiles = array(INT_TYPE, [0])
+        self._tops = []
+        # Entries usually come grouped by directory, so the last one looked up is kept
+        self._last = ('', 0)
+
+    def _dir_id(self, path):
+        """
+        :param str path: The path of a directory, relative to the top of the dump
+        :returns: The id of the directory, making it and its parents if needed
+        :rtype: int
+        """
+        if path == self._last[0]:
+            return self._last[1]
+
+        dir_id = 0
+        for name in path.split('/'):
+            if not name:
+                continue
+            key = '%i/%s' % (dir_id, name)
+            sub_id = self._dir_ids.get(key)
+            if sub_id is None:
+                sub_id = len(self._names)
+                self._dir_ids[key] = sub_id
+                self._names.append(name)
+                self._subdirs.append([])
+                self._subdirs[dir_id].append(sub_id)
+                for values in (self._dir_mtime, self._latest, self._size, self._nfiles):
+                    values.append(0)
+                if dir_id == 0:
+                    self._tops.append(sub_id)
+            dir_id = sub_id
+
+        self._last = (path, dir_id)
+        return dir_id
+
+    def add(self, path, is_dir, mtime, size):
+        """
+        Adds a directory or file. Directories above it are made if they have not been added yet.
+
+        :param str path: The path, relative to the top of the dump
+        :param bool is_dir: If True, this is a directory
+        :param float mtime: The modification time
+        :param int size: The size of a file
+        """
+        if is_dir:
+            self._dir_mtime[self._dir_id(path)] = mtime
+            return
+
+        dir_id = self._dir_id(os.path.dirname(path))
+        if mtime > self._latest[dir_id]:
+            self._latest[dir_id] = mtime
+        self._size[dir_id] += size
+        self._nfiles[dir_id] += 1
+
+    def top_dirs(self):
+        """
+        :returns: The names of the top level directories
+        :rtype: list
+        """
+        return [self._names[dir_id] for dir_id in self._tops]
+
+    def build_tops(self, classify, avoid=(), metrics=None):
+        """
+        Builds the tree of every top level directory, in the order of their names.
+
+        :param function classify: Gives the flags of a directory, like for :py:meth:`build`
+        :param avoid: The names of top level directories that are not built
+        :type avoid: list
+        :param metrics.Metrics metrics: If given, gets the progress through the directories
+        :returns: The name and the tree, which is not aggregated yet, of each directory
+        :rtype: generator
+        """
+        top_dirs = sorted(self.top_dirs())
+        for num, top_name in enumerate(top_dirs):
+            if metrics is not None:
+                metrics.set_progress(float(num) / len(top_dirs), top_name)
+            if top_name not in avoid:
+                yield top_name, self.build(top_name, classify)
+
+    def build(self, top_name, classify):
+        """
+        Builds the tree of one top level directory.
+        Like a directory walk, an empty directory has its own modification time as its latest time.
+        The tree is not aggregated yet.
+
+        :param str top_name: The name of the top level directory
+        :param function classify: Takes the path of a directory, relative to the top of the dump,
+                                  and returns the flags to set for it.
+                                  If it returns None, the directory is :py:data:`PROTECTED`
+                                  and nothing inside of it is added.
+        :returns: The tree of the directory
+        :rtype: NamespaceTree
+        """
+
+        tree = NamespaceTree(top_name)
+
+        pending = [(self._dir_ids['0/%s' % top_name], 0, top_name)]
+        while pending:
+            dir_id, index, path = pending.pop()
+            flags = classify(path)
+            if flags is None:
+                tree.set_files(index, 0, 0, 0, PROTECTED)
+                continue
+
+            subdirs = self._subdirs[dir_id]
+            nfiles = self._nfiles[dir_id]
+            latest = self._latest[dir_id] if subdirs or nfiles else self._dir_mtime[dir_id]
+            tree.set_files(index, latest, self._size[dir_id], nfiles, flags)
+
+            first = tree.add_children(index, [self._names[sub_id] for sub_id in subdirs])
+            pending.extend((sub_id, first + num, os.path.join(path, self._names[sub_id]))
+                           for num, sub_id in enumerate(subdirs))
+
+        return tree
+
+
+class TreeNode(object):
+    """
+    A view of one directory in a :py:class:`NamespaceTree`.
+    The nodes of the subdirectories are made when they are accessed.
+    Before a tree is set, the node is an empty directory.
+    """
+
+    def __init__(self, path_name, tree=None, index=0):
+        """
+        Initializes the node.
+        :param str path_name: is the path to the directory that defines this node
+        :param NamespaceTree tree: is the filled tree this node is part of, if any
+        :param int index: is the index of this node's directory inside of *tree*
+        """
+        self._path_name = path_name
+        self.tree = tree
+        self.index = index
+
+    @property
+    def path_name(self):
+        """The path to the directory, relative to the unmerged location"""
+        if self._path_name is None:
+            self._path_name = self.tree.path(self.index)
+        return self._path_name
+
+    @property
+    def sub_nodes(self):
+        """The nodes of the subdirectories, of the same class as this node"""
+        if self.tree is None:
+            return []
+        return [type(self)(None, self.tree, child) for child in self.tree.children(self.index)]
+
+    @property
+    def can_vanish(self):
+        """Whether or not this directory can be deleted. None before filling."""
+        return None if self.tree is None else self.tree.can_vanish(self.index)
+
+    @property
+    def latest(self):
+        """The latest modification time inside of the directory"""
+        return 0 if self.tree is None else self.tree.latest[self.index]
+
+    @property
+    def nsubnodes(self):
+        """The number of directories inside of the directory"""
+        return 0 if self.tree is None else self.tree.nsubnodes[self.index]
+
+    @property
+    def nsubfiles(self):
+        """The number of files inside of the directory"""
+        return 0 if self.tree is None else self.tree.nsubfiles[self.index]
+
+    @property
+    def size(self):
+        """The total size of the files inside of the directory"""
+        return 0 if self.tree is None else self.tree.size[self.index]
+
+    def traverse_tree(self, list_to_del):
+        """
+        Searches the tree for directories that can be deleted
+        and appends them to a list of directories to delete.
+
+        :param list list_to_del: is a list of directories that
+                                can be deleted by a cleaner.
+        """
+
+        if self.tree is not None:
+            list_to_del.extend(type(self)(None, self.tree, index)
+                               for index in self.tree.deletable(self.index))
+
+
+class TreeFiller(object):
+    """
+    Fills a :py:class:`NamespaceTree` by listing every directory under its top.
+    Protected directories are not listed.
+    With a cache, directories that have not changed since they were cached are not listed again.
+    """
+
+    def __init__(self, list_dir, get_mtime, classify, metrics, cache=None):
+        """
+        :param function list_dir: Takes the path of a directory, relative to the unmerged
+                                  location, and returns its subdirectories and the
+                                  ``(name, mtime, size)`` of its files
+        :param function get_mtime: Takes the path of a directory, relative to the unmerged
+                                   location, and returns its modification time
+        :param function classify: Takes the path of a directory and returns the flags to set,
+                                  or None if it is protected, like for :py:meth:`TreeBuilder.build`
+        :param metrics.Metrics metrics: Counts the directories and files listed
+        :param scancache.ScanCache cache: If given, gives the listings of unchanged directories.
+                                          This can also be a
+                                          :py:class:`residentscan.WatchedListings`.
+        """
+        self.list_dir = list_dir
+        self.get_mtime = get_mtime
+        self.classify = classify
+        self.metrics = metrics
+        self.cache = cache
+
+    def fill(self, path_name, threads=1):
+        """
+        :param str path_name: The path of the top directory
+        :param int threads: The number of threads listing directories
+        :returns: The tree, which is not aggregated yet
+        :rtype: NamespaceTree
+        """
+
+        tree = NamespaceTree(path_name)
+        walk_tree((0, path_name), lambda node: self.list_node(tree, node), threads)
+        return tree
+
+    def list_node(self, tree, node):
+        """
+        Lists a single directory in the tree.
+
+        :param NamespaceTree tree: The tree being filled
+        :param tuple node: The index and path of the directory
+        :returns: The index and path of each subdirectory to list
+        :rtype: list
+        """
+
+        index, path_name = node
+        flags = self.classify(path_name)
+
+        # If protected, cannot delete this directory, and stop filling
+        if flags is None:
+            tree.set_files(index, 0, 0, 0, PROTECTED)
+            return []
+
+        cached = None
+        dir_mtime = None
+        if self.cache is not None:
+            if getattr(self.cache, 'check_mtime', True):
+                dir_mtime = self.get_mtime(path_name)
+            cached = self.cache.get(path_name, dir_mtime)
+
+        if cached is not None:
+            latest, size, nfiles, dirs = cached
+
+        else:
+            dirs, all_files = self.list_dir(path_name)
+            nfiles = len(all_files)
+
+            # Get the latest modification start for all files
+            latest = 0
+            size = 0
+            for _, modtime, file_size in all_files:
+                size += file_size
+                if modtime > latest:
+                    latest = modtime
+
+            if not dirs and not all_files:
+                # Check that this time function works for your system as well
+                latest = dir_mtime if dir_mtime is not None else self.get_mtime(path_name)
+
+            if self.cache is not None:
+                self.cache.put(path_name, dir_mtime, latest, size, nfiles, dirs)
+
+        tree.set_files(index, latest, size, nfiles, flags)
+        self.metrics.add(1, nfiles, size)
+
+        first = tree.add_children(index, dirs)
+        return [(first + num, os.path.join(path_name, subdir))
+                for num, subdir in enumerate(dirs)]
+
+
+def walk_tree(top_node, list_node, threads=1):
+    """
+    Walks a tree by calling *list_node* on *top_node*, and then on each node
+    returned by a previous call, until no nodes are left.
+    With more than one thread, the listings are done concurrently by a pool of worker threads,
+    so the time spent waiting on storage is divided by the number of threads.
+
+    :param tuple top_node: The node to start the walk from,
+                           like the index and path used by :py:class:`TreeFiller`
+    :param function list_node: Takes a node and returns a list of its children to walk
+    :param int threads: The number of threads doing listings
+    :raises Exception: The first exception raised by *list_node*, after the workers stop
+    """
+
+    if threads <= 1:
+        pending = [top_node]
+        while pending:
+            pending.extend(list_node(pending.pop()))
+
+        return
+
+    errors = _walk_threaded(top_node, list_node, threads)
+    if errors:
+        raise errors[0]
+
+
+def _walk_threaded(top_node, list_node, threads):
+    """
+    Walks a tree with a pool of worker threads, and waits for the workers to stop.
+
+    :param tuple top_node: The node to start the walk from
+    :param function list_node: Takes a node and returns a list of its children to walk
+    :param int threads: The number of threads doing listings
+    :returns: The exceptions raised by *list_node*
+    :rtype: list
+    """
+
+    tasks = Queue()
+    errors = []
+
+    workers = [threading.Thread(target=_walk_worker, args=(tasks, list_node, errors))
+               for _ in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    tasks.put(top_node)
+    tasks.join()
+
+    for thread in workers:
+        tasks.put(None)
+    for thread in workers:
+        thread.join()
+
+    return errors
+
+
+def _walk_worker(tasks, list_node, errors):
+    """
+    Lists nodes from the queue until a None is received.
+    After an error, the queue is drained without listing anything else.
+
+    :param Queue tasks: The nodes to list, which gets the children of each node
+    :param function list_node: Takes a node and returns a list of its children to walk
+    :param list errors: Gets the exceptions raised by *list_node*
+    """
+
+    while True:
+        node = tasks.get()
+        try:
+            if node is None:
+                return
+            if not errors:
+                for child in list_node(node):
+                    tasks.put(child)
+        except Exception:     # pylint: disable=broad-except
+            errors.append(sys.exc_info()[1])
+        finally:
+            tasks.task_done()
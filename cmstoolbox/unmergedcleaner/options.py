@@ -0,0 +1,91 @@
+"""
+This module holds the command line options of ``ListDeletable.py``
+for the :ref:`unmerged-ref`.
+"""
+
+from optparse import OptionParser
+
+
+def make_parser():
+    """
+    :returns: The parser of the command line options
+    :rtype: optparse.OptionParser
+    """
+
+    parser = OptionParser('Usage: ./%prog [options]\n\n'
+                          '  This script can list and delete directories over the course of\n'
+                          '  multiple runs. The first time is it run, it generates a file,\n'
+                          '  config.py. Edit config.py so that it points to the correct LFN and\n'
+                          '  PFN names, along with targets the proper storage type. The second\n'
+                          '  time it runs, this script creates a list of directories to delete.\n'
+                          '  These directories can then be deleted with this script by passing\n'
+                          '  the --delete flag.\n\n'
+                          ' See http://cms-comp-ops-tools.readthedocs.io/en/latest/'
+                          'siteadmintoolkit.html#module-ListDeletable for more details.')
+
+    parser.add_option('--delete', action='store_true', dest='do_delete',
+                      help=('This flag cause the script to operate in deletion mode. '
+                            'The script has to create the deletion file before this mode '
+                            'can be activated so that the site admin can take a look by '
+                            'hand at the deletion list.'))
+
+    parser.add_option('--full-scan', action='store_true', dest='full_scan',
+                      help=('List every directory again, instead of using the scan cache '
+                            'for directories that have not changed since the last scan.'))
+
+    parser.add_option('--resume', action='store_true', dest='resume',
+                      help=('Continue a directory scan that stopped part of the way through. '
+                            'Top level directories that were already listed are not listed again, '
+                            'unless the protected list or configuration changed.'))
+
+    parser.add_option('--shard', metavar='INDEX/COUNT', dest='shard',
+                      help=('Only list the top level directories in one of COUNT shards, '
+                            'starting from 0/COUNT, so that several nodes can scan at once. '
+                            'The results are written next to the deletion file '
+                            'for --merge instead of to the deletion file.'))
+
+    parser.add_option('--merge', metavar='COUNT', dest='merge', type='int',
+                      help=('Write the deletion file from the results of COUNT shards. '
+                            'The results of every shard must be next to the deletion file.'))
+
+    parser.add_option('--now', metavar='SECONDS', dest='now', type='int',
+                      help=('Measure ages from this time, in seconds since the epoch, '
+                            'instead of from the start of the scan. '
+                            'Give every shard the same time.'))
+
+    parser.add_option('--fsimage', metavar='FILE', dest='fsimage',
+                      help=('Read the unmerged directory from the output of '
+                            '"hdfs oiv -p Delimited" or "hdfs oiv -p XML" '
+                            'instead of listing it. The NameNode is not contacted.'))
+
+    parser.add_option('--dump', metavar='FILE', dest='dump',
+                      help=('Read the unmerged directory from a namespace dump of the storage '
+                            'instead of listing it. The format is set by DUMP_FORMAT '
+                            'and DUMP_COLUMNS.'))
+
+    parser.add_option('--estimate', action='store_true', dest='estimate',
+                      help=('Quickly estimate how much a scan would delete, with confidence '
+                            'intervals, by listing a random sample of the unmerged directory. '
+                            'See ESTIMATE_FRACTION. No deletion file is written.'))
+
+    parser.add_option('--report', action='store_true', dest='report',
+                      help=('Print the workflows with the most space to free, from the '
+                            'MANIFEST_FILE written with the deletion file. '
+                            'The storage is not contacted.'))
+
+    parser.add_option('--report-depth', metavar='LEVELS', dest='report_depth', type='int',
+                      default=4,
+                      help=('The number of directory levels under the unmerged location '
+                            'that --report groups by. The default is 4, which is a workflow.'))
+
+    parser.add_option('--report-limit', metavar='NUM', dest='report_limit', type='int',
+                      default=20,
+                      help='The number of groups printed by --report. The default is 20.')
+
+    parser.add_option('--daemon', action='store_true', dest='daemon',
+                      help=('Keep running and watch the unmerged directory for changes. '
+                            'A new deletion file is written on SIGUSR1, '
+                            'when "write" is sent to DAEMON_SOCKET, '
+                            'and every DAEMON_RESCAN_TIME seconds.'))
+
+    return parser
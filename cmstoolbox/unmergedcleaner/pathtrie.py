@@ -0,0 +1,81 @@
+"""
+This module holds the index of protected paths used by the :ref:`unmerged-ref`.
+The paths are stored in a trie of path components, so checking a path
+takes one dictionary lookup per directory level, no matter how many paths are protected.
+"""
+
+
+PROTECTED = 'protected'
+"""Returned by :py:meth:`PathTrie.lookup` for a path that is in the trie."""
+
+INSIDE = 'inside'
+"""Returned by :py:meth:`PathTrie.lookup` for a path below a path that is in the trie."""
+
+ANCESTOR = 'ancestor'
+"""Returned by :py:meth:`PathTrie.lookup` for a path above a path that is in the trie."""
+
+_END = None
+"""Key marking the end of a path in a trie node. Path components are never None."""
+
+
+def split_path(path):
+    """
+    :param str path: A path
+    :returns: The components of the path, ignoring repeated and trailing slashes
+    :rtype: list
+    """
+    return [part for part in path.split('/') if part]
+
+
+class PathTrie(object):
+    """
+    A set of paths that can be checked for exact matches, ancestors, and descendants.
+    """
+
+    def __init__(self, paths=()):
+        """
+        :param list paths: The initial paths in the trie
+        """
+        self._root = {}
+        self._size = 0
+        for path in paths:
+            self.add(path)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, path):
+        """
+        :param str path: A path to add to the trie
+        """
+        node = self._root
+        for part in split_path(path):
+            node = node.setdefault(part, {})
+
+        if _END not in node:
+            node[_END] = True
+            self._size += 1
+
+    def lookup(self, path):
+        """
+        Checks the relation of a path to the paths in the trie.
+        A path below another path in the trie is :py:data:`INSIDE`,
+        even if it is in the trie itself.
+
+        :param str path: The path to check
+        :returns: :py:data:`PROTECTED`, :py:data:`INSIDE`, :py:data:`ANCESTOR`, or None
+                  if the path is not related to anything in the trie
+        :rtype: str
+        """
+        node = self._root
+        for part in split_path(path):
+            if _END in node:
+                return INSIDE
+            node = node.get(part)
+            if node is None:
+                return None
+
+        if _END in node:
+            return PROTECTED
+
+        return ANCESTOR if node else None
@@ -0,0 +1,319 @@
+"""
+This module keeps the directory listings of the :ref:`unmerged-ref` in memory
+for a long-lived process, like the one started by ``listdeletable.py --daemon``.
+On Linux, every listed directory is watched with inotify.
+A listing is reused until an event shows that something in its directory changed.
+Directories that cannot be watched, for example because the inotify watch limit
+(``/proc/sys/fs/inotify/max_user_watches``) is reached, are listed again
+after their listing is older than a set time.
+
+:py:class:`WatchedListings` can be passed as the cache to
+:py:meth:`cmstoolbox.unmergedcleaner.listdeletable.DataNode.fill`.
+"""
+
+import os
+import sys
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+"""The events that make a directory listing out of date."""
+
+_EVENT = struct.Struct('iIII')
+
+
+def _encode(path):
+    """
+    :param str path: A path
+    :returns: The path as bytes for the C library
+    :rtype: bytes
+    """
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding())
+
+
+def _decode(name):
+    """
+    :param bytes name: A file name from an event
+    :returns: The name as the same type that ``os.listdir`` returns for a ``str`` path
+    :rtype: str
+    """
+    if isinstance(name, str):
+        return name
+    return name.decode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+class Inotify(object):
+    """
+    A minimal inotify instance, using the C library through :py:mod:`ctypes`.
+    """
+
+    def __init__(self):
+        """
+        :raises OSError: If inotify is not available on this system
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this system')
+
+        self._libc = libc
+        self.inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not start inotify')
+
+    def fileno(self):
+        """
+        :returns: The file descriptor to wait on for events
+        :rtype: int
+        """
+        return self.inotify_fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        :param str path: The directory to watch
+        :param int mask: The events to watch for
+        :returns: The watch descriptor
+        :rtype: int
+        :raises OSError: If the watch cannot be added
+        """
+        watch_desc = self._libc.inotify_add_watch(self.inotify_fd, _encode(path), mask)
+        if watch_desc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return watch_desc
+
+    def rm_watch(self, watch_desc):
+        """
+        :param int watch_desc: The watch descriptor to remove
+        """
+        self._libc.inotify_rm_watch(self.inotify_fd, watch_desc)
+
+    def read(self):
+        """
+        Reads all of the events that are waiting, without blocking.
+
+        :returns: Tuples of the watch descriptor, event mask, and the name of the
+                  entry in the watched directory (empty for events on the directory itself)
+        :rtype: list
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 65536)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+
+            offset = 0
+            while offset < len(data):
+                watch_desc, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((watch_desc, mask, _decode(name)))
+
+    def close(self):
+        """Closes the inotify instance and removes all of its watches"""
+        os.close(self.inotify_fd)
+
+
+class WatchedListings(object):
+    """
+    A cache of directory listings that stays current through inotify.
+    It has the same interface as :py:class:`scancache.ScanCache`,
+    but does not need the modification time of the directory to be checked.
+    This can be used from multiple threads,
+    but :py:meth:`process_events` should not be called during a scan.
+    """
+
+    check_mtime = False
+
+    def __init__(self, location, rescan_time):
+        """
+        :param str location: The directory that the cached paths are relative to
+        :param int rescan_time: Listings of directories that cannot be watched
+                                are used for this many seconds
+        """
+        self.location = location
+        self.rescan_time = rescan_time
+        self.hits = 0
+        self.misses = 0
+
+        self._inotify = Inotify()
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._watch_paths = {}
+        self._path_watches = {}
+        self._unwatched = set()
+        self._dirty_tops = set()
+
+    def fileno(self):
+        """
+        :returns: The file descriptor to wait on before calling :py:meth:`process_events`
+        :rtype: int
+        """
+        return self._inotify.fileno()
+
+    def get(self, path, mtime=None):                # pylint: disable=unused-argument
+        """
+        Gets a listing, and starts watching the directory if it is not cached.
+
+        :param str path: The path of the directory
+        :param float mtime: Not used
+        :returns: The latest modification time, total size, and number of files
+                  directly inside of the directory, and the list of subdirectories.
+                  If the directory is not cached or has changed, None is returned.
+        :rtype: tuple
+        """
+        with self._lock:
+            listing = self._listings.get(path)
+            if listing is not None and (path not in self._unwatched or
+                                        time.time() - listing[4] < self.rescan_time):
+                self.hits += 1
+                return listing[:4]
+
+            self.misses += 1
+            if path not in self._path_watches and path not in self._unwatched:
+                self._watch(path)
+
+        return None
+
+    def put(self, path, mtime, latest, size, nfiles, subdirs):  # pylint: disable=unused-argument
+        """
+        Stores the listing of a directory.
+
+        :param str path: The path of the directory
+        :param float mtime: Not used
+        :param float latest: The latest modification time of the files directly inside the directory
+        :param int size: The total size of those files
+        :param int nfiles: The number of those files
+        :param list subdirs: The names of the subdirectories
+        """
+        with self._lock:
+            self._listings[path] = (latest, size, nfiles, list(subdirs), time.time())
+
+    def _watch(self, path):
+        """Starts watching a directory. Must hold the lock."""
+        try:
+            watch_desc = self._inotify.add_watch(os.path.join(self.location, path))
+        except OSError as err:
+            LOG.warning('Cannot watch %s (%s). It will be listed again every %i seconds.',
+                        path, err.strerror, self.rescan_time)
+            self._unwatched.add(path)
+            return
+
+        self._watch_paths[watch_desc] = path
+        self._path_watches[path] = watch_desc
+
+    def _invalidate(self, path):
+        """Drops the listing of a single directory. Must hold the lock."""
+        self._listings.pop(path, None)
+        self._dirty_tops.add(path.split('/')[0])
+
+    def _forget(self, path):
+        """
+        Drops the listings and watches of a directory and everything below it.
+        This is needed when a directory is moved, since watches follow directories
+        to their new location. Must hold the lock.
+        """
+        prefix = path + '/'
+        for other in [other for other in self._listings
+                      if other == path or other.startswith(prefix)]:
+            self._invalidate(other)
+
+        for other in [other for other in self._path_watches
+                      if other == path or other.startswith(prefix)]:
+            watch_desc = self._path_watches.pop(other)
+            del self._watch_paths[watch_desc]
+            self._inotify.rm_watch(watch_desc)
+
+        self._unwatched = set(other for other in self._unwatched
+                              if other != path and not other.startswith(prefix))
+
+    def process_events(self):
+        """
+        Reads the waiting inotify events and drops the listings that are out of date.
+
+        :returns: The number of events read
+        :rtype: int
+        """
+
+        events = self._inotify.read()
+
+        with self._lock:
+            for watch_desc, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    LOG.warning('Too many inotify events at once. Listing everything again.')
+                    for path in list(self._listings):
+                        self._invalidate(path)
+                    continue
+
+                path = self._watch_paths.get(watch_desc)
+                if path is None:
+                    continue
+
+                if mask & IN_IGNORED:
+                    # The kernel removed the watch, usually because the directory is gone
+                    del self._watch_paths[watch_desc]
+                    del self._path_watches[path]
+                    self._invalidate(path)
+                    continue
+
+                self._invalidate(path)
+
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self._forget(path)
+                elif mask & IN_ISDIR and mask & (IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+                    self._forget(os.path.join(path, name))
+
+        return len(events)
+
+    def take_dirty(self):
+        """
+        :returns: The top level directories with changes since the last call,
+                  and the ones with listings of unwatched directories that are too old
+        :rtype: set
+        """
+        with self._lock:
+            dirty = self._dirty_tops
+            self._dirty_tops = set()
+
+            now = time.time()
+            for path in self._unwatched:
+                listing = self._listings.get(path)
+                if listing is None or now - listing[4] >= self.rescan_time:
+                    dirty.add(path.split('/')[0])
+
+        return dirty
+
+    def close(self):
+        """Stops watching everything"""
+        self._inotify.close()
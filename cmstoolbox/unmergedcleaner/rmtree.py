@@ -0,0 +1,303 @@
+"""
+This module removes directory trees for the :ref:`unmerged-ref` on POSIX storage.
+Each directory is opened once and everything inside it is listed, unlinked,
+and removed relative to that open directory, so no full path is looked up more than once.
+On network filesystems, this saves a lookup of every parent directory for each entry.
+The entries of large directories can be unlinked by several threads at the same time.
+Directories are only held open for reading while they are listed.
+The ones with subdirectories left to remove are held by ``O_PATH`` where there is one.
+Files are not looked up before they are unlinked, unless their sizes are asked for.
+
+Directories are opened with ``O_NOFOLLOW`` and checked against the entry that was listed,
+so a directory that is replaced by a symbolic link during the walk is never followed.
+The link itself is removed instead.
+
+Python versions without ``dir_fd`` support (including Python 2) fall back to
+walking the tree by path, which does not protect against links swapped in during the walk.
+"""
+
+import os
+import stat
+import errno
+
+from multiprocessing.pool import ThreadPool
+
+
+PARALLEL_UNLINK_MIN = 64
+"""Directories with at least this many files are unlinked by the thread pool, if there is one."""
+
+HAS_FD_FUNCTIONS = bool(
+    getattr(os, 'supports_dir_fd', None) and
+    os.unlink in os.supports_dir_fd and os.rmdir in os.supports_dir_fd and
+    os.open in os.supports_dir_fd and os.scandir in os.supports_fd)
+"""If directory trees can be removed through file descriptors here."""
+
+HAS_O_PATH = hasattr(os, 'O_PATH')
+"""If directories can be held open without reading them."""
+
+
+class RemovalCounts(object):
+    """
+    Counts what was removed from one tree.
+    """
+
+    def __init__(self, path, sizes=True):
+        """
+        :param str path: The top of the tree
+        :param bool sizes: If the bytes in the files are counted.
+                           If not, :py:attr:`bytes` is None.
+        """
+        self.path = path
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0 if sizes else None
+
+    def __repr__(self):
+        return '<RemovalCounts %s: %i files, %i directories, %s bytes>' % \
+            (self.path, self.files, self.dirs, self.bytes)
+
+    def add_files(self, sizes):
+        """
+        :param list sizes: The size of each file that was unlinked,
+                           or None for each file that was already gone
+        """
+        for size in sizes:
+            if size is not None:
+                self.files += 1
+                if self.bytes is not None:
+                    self.bytes += size
+
+
+def _ignore_missing(func, *args, **kwargs):
+    """
+    Calls a function, ignoring errors for things that were removed by someone else.
+
+    :returns: False if the thing was already gone
+    :rtype: bool
+    """
+    try:
+        func(*args, **kwargs)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return False
+
+    return True
+
+
+def _open_dir(name, dir_fd):
+    """
+    :param str name: The name of a directory
+    :param int dir_fd: The open parent directory
+    :returns: The open directory, or None if it is not a directory any more
+    :rtype: int
+    """
+
+    try:
+        before = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+        if not stat.S_ISDIR(before.st_mode):
+            return None
+        sub_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=dir_fd)
+    except OSError as err:
+        # ELOOP or ENOTDIR if a link was swapped in, or ENOENT if it is gone
+        if err.errno in (errno.ELOOP, errno.ENOTDIR, errno.ENOENT):
+            return None
+        raise
+
+    if not os.path.samestat(before, os.fstat(sub_fd)):
+        os.close(sub_fd)
+        return None
+
+    return sub_fd
+
+
+def _unlink(name, dir_fd, sizes):
+    """
+    :param str name: The name of a file or link
+    :param int dir_fd: The open directory it is in
+    :param bool sizes: If the size is looked up before unlinking
+    :returns: The size, or zero if it is not looked up, or None if it was already gone
+    :rtype: int
+    """
+    size = 0
+    try:
+        if sizes:
+            size = os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_size
+        os.unlink(name, dir_fd=dir_fd)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+    return size
+
+
+def _clear_files(dir_fd, counts, pool):
+    """
+    Lists an open directory and unlinks everything in it that is not a directory.
+
+    :param int dir_fd: The open directory
+    :param RemovalCounts counts: Counts the removals
+    :param multiprocessing.pool.ThreadPool pool: If given, large directories are unlinked by this
+    :returns: The names of the subdirectories
+    :rtype: list
+    """
+
+    subdirs = []
+    files = []
+    for entry in os.scandir(dir_fd):
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.name)
+        else:
+            files.append(entry.name)
+
+    sizes = counts.bytes is not None
+    if pool is not None and len(files) >= PARALLEL_UNLINK_MIN:
+        counts.add_files(pool.map(lambda name: _unlink(name, dir_fd, sizes), files,
+                                  max(1, len(files) // 64)))
+    else:
+        counts.add_files([_unlink(name, dir_fd, sizes) for name in files])
+
+    return subdirs
+
+
+def _path_fd(dir_fd):
+    """
+    Replaces an open directory by an ``O_PATH`` descriptor, where there is one.
+    It is enough to remove the entries of the directory,
+    and holds less than a directory opened for reading.
+
+    :param int dir_fd: The open directory, which is closed if it is replaced
+    :returns: The descriptor to keep
+    :rtype: int
+    """
+    if not HAS_O_PATH:
+        return dir_fd
+
+    path_fd = os.open('.', os.O_PATH | os.O_DIRECTORY, dir_fd=dir_fd)
+    os.close(dir_fd)
+    return path_fd
+
+
+def _remove_contents(top_fd, counts, pool):
+    """
+    Removes everything inside an open directory.
+    The directories being removed are kept on a stack, instead of recursing,
+    and each directory is only held open for reading while it is listed.
+
+    :param int top_fd: The open directory, which is not closed
+    :param RemovalCounts counts: Counts the removals
+    :param multiprocessing.pool.ThreadPool pool: If given, large directories are unlinked by this
+    """
+
+    # The descriptor, name, and subdirectories left of each directory being removed
+    stack = [[top_fd, None, _clear_files(top_fd, counts, pool)]]
+    try:
+        while stack:
+            dir_fd, name, subdirs = stack[-1]
+            if not subdirs:
+                stack.pop()
+                if stack:
+                    os.close(dir_fd)
+                    if _ignore_missing(os.rmdir, name, dir_fd=stack[-1][0]):
+                        counts.dirs += 1
+                continue
+
+            name = subdirs.pop()
+            sub_fd = _open_dir(name, dir_fd)
+            if sub_fd is None:
+                # Not a directory any more, so only remove the link or file
+                counts.add_files([_unlink(name, dir_fd, counts.bytes is not None)])
+                continue
+
+            frame = [sub_fd, name, []]
+            stack.append(frame)
+            frame[2] = _clear_files(sub_fd, counts, pool)
+            if frame[2]:
+                frame[0] = _path_fd(sub_fd)
+
+    finally:
+        for dir_fd, _, _ in stack[1:]:
+            os.close(dir_fd)
+
+
+def _rmtree_by_path(path, counts):
+    """
+    Removes a tree by path, for systems without ``dir_fd`` support.
+
+    :param str path: The top of the tree
+    :param RemovalCounts counts: Counts the removals
+    """
+
+    for root, dirs, files in os.walk(path, topdown=False):
+        # Links to directories are listed with the directories, but removed like files
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+        for name in files + links:
+            full_path = os.path.join(root, name)
+            size = 0
+            if counts.bytes is not None:
+                try:
+                    size = os.lstat(full_path).st_size
+                except OSError:
+                    pass
+            counts.add_files([size if _ignore_missing(os.unlink, full_path) else None])
+        for name in dirs:
+            if name not in links and _ignore_missing(os.rmdir, os.path.join(root, name)):
+                counts.dirs += 1
+
+    if _ignore_missing(os.rmdir, path):
+        counts.dirs += 1
+
+
+def rmtree(path, pool=None, sizes=False):
+    """
+    Removes a directory and everything inside of it.
+
+    :param str path: The directory to remove
+    :param multiprocessing.pool.ThreadPool pool: If given, directories with at least
+                                                 :py:data:`PARALLEL_UNLINK_MIN` files
+                                                 are unlinked by the threads of this pool
+    :param bool sizes: If True, the size of each file is looked up before it is unlinked.
+                       This is one more call to the storage for each file.
+    :returns: The numbers of files and directories removed, including *path*,
+              and the bytes in the files if *sizes* is True
+    :rtype: RemovalCounts
+    :raises OSError: If *path* is a symbolic link or cannot be removed
+    """
+
+    counts = RemovalCounts(path, sizes)
+
+    if stat.S_ISLNK(os.lstat(path).st_mode):
+        raise OSError(errno.ELOOP, 'Refusing to remove a tree through a symbolic link', path)
+
+    if not HAS_FD_FUNCTIONS:
+        _rmtree_by_path(path, counts)
+        return counts
+
+    parent, name = os.path.split(os.path.abspath(path))
+    parent_fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        top_fd = _open_dir(name, parent_fd)
+        if top_fd is None:
+            raise OSError(errno.ENOTDIR, 'Not a directory', path)
+
+        try:
+            _remove_contents(top_fd, counts, pool)
+        finally:
+            os.close(top_fd)
+
+        os.rmdir(name, dir_fd=parent_fd)
+        counts.dirs += 1
+
+    finally:
+        os.close(parent_fd)
+
+    return counts
+
+
+def make_pool(threads):
+    """
+    :param int threads: The number of threads unlinking files
+    :returns: A pool for :py:func:`rmtree`, or None for a single thread
+    :rtype: multiprocessing.pool.ThreadPool
+    """
+    return ThreadPool(threads) if threads > 1 else None
@@ -0,0 +1,152 @@
+"""
+This module holds the scan cache used by the :ref:`unmerged-ref`.
+The cache is a SQLite file that stores what was found in each directory during the last scan:
+the directory modification time, the latest modification time, total size, and number
+of the files directly inside of it, and the names of its subdirectories.
+
+Adding, removing, or renaming an entry in a directory
+changes the modification time of the directory.
+If the modification time of a directory is the same during the next scan, the cached information
+is used instead of listing the directory and checking each of its files again.
+Only the modification time of the directory itself is checked.
+Files that are modified in place without being replaced are not noticed,
+which is fine for the unmerged area since files there are only written once.
+
+The cache only keeps directories seen by the last complete scan.
+If a scan does not finish, the cache from the previous scan stays as it was.
+A scan of one shard, or a scan resumed from a checkpoint, only sees part of the directories,
+so its results are added to the cache instead of replacing it.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+
+class ScanCache(object):
+    """
+    A cache of directory listings, keyed on the directory path and modification time.
+    This can be used from multiple threads.
+    """
+
+    check_mtime = True
+    """The modification time of each directory must be passed to :py:meth:`get`."""
+
+    def __init__(self, file_name, location, full_scan=False):
+        """
+        :param str file_name: The location of the SQLite file
+        :param str location: The location that the cached paths are relative to.
+                             If this is different than the location of the cached scan,
+                             the cached information is not used.
+        :param bool full_scan: If True, the cached information is not used,
+                               but the cache is still filled for the next scan
+        """
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        directory = os.path.dirname(file_name)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._conn = sqlite3.connect(file_name, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, '
+                           'latest REAL, size INTEGER, nfiles INTEGER, subdirs TEXT)')
+
+        # Results from this scan go into a new table until the scan is finished
+        self._conn.execute('DROP TABLE IF EXISTS new_dirs')
+        self._conn.execute('CREATE TABLE new_dirs (path TEXT PRIMARY KEY, mtime REAL, '
+                           'latest REAL, size INTEGER, nfiles INTEGER, subdirs TEXT)')
+
+        self._location = location
+        self._use_cached = not full_scan and self._same_location()
+
+    def _same_location(self):
+        """
+        :returns: If the cache is from a scan of the same location
+        :rtype: bool
+        """
+        cached_location = self._conn.execute(
+            'SELECT value FROM meta WHERE key = ?', ('location',)).fetchone()
+        return cached_location is not None and cached_location[0] == self._location
+
+    def get(self, path, mtime):
+        """
+        :param str path: The path of the directory
+        :param float mtime: The current modification time of the directory
+        :returns: The latest modification time, total size, and number of files
+                  directly inside of the directory, and the list of subdirectories.
+                  If the directory is not in the cache or has changed, None is returned.
+        :rtype: tuple
+        """
+
+        if not self._use_cached:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT mtime, latest, size, nfiles, subdirs FROM dirs WHERE path = ?',
+                (path,)).fetchone()
+
+            if row is None or row[0] != mtime:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute('INSERT OR REPLACE INTO new_dirs VALUES (?, ?, ?, ?, ?, ?)',
+                               (path,) + tuple(row))
+
+        # Directory names cannot contain '/'
+        return row[1], row[2], row[3], [name for name in row[4].split('/') if name]
+
+    def put(self, path, mtime, latest, size, nfiles, subdirs):
+        """
+        Stores the listing of a directory.
+        Directories modified within the last two seconds are not stored,
+        since another change within the same second would not change the modification time.
+
+        :param str path: The path of the directory
+        :param float mtime: The modification time of the directory
+        :param float latest: The latest modification time of the files directly inside the directory
+        :param int size: The total size of those files
+        :param int nfiles: The number of those files
+        :param list subdirs: The names of the subdirectories
+        """
+
+        if mtime >= time.time() - 2:
+            return
+
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO new_dirs VALUES (?, ?, ?, ?, ?, ?)',
+                               (path, mtime, latest, size, nfiles, '/'.join(subdirs)))
+
+    def close(self, completed=True, merge=False):
+        """
+        Closes the cache file.
+
+        :param bool completed: If True, the results of this scan replace the cache.
+                               Otherwise, they are thrown away.
+        :param bool merge: If True, the results of this scan only replace the directories
+                           that it listed, and the rest of the cache is kept.
+                           This is for scans that only see part of the directories.
+        """
+
+        with self._lock:
+            if completed and merge and self._same_location():
+                self._conn.execute('INSERT OR REPLACE INTO dirs SELECT * FROM new_dirs')
+                self._conn.execute('DROP TABLE new_dirs')
+            elif completed:
+                self._conn.execute('DROP TABLE dirs')
+                self._conn.execute('ALTER TABLE new_dirs RENAME TO dirs')
+                self._conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                   ('location', self._location))
+            else:
+                self._conn.execute('DROP TABLE new_dirs')
+
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,99 @@
+"""
+This module splits a directory scan of the :ref:`unmerged-ref` between several nodes,
+for ``ListDeletable.py --shard`` and ``ListDeletable.py --merge``.
+
+Each top level directory belongs to one shard, picked by the CRC-32 of its name.
+A shard writes the trees of its top level directories to a checkpoint next to the
+**DELETION_FILE**, named by :py:func:`shard_file`.
+See :py:mod:`cmstoolbox.unmergedcleaner.checkpoint`.
+The merge reads every shard with :py:func:`read_shards`, and only uses them if they all
+finished and were run with the same protected list and configuration.
+"""
+
+import os
+import zlib
+import logging
+
+from . import checkpoint
+
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_shard(text):
+    """
+    :param str text: A shard, like ``'2/8'`` for the third of eight shards
+    :returns: The index of the shard, starting from 0, and the number of shards
+    :rtype: tuple
+    :raises ValueError: If the text is not a shard
+    """
+
+    index, count = [int(part) for part in text.split('/')]
+    if not 0 <= index < count:
+        raise ValueError('The index must be from 0 to one less than the number of shards')
+
+    return index, count
+
+
+def in_shard(top_dir, shard):
+    """
+    Splits the top level directories between shards by the CRC-32 of their names,
+    which is the same on every node and every Python version.
+
+    :param str top_dir: The name of a top level directory
+    :param tuple shard: The index of a shard and the number of shards
+    :returns: If the directory is scanned by the shard
+    :rtype: bool
+    """
+
+    index, count = shard
+    return (zlib.crc32(top_dir.encode('utf-8')) & 0xffffffff) % count == index
+
+
+def shard_file(deletion_file, shard):
+    """
+    :param str deletion_file: The **DELETION_FILE**
+    :param tuple shard: The index of a shard and the number of shards
+    :returns: The file the shard writes its results to, next to the deletion file
+    :rtype: str
+    """
+    return '%s.shard-%i-of-%i' % ((deletion_file,) + tuple(shard))
+
+
+def read_shards(deletion_file, num_shards):
+    """
+    :param str deletion_file: The **DELETION_FILE** the shards are next to
+    :param int num_shards: The number of shards
+    :returns: The saved top level directories of every shard, sorted by name
+    :rtype: list
+    :raises ValueError: If a shard is missing, did not finish,
+                        or was run with a different protected list or configuration
+    """
+
+    headers = []
+    tops = []
+    for index in range(num_shards):
+        file_name = shard_file(deletion_file, (index, num_shards))
+        if not os.path.exists(file_name):
+            raise ValueError('Shard %i/%i has no results at %s' % (index, num_shards, file_name))
+
+        header, shard_tops = checkpoint.read_shard(file_name)
+        if header.get('shard') != [index, num_shards]:
+            raise ValueError('%s is for shard %s' % (file_name, header.get('shard')))
+
+        headers.append(header)
+        tops.extend(shard_tops)
+
+    if len(set(header['fingerprint'] for header in headers)) != 1:
+        raise ValueError('The shards were run with different protected lists or configurations')
+
+    if len(set(header['now'] for header in headers)) != 1:
+        LOG.warning('The shards measured ages from different times. '
+                    'Pass the same --now to every shard for the same result as one scan.')
+
+    names = [top.path_name for top in tops]
+    if len(set(names)) != len(names):
+        raise ValueError('A top level directory is in more than one shard')
+
+    LOG.info('Merging %i top level directories from %i shards', len(tops), num_shards)
+    return sorted(tops, key=lambda top: top.path_name)
@@ -0,0 +1,188 @@
+"""
+This module makes synthetic unmerged areas, for testing and benchmarking the :ref:`unmerged-ref`.
+
+A :py:class:`Layout` describes the tree: its depth, the number of subdirectories in each
+directory, the number of files in each directory at the bottom, how old those directories are,
+and how many of the directories at one level are protected.
+Like production, the levels are named like eras, datasets, data tiers, processing versions,
+and block numbers, and all of the files in one block directory have about the same age.
+
+:py:func:`generate` gives the tree as the same records read from namespace dumps,
+so it can fill a :py:class:`backends.MemoryBackend`, a :py:class:`namespacetree.TreeBuilder`,
+or be written to disk by :py:func:`materialize`.
+Files written to disk are sparse, so no data is written, and a tree of millions of files
+fits on a tmpfs.
+The same layout and seed always give the same tree.
+"""
+
+import os
+import random
+
+
+LEVEL_NAMES = ['Era%i', 'Dataset%i', 'TIER%i', 'v%i', '%05i']
+"""The names of the directories at each level. Deeper levels are named ``dir%i``."""
+
+DAY = 24 * 60 * 60
+
+
+class Layout(object):
+    """
+    The shape of a synthetic unmerged area.
+    """
+
+    def __init__(self, depth=5, fanout=4, files=20, ages=('exponential', 30 * DAY),
+                 protected_fraction=0.1, protected_level=2, file_size=2 ** 30, seed=0):
+        """
+        :param int depth: The number of directory levels
+        :param int fanout: The number of subdirectories in each directory above the bottom
+        :param int files: The number of files in each directory at the bottom
+        :param tuple ages: The distribution and mean, in seconds, of the ages of the
+                           directories at the bottom. The distribution is ``'exponential'``,
+                           or ``'uniform'`` from zero to twice the mean.
+        :param float protected_fraction: The fraction of the directories at *protected_level*
+                                         that are protected
+        :param int protected_level: The level of the protected directories, starting from 1
+        :param int file_size: The size of each file, in bytes
+        :param int seed: The seed of the random ages and protected directories
+        """
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.age_distribution, self.mean_age = ages
+        self.protected_fraction = protected_fraction
+        self.protected_level = min(protected_level, depth)
+        self.file_size = file_size
+        self.seed = seed
+
+    @classmethod
+    def with_entries(cls, entries, depth=5, files=20, **kwargs):
+        """
+        :param int entries: The number of directories and files wanted
+        :param int depth: The number of directory levels
+        :param int files: About the number of files in each directory at the bottom
+        :param kwargs: The rest of the arguments of :py:class:`Layout`
+        :returns: A layout with a fan-out chosen from *files*, and then the number of files
+                  that gives about *entries* directories and files with that fan-out
+        :rtype: Layout
+        """
+        fanout = max(2, int(round((float(entries) / (files + 1)) ** (1.0 / depth))))
+        layout = cls(depth=depth, fanout=fanout, files=files, **kwargs)
+        # The fan-out is rounded, so the files make up the difference
+        dirs = layout.counts()[0]
+        layout.files = max(1, int(round(float(entries - dirs) / fanout ** depth)))
+        return layout
+
+    def counts(self):
+        """
+        :returns: The numbers of directories and files in the tree
+        :rtype: tuple
+        """
+        dirs = sum(self.fanout ** level for level in range(1, self.depth + 1))
+        return dirs, self.fanout ** self.depth * self.files
+
+    def age(self, rand):
+        """
+        :param random.Random rand: The random numbers to use
+        :returns: The age of one directory at the bottom, in seconds
+        :rtype: float
+        """
+        if self.age_distribution == 'uniform':
+            return rand.uniform(0, 2 * self.mean_age)
+        if self.age_distribution == 'exponential':
+            return rand.expovariate(1.0 / self.mean_age)
+
+        raise ValueError('Unknown age distribution %s' % self.age_distribution)
+
+
+def level_name(level, index):
+    """
+    :param int level: The level of a directory, starting from 0
+    :param int index: The number of the directory in its parent
+    :returns: The name of the directory
+    :rtype: str
+    """
+    return (LEVEL_NAMES[level] if level < len(LEVEL_NAMES) else 'dir%i') % index
+
+
+def generate(layout, now, protected=None):
+    """
+    Gives the records of a synthetic tree.
+    Each directory comes after everything inside of it,
+    with the modification time of the newest thing inside.
+
+    :param Layout layout: The shape of the tree
+    :param float now: The time the ages are counted back from
+    :param list protected: If given, the paths of the protected directories are appended to this
+                           as the records are given
+    :returns: Tuples of the path relative to the top of the tree, whether it is a directory,
+              the modification time, and the size
+    :rtype: generator
+    """
+
+    rand = random.Random(layout.seed)
+
+    def walk(path, level):
+        """Gives the records inside a directory, and then the directory itself"""
+        if level == layout.depth:
+            block_time = now - layout.age(rand)
+            newest = block_time
+            for index in range(layout.files):
+                # Files in a block are written within an hour of each other
+                mtime = block_time - rand.uniform(0, 3600)
+                newest = mtime if index == 0 else max(newest, mtime)
+                yield (os.path.join(path, 'file_%i.root' % index), False, mtime, layout.file_size)
+            yield (path, True, newest, 0)
+            return
+
+        newest = 0
+        for index in range(layout.fanout):
+            sub_path = os.path.join(path, level_name(level, index))
+            # The draw is made even without a list, so the tree is the same either way
+            if level + 1 == layout.protected_level and \
+                    rand.random() < layout.protected_fraction and protected is not None:
+                protected.append(sub_path)
+
+            for record in walk(sub_path, level + 1):
+                if record[0] == sub_path:
+                    newest = max(newest, record[2])
+                yield record
+
+        if path:
+            yield (path, True, newest, 0)
+
+    return walk('', 0)
+
+
+def materialize(records, location):
+    """
+    Writes records to disk as a tree of sparse files.
+    The directories must come after everything inside of them,
+    like they do from :py:func:`generate`, so their modification times stay as given.
+
+    :param records: The tuples of the path, whether it is a directory,
+                    the modification time, and the size
+    :type records: iterable
+    :param str location: The top of the tree, which is made if needed
+    :returns: The numbers of directories and files written
+    :rtype: tuple
+    """
+
+    ndirs = 0
+    nfiles = 0
+    for path, is_dir, mtime, size in records:
+        full_path = os.path.join(location, path)
+        if is_dir:
+            if not os.path.isdir(full_path):
+                os.makedirs(full_path)
+            ndirs += 1
+        else:
+            parent = os.path.dirname(full_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            with open(full_path, 'wb') as output:
+                output.truncate(size)
+            nfiles += 1
+
+        os.utime(full_path, (mtime, mtime))
+
+    return ndirs, nfiles
@@ -0,0 +1,294 @@
+"""
+This module records the storage calls of the :ref:`unmerged-ref` and plays them back,
+so that changes to the scan can be measured against the latencies of a real site
+without touching its storage.
+
+When **TRACE_FILE** is set, the storage backend is wrapped in a :py:class:`TracingBackend`.
+Every call to :py:meth:`backends.StorageBackend.list_dir`,
+:py:meth:`backends.StorageBackend.stat_many`, :py:meth:`backends.StorageBackend.delete_many`,
+and :py:meth:`backends.StorageBackend.list_files` is then written to the trace
+with its arguments, result or error, and latency.
+This covers everything that goes to the storage, including
+:py:func:`listdeletable.list_folder`, :py:func:`listdeletable.get_mtime`,
+:py:func:`listdeletable.get_file_size`, and the deletions of :py:func:`listdeletable.do_delete`.
+
+The trace has one JSON object on each line, and is gzipped if its name ends with ``.gz``.
+The first line holds the storage type, the unmerged location, and when the trace started.
+
+Setting **STORAGE_TYPE** to ``'replay'`` uses a :py:class:`ReplayBackend`
+that serves the namespace in **REPLAY_FILE**, waiting as long as each call took
+when it was recorded, times **REPLAY_LATENCY_SCALE**.
+Each thread waits on its own, so a change in the number of threads or in the order of calls
+is measured against the latency of each call on the real storage.
+"""
+
+import json
+import time
+import gzip
+import errno
+import logging
+import threading
+
+from . import backends
+from .fsimage import open_text
+
+
+LOG = logging.getLogger(__name__)
+
+
+def open_trace(file_name, mode='wb'):
+    """
+    :param str file_name: The trace to write, which is gzipped if it ends with ``.gz``
+    :param str mode: ``'wb'`` for a new trace, or ``'ab'`` to add to one
+    :returns: The opened file, which takes bytes
+    :rtype: file
+    """
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode)
+
+    return open(file_name, mode)
+
+
+class TracingBackend(backends.StorageBackend):
+    """
+    Passes calls on to another backend, writing each one to a trace file.
+    Like other backends, this can still be used after :py:meth:`close`.
+    The trace is then continued.
+    """
+
+    def __init__(self, backend, file_name):
+        """
+        :param backends.StorageBackend backend: The backend that does the work
+        :param str file_name: The trace file to write
+        """
+        super(TracingBackend, self).__init__(backend.config)
+        self.backend = backend
+        self.storage_type = backend.storage_type
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self._file = open_trace(file_name)
+        self._write({'storage_type': backend.storage_type,
+                     'location': self.config.UNMERGED_DIR_LOCATION,
+                     'start': time.time()})
+
+    def _write(self, content):
+        """Adds a line to the trace"""
+        line = (json.dumps(content) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                self._file = open_trace(self.file_name, 'ab')
+            self._file.write(line)
+
+    def _call(self, operation, args, func):
+        """
+        Calls the backend and records the call.
+
+        :param str operation: The name of the method
+        :param list args: The arguments to write to the trace
+        :param function func: Takes no arguments and calls the backend
+        :returns: What *func* returns
+        """
+
+        start = time.time()
+        try:
+            result = func()
+        except EnvironmentError as err:
+            self._write({'op': operation, 'args': args, 'latency': time.time() - start,
+                         'error': err.errno, 'message': str(err)})
+            raise
+
+        self._write({'op': operation, 'args': args, 'latency': time.time() - start,
+                     'result': result})
+        return result
+
+    def list_dir(self, pfn):
+        return self._call('list_dir', [pfn], lambda: self.backend.list_dir(pfn))
+
+    def stat_many(self, pfns):
+        return self._call('stat_many', [pfns], lambda: self.backend.stat_many(pfns))
+
+    def delete_many(self, pfns, recursive):
+        return self._call('delete_many', [pfns, recursive],
+                          lambda: self.backend.delete_many(pfns, recursive))
+
+    def batches(self, pfns, recursive):
+        return self.backend.batches(pfns, recursive)
+
+    def list_files(self, pfn):
+        start = time.time()
+        listed = self.backend.list_files(pfn)
+        if listed is None:
+            self._write({'op': 'list_files', 'args': [pfn], 'latency': time.time() - start,
+                         'result': None})
+            return None
+
+        return self._list_files(pfn, start, listed)
+
+    def _list_files(self, pfn, start, listed):
+        """Gives back the listed files, and records all of them at the end"""
+        output = []
+        for entry in listed:
+            output.append(entry)
+            yield entry
+
+        self._write({'op': 'list_files', 'args': [pfn], 'latency': time.time() - start,
+                     'result': output})
+
+    def flush(self):
+        self.backend.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        self.backend.close()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+@backends.register('replay')
+class ReplayBackend(backends.StorageBackend):
+    """
+    Serves the namespace recorded in a trace by :py:class:`TracingBackend`.
+
+    The modification times are moved forward by the time since the trace was recorded,
+    so everything has the same age as when it was recorded.
+    If the **UNMERGED_DIR_LOCATION** is different from the recorded one,
+    paths are moved from one to the other.
+    Deletions give the recorded outcome, and do not change the namespace.
+    Paths that were not recorded are missing.
+    """
+
+    def __init__(self, config):
+        super(ReplayBackend, self).__init__(config)
+        self.scale = getattr(config, 'REPLAY_LATENCY_SCALE', 1.0)
+
+        # Each of these maps a recorded PFN to the result and latency of its calls
+        self.listings = {}
+        self.stats = {}
+        self.deletions = {}
+        self.listed_files = {}
+
+        with open_text(config.REPLAY_FILE) as trace:
+            header = json.loads(next(trace))
+            self.location = header['location']
+            self.shift = time.time() - header['start']
+
+            for line in trace:
+                if line.strip():
+                    self._add(json.loads(line))
+
+    def _add(self, call):
+        """Adds one recorded call"""
+
+        operation = call['op']
+        if operation == 'list_dir':
+            self.listings[call['args'][0]] = call
+
+        elif operation in ('stat_many', 'delete_many'):
+            results = self.stats if operation == 'stat_many' else self.deletions
+            pfns = call['args'][0]
+            for num, pfn in enumerate(pfns):
+                results[pfn] = {'latency': call['latency'] / len(pfns),
+                                'error': call.get('error'),
+                                'result': call['result'][num] if 'result' in call else None}
+
+        elif operation == 'list_files':
+            self.listed_files[call['args'][0]] = call
+
+    def _recorded(self, pfn):
+        """
+        :param str pfn: A path inside this **UNMERGED_DIR_LOCATION**
+        :returns: The same path inside the recorded location
+        :rtype: str
+        """
+        if pfn.startswith(self.config.UNMERGED_DIR_LOCATION):
+            return self.location + pfn[len(self.config.UNMERGED_DIR_LOCATION):]
+        return pfn
+
+    def _current(self, pfn):
+        """The opposite of :py:meth:`_recorded`"""
+        if pfn.startswith(self.location):
+            return self.config.UNMERGED_DIR_LOCATION + pfn[len(self.location):]
+        return pfn
+
+    def _wait(self, latency):
+        """Waits as long as the recorded call took, times the scale"""
+        if self.scale and latency:
+            time.sleep(latency * self.scale)
+
+    @staticmethod
+    def _raise(call, pfn):
+        """Raises the error of a recorded call"""
+        raise OSError(call['error'] or errno.EIO, call.get('message', 'Recorded error'), pfn)
+
+    def list_dir(self, pfn):
+        call = self.listings.get(self._recorded(pfn))
+        if call is None:
+            raise OSError(errno.ENOENT, 'Not in the trace', pfn)
+
+        self._wait(call['latency'])
+        if 'result' not in call:
+            self._raise(call, pfn)
+
+        subdirs, files = call['result']
+        return subdirs, [(name, mtime + self.shift, size) for name, mtime, size in files]
+
+    def stat_many(self, pfns):
+        output = []
+        for pfn in pfns:
+            call = self.stats.get(self._recorded(pfn))
+            if call is None:
+                output.append(None)
+                continue
+
+            self._wait(call['latency'])
+            if call['error'] is not None:
+                self._raise(call, pfn)
+
+            info = call['result']
+            output.append(None if info is None else (info[0] + self.shift, info[1]))
+
+        return output
+
+    def delete_many(self, pfns, recursive):
+        output = []
+        for pfn in pfns:
+            call = self.deletions.get(self._recorded(pfn))
+            if call is None:
+                output.append((backends.MISSING, 0))
+                continue
+
+            self._wait(call['latency'])
+            if call['error'] is not None:
+                self._raise(call, pfn)
+
+            output.append(tuple(call['result']))
+
+        return output
+
+    def list_files(self, pfn):
+        call = self.listed_files.get(self._recorded(pfn))
+        if call is None or call['result'] is None:
+            return None
+
+        self._wait(call['latency'])
+        return [(self._current(path), mtime + self.shift, size)
+                for path, mtime, size in call['result']]
+
+
+def wrap(backend, config):
+    """
+    :param backends.StorageBackend backend: A new backend
+    :param module config: The configuration
+    :returns: The backend, wrapped in a :py:class:`TracingBackend` if **TRACE_FILE** is set
+    :rtype: backends.StorageBackend
+    """
+    trace_file = getattr(config, 'TRACE_FILE', None)
+    if not trace_file:
+        return backend
+
+    LOG.info('Recording the storage calls to %s', trace_file)
+    return TracingBackend(backend, trace_file)
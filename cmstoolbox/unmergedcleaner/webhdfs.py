@@ -0,0 +1,202 @@
+"""
+This module is a small WebHDFS client for the :ref:`unmerged-ref` at Hadoop sites.
+It talks to the NameNode (or an HttpFS gateway) over HTTP, instead of starting
+a JVM for each ``hdfs dfs`` command.
+Connections are kept open in a pool between requests, and each request
+takes one from the pool, so a directory walk with several threads lists directories
+concurrently without opening a new connection for each request.
+
+Directories are listed with ``LISTSTATUS_BATCH``, which pages through large directories
+and gives the type, size, and modification time of each entry.
+Servers without ``LISTSTATUS_BATCH`` fall back to ``LISTSTATUS``.
+Only simple authentication, through the ``user.name`` parameter, is supported.
+"""
+
+import json
+import socket
+import threading
+
+try:
+    import httplib
+    from urlparse import urlparse
+    from urllib import quote, urlencode
+except ImportError:
+    from urllib.parse import quote, urlencode, urlparse
+    import http.client as httplib
+
+
+class WebHdfsError(IOError):
+    """
+    An error returned by the WebHDFS server, or a request that got no response.
+    """
+
+    def __init__(self, status, exception, message):
+        """
+        :param int status: The HTTP status of the response, or 0 if there was no response
+        :param str exception: The name of the Java exception, like ``FileNotFoundException``
+        :param str message: The message from the server
+        """
+        super(WebHdfsError, self).__init__('%s (%i): %s' % (exception, status, message))
+        self.status = status
+        self.exception = exception
+
+
+class WebHdfsClient(object):
+    """
+    A WebHDFS client that can be shared between threads.
+    """
+
+    def __init__(self, url, user=None, timeout=60):
+        """
+        :param str url: The location of the server, like ``http://namenode:9870``
+        :param str user: The user name to send with each request, if any
+        :param float timeout: The timeout, in seconds, of each request
+        """
+        parsed = urlparse(url)
+        self._connection_class = httplib.HTTPSConnection if parsed.scheme == 'https' \
+            else httplib.HTTPConnection
+        self._netloc = parsed.netloc
+        self._prefix = parsed.path.rstrip('/') + '/webhdfs/v1'
+        self._user = user
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._pool = []
+        self._batch = True
+
+    def _acquire(self):
+        """
+        :returns: An idle connection from the pool, or a new one
+        :rtype: httplib.HTTPConnection
+        """
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+
+        return self._connection_class(self._netloc, timeout=self._timeout)
+
+    def _release(self, conn):
+        """
+        :param httplib.HTTPConnection conn: A connection to put back in the pool
+        """
+        with self._lock:
+            self._pool.append(conn)
+
+    def close(self):
+        """Closes the idle connections"""
+        with self._lock:
+            for conn in self._pool:
+                conn.close()
+            self._pool = []
+
+    def request(self, method, path, operation, **params):
+        """
+        Sends one request. A request that fails because the server closed
+        a kept-alive connection is sent again once on a new connection.
+
+        :param str method: The HTTP method
+        :param str path: The HDFS path
+        :param str operation: The WebHDFS operation, sent as ``op``
+        :param params: Other parameters for the operation
+        :returns: The JSON response
+        :rtype: dict
+        :raises WebHdfsError: If the server returns an error,
+                              or if the request fails or the server cannot be reached twice
+        """
+
+        params['op'] = operation
+        if self._user:
+            params['user.name'] = self._user
+
+        url = '%s%s?%s' % (self._prefix, quote(path), urlencode(sorted(params.items())))
+
+        error = None
+        for _ in range(2):
+            conn = self._acquire()
+            try:
+                conn.request(method, url)
+                response = conn.getresponse()
+                body = response.read()
+                error = None
+                break
+            except (httplib.HTTPException, socket.error) as err:
+                conn.close()
+                error = err
+
+        # Raised outside of the except block, since Python 2 has no "raise from"
+        if error is not None:
+            raise WebHdfsError(0, type(error).__name__, str(error))
+
+        self._release(conn)
+
+        try:
+            result = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            # Proxies and gateways can return errors that are not JSON
+            result = {}
+
+        if response.status >= 400:
+            error = result.get('RemoteException', {})
+            raise WebHdfsError(response.status, error.get('exception', 'HTTPError'),
+                               error.get('message', response.reason))
+
+        return result
+
+    def list_status(self, path):
+        """
+        Lists a directory, one page at a time.
+
+        :param str path: The HDFS path of the directory
+        :returns: The ``FileStatus`` of each entry
+        :rtype: generator
+        :raises WebHdfsError: If the directory cannot be listed
+        """
+
+        if not self._batch:
+            for status in self.request('GET', path, 'LISTSTATUS')['FileStatuses']['FileStatus']:
+                yield status
+            return
+
+        start_after = None
+        while True:
+            params = {} if start_after is None else {'startAfter': start_after}
+            try:
+                listing = self.request('GET', path, 'LISTSTATUS_BATCH', **params)
+            except WebHdfsError as err:
+                if start_after is None and err.exception in ('IllegalArgumentException',
+                                                             'UnsupportedOperationException'):
+                    # Older servers do not know the operation
+                    self._batch = False
+                    for status in self.list_status(path):
+                        yield status
+                    return
+                raise
+
+            listing = listing['DirectoryListing']
+            statuses = listing['partialListing']['FileStatuses']['FileStatus']
+            for status in statuses:
+                yield status
+
+            if not listing.get('remainingEntries') or not statuses:
+                return
+
+            start_after = statuses[-1]['pathSuffix']
+
+    def get_file_status(self, path):
+        """
+        :param str path: The HDFS path
+        :returns: The ``FileStatus`` of the path
+        :rtype: dict
+        :raises WebHdfsError: If the path does not exist
+        """
+        return self.request('GET', path, 'GETFILESTATUS')['FileStatus']
+
+    def delete(self, path, recursive=True):
+        """
+        :param str path: The HDFS path to delete
+        :param bool recursive: If True, directories are deleted with everything in them
+        :returns: If anything was deleted
+        :rtype: bool
+        :raises WebHdfsError: If the path cannot be deleted
+        """
+        return self.request('DELETE', path, 'DELETE',
+                            recursive='true' if recursive else 'false')['boolean']
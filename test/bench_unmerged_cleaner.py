@@ -0,0 +1,476 @@
+#! /usr/bin/env python
+
+"""
+``test/bench_unmerged_cleaner.py`` benchmarks the directory walk of the :ref:`unmerged-ref`.
+It is not run by ``opsspace-test``, since it only reports numbers.
+It builds a synthetic unmerged tree in a temporary directory and
+counts the metadata calls made by the walk before and after using
+:py:func:`cmstoolbox.unmergedcleaner.listdeletable.scan_folder`.
+
+The calls are counted by wrapping :py:func:`os.stat`, :py:func:`os.lstat`,
+:py:func:`os.listdir` and :py:func:`os.scandir`.
+A ``scandir`` entry only costs a ``stat`` call the first time its
+``stat()`` method is called, since the type of an entry comes with the directory listing
+on filesystems that fill ``d_type`` (ext4, XFS, tmpfs, and most network filesystems).
+
+It then times the files mode listing, comparing a ``find`` subprocess,
+which is how older versions listed files, to
+:py:func:`cmstoolbox.unmergedcleaner.listdeletable.get_unmerged_files`
+with different numbers of threads.
+
+Usage::
+
+    ./bench_unmerged_cleaner.py [DEPTH [FANOUT [FILES]]]
+
+The ``suite`` command times the main steps of the cleaner on synthetic unmerged areas
+made by :py:mod:`cmstoolbox.unmergedcleaner.synthetic`, from 10^4 to 10^7 entries:
+:py:meth:`DataNode.fill`, :py:meth:`DataNode.traverse_tree`,
+:py:func:`filter_protected`, :py:func:`bi_search`, and :py:func:`do_delete`.
+The tree is either held by a :py:class:`backends.MemoryBackend`,
+or written as sparse files to a tmpfs with ``--backend tmpfs``.
+The times can be saved as a JSON baseline,
+and later runs compared to it, failing if a step got slower than the tolerance::
+
+    ./bench_unmerged_cleaner.py suite --entries 10000,100000 --save baseline.json
+    ./bench_unmerged_cleaner.py suite --entries 10000,100000 --baseline baseline.json
+
+Larger trees need a lot of memory, about 1 GB for each million entries.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import logging
+import platform
+import tempfile
+import collections
+from optparse import OptionParser
+
+import cmstoolbox._loadtestpath
+from cmstoolbox.unmergedcleaner import backends
+from cmstoolbox.unmergedcleaner import listdeletable
+from cmstoolbox.unmergedcleaner import synthetic
+from cmstoolbox.unmergedcleaner import _config
+
+
+class CountingEntry(object):
+    """
+    Wraps a ``DirEntry`` to count the stat calls it makes.
+    """
+
+    def __init__(self, entry, counts):
+        self._entry = entry
+        self._counts = counts
+        self._stat = None
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self):
+        return self._entry.is_dir()
+
+    def is_file(self):
+        return self._entry.is_file()
+
+    def stat(self):
+        if self._stat is None:
+            self._counts['stat'] += 1
+            self._stat = self._entry.stat()
+        return self._stat
+
+
+class SyscallCounter(object):
+    """
+    A context manager that counts the metadata calls made while it is active.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self._saved = None
+
+    def _wrap(self, name, func):
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return func(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        self._saved = (os.stat, os.lstat, os.listdir, backends.scandir)
+        os.stat = self._wrap('stat', os.stat)
+        os.lstat = self._wrap('stat', os.lstat)
+        os.listdir = self._wrap('readdir', os.listdir)
+
+        real_scandir = backends.scandir
+        if real_scandir is not None:
+            def counting_scandir(path):
+                self.counts['readdir'] += 1
+                for entry in real_scandir(path):
+                    yield CountingEntry(entry, self.counts)
+
+            backends.scandir = counting_scandir
+
+        return self
+
+    def __exit__(self, *args):
+        os.stat, os.lstat, os.listdir, backends.scandir = self._saved
+
+
+def legacy_fill(node):
+    """
+    The directory walk of :py:meth:`DataNode.fill` before :py:func:`scan_folder`.
+    Only the metadata calls are reproduced here.
+    """
+
+    full_path_name = os.path.join(listdeletable.config.UNMERGED_DIR_LOCATION, node.path_name)
+
+    dirs = [listing for listing in os.listdir(full_path_name) if
+            os.path.isdir(os.path.join(full_path_name, listing))]
+    all_files = [listing for listing in os.listdir(full_path_name) if
+                 os.path.isfile(os.path.join(full_path_name, listing))]
+
+    for subdir in dirs:
+        legacy_fill(listdeletable.DataNode(os.path.join(node.path_name, subdir)))
+
+    for file_name in all_files:
+        os.stat(full_path_name + '/' + file_name).st_mtime
+        os.stat(full_path_name + '/' + file_name).st_size
+
+
+def make_tree(location, depth, fanout, files):
+    """
+    Makes a tree of empty files.
+
+    :param str location: The top directory of the tree
+    :param int depth: Number of directory levels
+    :param int fanout: Number of subdirectories in each directory
+    :param int files: Number of files in each directory at the bottom level
+    :returns: The number of directories and files made
+    :rtype: tuple
+    """
+
+    ndirs = 0
+    nfiles = 0
+    level = [location]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for index in range(fanout):
+                path = os.path.join(parent, 'dir%i' % index)
+                os.makedirs(path)
+                next_level.append(path)
+        ndirs += len(next_level)
+        level = next_level
+
+    for parent in level:
+        for index in range(files):
+            open(os.path.join(parent, 'file%i.root' % index), 'w').close()
+        nfiles += files
+
+    return ndirs, nfiles
+
+
+def find_unmerged_files():
+    """
+    Runs ``find`` and reads the NUL separated output as it comes,
+    so the full list is never held in memory and file names with spaces are kept whole.
+    Files with a newline in their name are skipped, like the cleaner does.
+
+    :returns: the old files' PFNs in the unmerged directory
+    :rtype: generator
+    """
+
+    config = listdeletable.config
+    out = subprocess.Popen(['find', config.UNMERGED_DIR_LOCATION, '-type', 'f',
+                            '-not', '-newermt', '-%s seconds' % config.MIN_AGE, '-print0'],
+                           stdout=subprocess.PIPE)
+
+    fsdecode = getattr(os, 'fsdecode', lambda name: name)
+    leftover = b''
+    try:
+        for block in iter(lambda: out.stdout.read(1 << 16), b''):
+            names = (leftover + block).split(b'\0')
+            leftover = names.pop()
+            for name in names:
+                if b'\n' not in name:
+                    yield fsdecode(name)
+
+    finally:
+        out.stdout.close()
+        out.wait()
+
+
+def bench_files(location):
+    """
+    Times the files mode listers on a tree where every file is old enough to delete.
+    """
+
+    _config.MIN_AGE = 0
+    listdeletable.NOW = int(time.time()) + 1
+
+    print('%-14s %10s %10s' % ('Files lister', 'files', 'time [s]'))
+
+    expected = None
+    for name, lister in [('find', find_unmerged_files),
+                         ('native x1', lambda: listdeletable.get_unmerged_files(1)),
+                         ('native x4', lambda: listdeletable.get_unmerged_files(4)),
+                         ('native x16', lambda: listdeletable.get_unmerged_files(16))]:
+        start = time.time()
+        found = set(lister())
+        elapsed = time.time() - start
+
+        if expected is None:
+            expected = found
+        elif found != expected:
+            print('%s found different files than find' % name)
+
+        print('%-14s %10i %10.3f' % (name, len(found), elapsed))
+
+
+def main(depth=4, fanout=6, files=20):
+    """
+    Runs the benchmark and prints the results.
+    """
+
+    tmpdir = tempfile.mkdtemp()
+    location = os.path.join(tmpdir, 'store/unmerged')
+
+    try:
+        ndirs, nfiles = make_tree(location, depth, fanout, files)
+
+        listdeletable.config = _config
+        _config.UNMERGED_DIR_LOCATION = location
+        listdeletable.NOW = int(time.time())
+
+        print('Tree with %i directories and %i files' % (ndirs, nfiles))
+        print('%-14s %10s %10s %10s' % ('Walk', 'readdir', 'stat', 'time [s]'))
+
+        for name, walk in [('before', legacy_fill),
+                           ('scan_folder', listdeletable.DataNode.fill)]:
+            with SyscallCounter() as counter:
+                start = time.time()
+                for subdir in listdeletable.list_folder(location, 'subdirs'):
+                    walk(listdeletable.DataNode(subdir))
+                elapsed = time.time() - start
+
+            print('%-14s %10i %10i %10.3f' % (name, counter.counts['readdir'],
+                                              counter.counts['stat'], elapsed))
+
+        print()
+        bench_files(location)
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+SUITE_STEPS = ['fill', 'traverse_tree', 'bi_search', 'filter_protected', 'do_delete']
+"""The steps timed by :py:func:`run_suite`, in the order they are run."""
+
+
+def bench_entries(entries, backend, tmpdir):
+    """
+    Times each of :py:data:`SUITE_STEPS` on one synthetic tree.
+
+    :param int entries: About how many directories and files are in the tree
+    :param str backend: ``'memory'`` or ``'tmpfs'``
+    :param str tmpdir: Where the tree, if written to disk, and deletion file go
+    :returns: The seconds taken by each step, and the size of the tree
+    :rtype: dict
+    """
+
+    layout = synthetic.Layout.with_entries(entries)
+    now = int(time.time())
+    location = os.path.join(tmpdir, 'store/unmerged')
+    protected = []
+
+    listdeletable.config = _config
+    _config.UNMERGED_DIR_LOCATION = location
+    _config.DELETION_FILE = os.path.join(tmpdir, 'to_delete.txt')
+    _config.MIN_AGE = layout.mean_age
+    _config.DELETE_RATE = 0
+    _config.WHICH_LIST = 'directories'
+
+    records = synthetic.generate(layout, now, protected)
+    if backend == 'memory':
+        _config.STORAGE_TYPE = 'memory'
+        memory = backends.MemoryBackend(_config)
+        memory.storage_type = 'memory'
+        for path, is_dir, mtime, size in records:
+            memory.add(os.path.join(location, path), is_dir, mtime, size)
+        listdeletable.BACKEND = memory
+    else:
+        _config.STORAGE_TYPE = 'posix'
+        listdeletable.BACKEND = None
+        synthetic.materialize(records, location)
+
+    if not protected:
+        # Small trees can miss the protected fraction, but the cleaner needs something protected
+        protected.append(os.path.join(*[synthetic.level_name(level, 0)
+                                        for level in range(layout.protected_level)]))
+
+    listdeletable.NOW = now
+    listdeletable.PROTECTED_LIST = sorted(os.path.join(_config.LFN_TO_CLEAN, path)
+                                          for path in protected)
+    listdeletable.check_config()
+
+    ndirs, nfiles = layout.counts()
+    times = {'directories': ndirs, 'files': nfiles}
+
+    start = time.time()
+    nodes = []
+    for subdir in listdeletable.list_top_dirs():
+        node = listdeletable.DataNode(subdir)
+        node.fill()
+        nodes.append(node)
+    times['fill'] = time.time() - start
+
+    start = time.time()
+    list_to_del = []
+    for node in nodes:
+        node.traverse_tree(list_to_del)
+    times['traverse_tree'] = time.time() - start
+
+    file_lfns = [os.path.join(_config.LFN_TO_CLEAN, path)
+                 for path, is_dir, _, _ in synthetic.generate(layout, now) if not is_dir]
+
+    start = time.time()
+    for lfn in file_lfns:
+        listdeletable.bi_search(listdeletable.PROTECTED_LIST, os.path.dirname(lfn))
+    times['bi_search'] = time.time() - start
+
+    file_pfns = [listdeletable.lfn_to_pfn(lfn) for lfn in file_lfns]
+    del file_lfns
+
+    start = time.time()
+    listdeletable.filter_protected(file_pfns, listdeletable.PROTECTED_LIST)
+    times['filter_protected'] = time.time() - start
+    del file_pfns
+
+    listdeletable.write_deletions(nodes)
+    del nodes
+
+    start = time.time()
+    listdeletable.do_delete()
+    times['do_delete'] = time.time() - start
+
+    return times
+
+
+def compare(results, baseline, tolerance, min_seconds=0.01):
+    """
+    :param dict results: The results of :py:func:`run_suite`
+    :param dict baseline: Earlier results of :py:func:`run_suite`
+    :param float tolerance: How much slower a step can be, as a fraction of the baseline
+    :param float min_seconds: Steps that are slower by less than this are left out,
+                              since very short times are mostly noise
+    :returns: A description of each step that is slower than the baseline allows
+    :rtype: list
+    """
+
+    regressions = []
+    for entries, times in sorted(results['entries'].items(), key=lambda item: int(item[0])):
+        old_times = baseline.get('entries', {}).get(entries)
+        if old_times is None:
+            continue
+
+        for step in SUITE_STEPS:
+            if step in old_times and times[step] > old_times[step] * (1 + tolerance) and \
+                    times[step] - old_times[step] >= min_seconds:
+                regressions.append('%s at %s entries: %.3f s, was %.3f s' %
+                                   (step, entries, times[step], old_times[step]))
+
+    return regressions
+
+
+def run_suite(sizes, backend='memory', tmpdir=None):
+    """
+    Times the steps of the cleaner at each size, and prints a table of the results.
+
+    :param list sizes: The numbers of entries in each tree
+    :param str backend: ``'memory'`` or ``'tmpfs'``
+    :param str tmpdir: Where to make the temporary directories. If None, ``/dev/shm`` is used
+                       if it exists.
+    :returns: The results, as written to a baseline file
+    :rtype: dict
+    """
+
+    if tmpdir is None and os.path.isdir('/dev/shm'):
+        tmpdir = '/dev/shm'
+
+    results = {'backend': backend, 'python': platform.python_version(),
+               'created': time.time(), 'entries': {}}
+
+    print(('%-10s %9s %9s' + ' %16s' * len(SUITE_STEPS)) %
+          tuple(['Entries', 'dirs', 'files'] + SUITE_STEPS))
+
+    # The deletions are logged one at a time
+    logging.getLogger().setLevel(logging.ERROR)
+
+    for entries in sizes:
+        workdir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            times = bench_entries(entries, backend, workdir)
+        finally:
+            listdeletable.BACKEND = None
+            shutil.rmtree(workdir)
+
+        results['entries'][str(entries)] = times
+        print(('%-10i %9i %9i' + ' %16.3f' * len(SUITE_STEPS)) %
+              tuple([entries, times['directories'], times['files']] +
+                    [times[step] for step in SUITE_STEPS]))
+
+    return results
+
+
+def suite_main(args):
+    """
+    Runs the ``suite`` command.
+
+    :param list args: The command line arguments after ``suite``
+    :returns: The exit code, which is 1 if there are regressions
+    :rtype: int
+    """
+
+    parser = OptionParser(usage='%prog suite [options]')
+    parser.add_option('--entries', default='10000,100000,1000000',
+                      help='Comma separated sizes of the trees [default: %default]')
+    parser.add_option('--backend', default='memory', choices=['memory', 'tmpfs'],
+                      help='Where the tree is held, "memory" or "tmpfs" [default: %default]')
+    parser.add_option('--tmpdir', default=None,
+                      help='Where to write the trees [default: /dev/shm if it exists]')
+    parser.add_option('--save', default=None, metavar='FILE',
+                      help='Save the results as a baseline to FILE')
+    parser.add_option('--baseline', default=None, metavar='FILE',
+                      help='Compare the results to the baseline in FILE')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='How much slower each step can be than the baseline, '
+                      'as a fraction [default: %default]')
+
+    opts, _ = parser.parse_args(args)
+
+    results = run_suite([int(float(size)) for size in opts.entries.split(',')],
+                        opts.backend, opts.tmpdir)
+
+    if opts.save:
+        with open(opts.save, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline, 'r') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), opts.tolerance)
+        for regression in regressions:
+            print('Slower than the baseline: %s' % regression)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['suite']:
+        sys.exit(suite_main(sys.argv[2:]))
+
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -23,9 +23,46 @@ import uuid
 import testfixtures
 import time
 import shutil
+import tempfile
+import socket
+import threading
+import weakref
+import gc
+import json
+import gzip
+
+try:
+    from thread import interrupt_main
+except ImportError:
+    from _thread import interrupt_main
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl, unquote
 
 import cmstoolbox._loadtestpath
 from cmstoolbox.unmergedcleaner import listdeletable
+from cmstoolbox.unmergedcleaner import backends
+from cmstoolbox.unmergedcleaner import deleter
+from cmstoolbox.unmergedcleaner import dumpfile
+from cmstoolbox.unmergedcleaner import estimate
+from cmstoolbox.unmergedcleaner import externalsort
+from cmstoolbox.unmergedcleaner import filesmode
+from cmstoolbox.unmergedcleaner import fsimage
+from cmstoolbox.unmergedcleaner import manifest
+from cmstoolbox.unmergedcleaner import metrics
+from cmstoolbox.unmergedcleaner import namespacetree
+from cmstoolbox.unmergedcleaner import pathtrie
+from cmstoolbox.unmergedcleaner import residentscan
+from cmstoolbox.unmergedcleaner import rmtree
+from cmstoolbox.unmergedcleaner import synthetic
+from cmstoolbox.unmergedcleaner import webhdfs
 
 
 listdeletable.set_config()
@@ -79,6 +116,216 @@ class TestUnmergedFunctions(unittest.TestCase):
             self.assertEqual(listdeletable.bi_search(test_list, popped),
                              False, 'bi_search found a string when it should not.')
 
+    def test_path_trie(self):
+        trie = pathtrie.PathTrie(['/store/unmerged/a/b', '/store/unmerged/c/', '/store/unmerged/a/b/d'])
+        self.assertEqual(len(trie), 3)
+
+        for path, expected in [('/store/unmerged/a/b', pathtrie.PROTECTED),
+                               ('/store/unmerged/c', pathtrie.PROTECTED),
+                               ('/store/unmerged/a/b/d', pathtrie.INSIDE),
+                               ('/store/unmerged/a/b/e/f.root', pathtrie.INSIDE),
+                               ('/store/unmerged/c/f.root', pathtrie.INSIDE),
+                               ('/store/unmerged/a', pathtrie.ANCESTOR),
+                               ('/store/unmerged', pathtrie.ANCESTOR),
+                               ('/store/unmerged/a/bc', None),
+                               ('/store/unmerged/cc/f.root', None),
+                               ('/store/mc', None)]:
+            self.assertEqual(trie.lookup(path), expected, path)
+
+    def test_filter_protected(self):
+        location = listdeletable.config.UNMERGED_DIR_LOCATION
+        files = [os.path.join(location, name) for name in
+                 ['protected1/a.root', 'protected10/b.root', 'dir/that/is/protected/c.root',
+                  'dir/that/is/d.root', 'avoid/e.root', 'avoided/f.root']]
+
+        chunk_size = listdeletable.config.SORT_CHUNK_SIZE
+        for listdeletable.config.SORT_CHUNK_SIZE in [1, 4, chunk_size]:
+            listdeletable.filter_protected(iter(files), listdeletable.PROTECTED_LIST)
+            with open(listdeletable.config.DELETION_FILE, 'r') as del_file:
+                self.assertEqual(del_file.read().split('\n'),
+                                 sorted([files[1], files[3], files[5]]))
+
+        listdeletable.config.SORT_CHUNK_SIZE = chunk_size
+
+    def test_sorted_paths(self):
+        paths = [str(uuid.uuid4()) for _ in range(1000)]
+        tmp_dir = os.path.dirname(listdeletable.config.DELETION_FILE)
+        before = sorted(os.listdir(tmp_dir))
+
+        for chunk_size in [1, 7, 1000, 2000]:
+            self.assertEqual(list(externalsort.sorted_paths(paths, chunk_size, tmp_dir)),
+                             sorted(paths))
+
+        # The chunks are cleaned up, even if not everything is read
+        sorted_paths = externalsort.sorted_paths(paths, 10, tmp_dir)
+        next(sorted_paths)
+        sorted_paths.close()
+        self.assertEqual(sorted(os.listdir(tmp_dir)), before)
+
+    def test_token_bucket(self):
+        bucket = deleter.TokenBucket(100)
+        start = time.time()
+        for _ in range(21):
+            bucket.wait()
+        self.assertTrue(0.18 < time.time() - start < 1.0)
+
+        self.assertEqual(deleter.TokenBucket(0).reserve(), 0)
+
+    def test_run_deletions(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+        done = []
+
+        def delete(entry):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+                done.append(entry)
+            if entry % 10 == 9:
+                raise OSError('Cannot delete %i' % entry)
+
+        with testfixtures.LogCapture() as capture:
+            stats = deleter.run_deletions(iter(range(100)), delete, 0, 4)
+        self.assertTrue('Could not delete 19: Cannot delete 19' in str(capture))
+        self.assertEqual(sorted(done), list(range(100)))
+        self.assertEqual((stats.deleted, stats.failed, stats.interrupted), (90, 10, False))
+        self.assertEqual(in_flight, [0, 4])
+
+        # Ctrl-C stops starting deletions and waits for the ones in flight
+        def interrupt(entry):
+            delete(entry)
+            if entry == 4:
+                interrupt_main()
+
+        del done[:]
+        with testfixtures.LogCapture():
+            stats = deleter.run_deletions(iter(range(1000)), interrupt, 0, 2)
+        self.assertTrue(stats.interrupted)
+        self.assertTrue(5 <= len(done) < 1000)
+        self.assertEqual(stats.deleted + stats.failed, len(done))
+        self.assertEqual(in_flight[0], 0)
+
+    def test_parse_hdfs_rm(self):
+        output = '\n'.join([
+            'Deleted /store/unmerged/a',
+            "Moved: 'hdfs://namenode:8020/store/unmerged/b c' to trash at: "
+            'hdfs://namenode:8020/user/cms/.Trash/Current/store/unmerged/b c',
+            "rm: `/cksums/store/unmerged/d': No such file or directory",
+            'rm: Failed to move to trash: hdfs://namenode:8020/store/unmerged/e',
+            ])
+        self.assertEqual(backends.parse_hdfs_rm(output),
+                         (set(['/store/unmerged/a', '/store/unmerged/b c']),
+                          set(['/cksums/store/unmerged/d'])))
+
+        self.assertEqual(
+            backends.parse_hdfs_ls('-rw-r--r--   3 cms cms  1024 2020-01-02 03:04 /store/a b\n'),
+            ('/store/a b', time.mktime((2020, 1, 2, 3, 4, 0, 0, 0, -1)), 1024))
+        self.assertEqual(
+            backends.parse_hdfs_ls('drwxr-xr-x   - cms cms     0 2020-01-02 03:04 /store/c'), None)
+
+        self.assertEqual(backends.hdfs_paths('/mnt/hadoop/store/unmerged/a'),
+                         ['/cksums/store/unmerged/a', '/store/unmerged/a'])
+
+        pfns = ['/mnt/hadoop/store/unmerged/%03i' % index for index in range(100)]
+        batches = list(backends.hadoop_batches(iter(pfns), 500))
+        self.assertEqual(sum(batches, []), pfns)
+        for batch in batches:
+            self.assertTrue(
+                sum(len(path) + 1 for pfn in batch for path in backends.hdfs_paths(pfn)) <= 500)
+
+    def test_synthetic_tree(self):
+        layout = synthetic.Layout(depth=3, fanout=3, files=2, protected_fraction=0.5, seed=4)
+        now = time.time()
+        protected = []
+        records = list(synthetic.generate(layout, now, protected))
+
+        self.assertEqual(records, list(synthetic.generate(layout, now)))
+        self.assertEqual((len([record for record in records if record[1]]),
+                          len([record for record in records if not record[1]])),
+                         layout.counts())
+        self.assertTrue(protected)
+        self.assertTrue(all(path.count('/') == 1 for path in protected))
+
+        for entries in [10000, 100000, 1000000]:
+            self.assertTrue(abs(sum(synthetic.Layout.with_entries(entries).counts()) - entries) <
+                            0.05 * entries)
+
+        # Directories come after what is in them, with the newest time inside
+        seen = set()
+        for path, is_dir, mtime, _ in records:
+            if is_dir:
+                self.assertEqual(mtime, max(record[2] for record in records
+                                            if os.path.dirname(record[0]) == path))
+            self.assertFalse(os.path.dirname(path) in seen)
+            seen.add(path)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(synthetic.materialize(records, tmp_dir), layout.counts())
+            for path, is_dir, mtime, size in records:
+                info = os.stat(os.path.join(tmp_dir, path))
+                self.assertAlmostEqual(info.st_mtime, mtime, 2)
+                if not is_dir:
+                    self.assertEqual(info.st_size, size)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_estimate_tree(self):
+        layout = synthetic.Layout(depth=4, fanout=8, files=5, ages=('exponential', 20), file_size=1,
+                                  seed=2)
+        protected = []
+        records = list(synthetic.generate(layout, 100, protected))
+        trie = pathtrie.PathTrie(protected)
+
+        listings = {'': ([], [])}
+        builder = namespacetree.TreeBuilder()
+        for path, is_dir, mtime, size in records:
+            builder.add(path, is_dir, mtime, size)
+            parent, name = os.path.split(path)
+            if is_dir:
+                listings.setdefault(parent, ([], []))[0].append(name)
+                listings.setdefault(path, ([], []))
+            else:
+                listings.setdefault(parent, ([], []))[1].append((name, mtime, size))
+
+        def protection(path):
+            lookup = trie.lookup(path)
+            if lookup in (pathtrie.PROTECTED, pathtrie.INSIDE):
+                return None
+            return lookup == pathtrie.ANCESTOR
+
+        def flags(path):
+            upper = protection(path)
+            return None if upper is None else (namespacetree.UPPER if upper else 0)
+
+        # The full scan
+        exact = dict((field, 0) for field in estimate.FIELDS)
+        for top_dir in builder.top_dirs():
+            tree = builder.build(top_dir, flags)
+            tree.aggregate(100, 80)
+            for index in tree.deletable():
+                exact['bytes'] += tree.size[index]
+                exact['files'] += tree.nsubfiles[index]
+                exact['directories'] += tree.nsubnodes[index] + 1
+
+        args = (listings[''][0], listings.get, lambda path: 100, protection, 20)
+
+        # Listing everything gives the exact totals, with no uncertainty
+        full = estimate.estimate_tree(*args, fraction=1.0, minimum=2)
+        for field in ['bytes', 'files', 'directories']:
+            self.assertEqual((full.values[field], full.error(field)), (exact[field], 0))
+        self.assertEqual(full.values['total_directories'], layout.counts()[0] - sum(
+            1 for path, is_dir, _, _ in records if is_dir and protection(path) is None))
+
+        sampled = estimate.estimate_tree(*args, fraction=0.1, minimum=2, rand=random.Random(1))
+        self.assertTrue(sampled.listed < 0.2 * layout.counts()[0])
+        for field in ['bytes', 'files']:
+            low, high = sampled.interval(field)
+            self.assertTrue(low <= exact[field] <= high, (field, low, exact[field], high))
+
     def test_get_protected(self):
         if os.environ.get('TRAVIS'):
             # Can't run this test on Travis-CI due to certificate
@@ -128,6 +375,81 @@ class TestUnmergedFileChecks(unittest.TestCase):
         self.assertTrue(listdeletable.get_mtime(tmp_file) <= int(after_create),
                         'File appears newer than it actually is.')
 
+    def test_scan_folder(self):
+        for name in ['a.root', 'b.root', 'sub/c.root', 'other/d.root']:
+            self.tmpdir.write(os.path.join('scan', name), bytearray(os.urandom(100)))
+
+        scan_dir = self.tmpdir.getpath('scan')
+        subdirs, files = listdeletable.scan_folder(scan_dir)
+
+        self.assertEqual(sorted(subdirs), sorted(listdeletable.list_folder(scan_dir, 'subdirs')))
+        self.assertEqual(sorted(name for name, _, _ in files),
+                         sorted(listdeletable.list_folder(scan_dir, 'files')))
+
+        for name, mtime, size in files:
+            self.assertEqual(mtime, listdeletable.get_mtime(os.path.join(scan_dir, name)))
+            self.assertEqual(size, listdeletable.get_file_size(os.path.join(scan_dir, name)))
+
+    def test_find_names(self):
+        names = ['with space/a.root', 'with\nnewline/b.root', 'new/c.root', 'tab\tname.root']
+        old = int(time.time()) - 1000
+        for name in names:
+            path = self.tmpdir.write(name, b'data')
+            if not name.startswith('new'):
+                os.utime(path, (old, old))
+
+        listdeletable.config.MIN_AGE = 100
+        listdeletable.NOW = int(time.time())
+        self.assertEqual(sorted(listdeletable.get_unmerged_files()),
+                         sorted([self.tmpdir.getpath(names[0]), self.tmpdir.getpath(names[3])]))
+
+        # Records from a dump skip the same names
+        records = [(name, False, old, 4) for name in names]
+        self.assertEqual(sorted(filesmode.records_old_files(records, '/pfn', old)),
+                         sorted('/pfn/' + name for name in names if '\n' not in name))
+
+    def test_rmtree(self):
+        outside = self.tmpdir.write('outside/keep.root', b'data')
+
+        has_fd_functions = rmtree.HAS_FD_FUNCTIONS
+        pool = rmtree.make_pool(4)
+
+        try:
+            for rmtree.HAS_FD_FUNCTIONS in set([False, has_fd_functions]):
+                for index in range(100):
+                    self.tmpdir.write('tree/big/file_%i.root' % index, b'data')
+                self.tmpdir.write('tree/a/b/c/file.root', b'data')
+                os.symlink(self.tmpdir.getpath('outside'), self.tmpdir.getpath('tree/a/link'))
+
+                # Links are removed, and not followed
+                self.assertRaises(OSError, rmtree.rmtree, self.tmpdir.getpath('tree/a/link'))
+                counts = rmtree.rmtree(self.tmpdir.getpath('tree'), pool, sizes=True)
+
+                self.assertFalse(os.path.exists(self.tmpdir.getpath('tree')))
+                self.assertTrue(os.path.exists(outside))
+                self.assertEqual((counts.files, counts.dirs, counts.bytes),
+                                 (102, 5, 101 * 4 + len(self.tmpdir.getpath('outside'))))
+
+                # Without sizes, files are not looked up
+                self.tmpdir.write('tree/a/b/c/file.root', b'data')
+                counts = rmtree.rmtree(self.tmpdir.getpath('tree'))
+                self.assertEqual((counts.files, counts.dirs, counts.bytes), (1, 4, None))
+
+        finally:
+            rmtree.HAS_FD_FUNCTIONS = has_fd_functions
+            pool.close()
+            pool.join()
+
+        if has_fd_functions:
+            # A directory swapped for a link is not opened
+            parent_fd = os.open(self.tmpdir.path, os.O_RDONLY)
+            try:
+                os.symlink(self.tmpdir.getpath('outside'), self.tmpdir.getpath('swapped'))
+                self.assertEqual(rmtree._open_dir('swapped', parent_fd), None)
+                self.assertEqual(rmtree._open_dir('missing', parent_fd), None)
+            finally:
+                os.close(parent_fd)
+
     def do_deletion(self, delete_function):
         # Pass a function that does the deletion
 
@@ -221,6 +543,1078 @@ class TestUnmergedFileChecks(unittest.TestCase):
         self.assertTrue(os.path.exists(self.tmpdir.getpath('dir')))
 
 
+class WebHdfsStandIn(BaseHTTPRequestHandler):
+    """
+    Serves the test directory like a WebHDFS server would serve the unmerged area.
+    Listings are split into pages of three entries.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    connections = 0
+    requests = 0
+
+    def setup(self):
+        WebHdfsStandIn.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, result):
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def status(self, path, name):
+        info = os.stat(path)
+        return {'pathSuffix': name, 'length': 0 if os.path.isdir(path) else info.st_size,
+                'type': 'DIRECTORY' if os.path.isdir(path) else 'FILE',
+                'modificationTime': int(info.st_mtime * 1000)}
+
+    def handle_op(self):
+        WebHdfsStandIn.requests += 1
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        hdfs_path = unquote(url.path[len('/webhdfs/v1'):])
+        lfn_to_clean = listdeletable.config.LFN_TO_CLEAN
+
+        if hdfs_path == lfn_to_clean or hdfs_path.startswith(lfn_to_clean + '/'):
+            path = unmerged_location + hdfs_path[len(lfn_to_clean):]
+        else:
+            path = '/does/not/exist'
+
+        if params['op'] == 'DELETE':
+            if 'forbidden' in hdfs_path:
+                return self.reply(403, {'RemoteException': {
+                    'exception': 'AccessControlException', 'message': 'Permission denied'}})
+            if not os.path.exists(path):
+                return self.reply(200, {'boolean': False})
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            return self.reply(200, {'boolean': True})
+
+        if not os.path.exists(path):
+            return self.reply(404, {'RemoteException': {
+                'exception': 'FileNotFoundException', 'message': 'File %s does not exist.' % hdfs_path}})
+
+        if params['op'] == 'GETFILESTATUS':
+            return self.reply(200, {'FileStatus': self.status(path, '')})
+
+        names = sorted(name for name in os.listdir(path) if name > params.get('startAfter', ''))
+        self.reply(200, {'DirectoryListing': {
+            'partialListing': {'FileStatuses': {'FileStatus': [
+                self.status(os.path.join(path, name), name) for name in names[:3]]}},
+            'remainingEntries': len(names[3:])}})
+
+    do_GET = handle_op
+    do_DELETE = handle_op
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestScanModes(unittest.TestCase):
+    """
+    Builds a tree with old and new files by setting the modification times
+    and compares the results of different ways to scan it.
+    """
+
+    tmpdir = None
+
+    old_dirs = ['delete/not/protected', 'dir/to/delete', 'make/a/dir/to/delete',
+                'hello/delete', 'deep/a/b/c/d/e/f/g']
+    new_dirs = ['hello/new', 'new', 'deep/a/b/new']
+
+    def setUp(self):
+        self.tmpdir = testfixtures.TempDirectory(path=unmerged_location)
+        now = int(time.time())
+
+        for next_dir in self.old_dirs + self.new_dirs + protected_list + \
+                listdeletable.config.DIRS_TO_AVOID:
+            for index in range(3):
+                path = self.tmpdir.write(os.path.join(next_dir, 'file_%i.root' % index),
+                                         bytearray(os.urandom(100 * (index + 1))))
+                if next_dir not in self.new_dirs:
+                    os.utime(path, (now - 1000, now - 1000))
+
+        os.makedirs(self.tmpdir.getpath('empty/dir'))
+        os.utime(self.tmpdir.getpath('empty/dir'), (now - 1000, now - 1000))
+
+        listdeletable.config.WHICH_LIST = 'directories'
+        listdeletable.config.MIN_AGE = 100
+        listdeletable.NOW = now
+
+    def tearDown(self):
+        listdeletable.config.SCAN_THREADS = 1
+        self.tmpdir.cleanup()
+        if os.path.exists(unmerged_location):
+            shutil.rmtree(unmerged_location)
+
+    def get_deletions(self, **kwargs):
+        listdeletable.main(**kwargs)
+        with open(listdeletable.config.DELETION_FILE, 'r') as del_file:
+            return del_file.read()
+
+    def node_summary(self, node):
+        return (node.path_name, node.can_vanish, node.latest, node.nsubnodes,
+                node.nsubfiles, node.size,
+                [self.node_summary(sub_node) for sub_node in node.sub_nodes])
+
+    def test_parallel(self):
+        serial = listdeletable.DataNode('')
+        serial.fill(threads=1)
+        self.assertTrue(serial.nsubnodes > 20)
+
+        for threads in [2, 8]:
+            parallel = listdeletable.DataNode('')
+            parallel.fill(threads=threads)
+            self.assertEqual(self.node_summary(serial), self.node_summary(parallel))
+
+        serial_list = self.get_deletions()
+        listdeletable.config.SCAN_THREADS = 4
+        self.assertEqual(serial_list, self.get_deletions())
+        self.assertTrue(os.path.join(unmerged_location, 'dir/to\n') in serial_list)
+        self.assertFalse(os.path.join(unmerged_location, 'hello\n') in serial_list)
+
+    def get_skipped(self, **kwargs):
+        with testfixtures.LogCapture() as logs:
+            deletions = self.get_deletions(**kwargs)
+
+        for record in logs.records:
+            if record.getMessage().startswith('The scan cache skipped'):
+                return deletions, int(record.getMessage().split()[5])
+
+    def test_scan_cache(self):
+        # Directories modified in the last couple seconds are not cached
+        for path, dirs, _ in os.walk(unmerged_location):
+            for name in dirs:
+                os.utime(os.path.join(path, name), (listdeletable.NOW - 1000,) * 2)
+
+        listdeletable.config.SCAN_CACHE = os.path.join(
+            os.path.dirname(listdeletable.config.DELETION_FILE), 'scan_cache.db')
+
+        try:
+            deletions, skipped = self.get_skipped()
+            self.assertEqual(skipped, 0)
+
+            self.assertEqual(self.get_skipped(), (deletions, 29))
+            self.assertEqual(self.get_skipped(full_scan=True), (deletions, 0))
+            self.assertEqual(self.get_skipped(), (deletions, 29))
+
+            # A shard only lists part of the directories, and adds them to the cache
+            try:
+                with testfixtures.LogCapture():
+                    listdeletable.main(shard=(0, 3))
+            finally:
+                os.remove(listdeletable.shard_file((0, 3)))
+            self.assertEqual(self.get_skipped(), (deletions, 29))
+
+            # Adding a file changes the directory
+            self.tmpdir.write('dir/to/delete/new.root', b'new')
+            deletions, skipped = self.get_skipped()
+            self.assertEqual(skipped, 28)
+            self.assertFalse(os.path.join(unmerged_location, 'dir/to\n') in deletions)
+
+            listdeletable.config.SCAN_CACHE = None
+            self.assertEqual(self.get_deletions(), deletions)
+
+        finally:
+            listdeletable.config.SCAN_CACHE = None
+
+    def make_deep_tree(self, depth, latest):
+        tree = namespacetree.NamespaceTree('deep')
+        index = 0
+        for _ in range(depth):
+            index = tree.add_children(index, ['a'])
+
+        tree.set_files(index, latest, 10, 2)
+        tree.aggregate(listdeletable.NOW, listdeletable.config.MIN_AGE)
+        return listdeletable.DataNode('deep', tree)
+
+    def test_deep_tree(self):
+        depth = sys.getrecursionlimit() * 2
+
+        top_node = self.make_deep_tree(depth, listdeletable.NOW - 1000)
+        self.assertEqual(top_node.nsubnodes, depth)
+        self.assertEqual(top_node.nsubfiles, 2)
+        self.assertEqual(top_node.size, 10)
+
+        list_to_del = []
+        top_node.traverse_tree(list_to_del)
+        self.assertEqual([node.path_name for node in list_to_del], ['deep'])
+
+        top_node = self.make_deep_tree(depth, listdeletable.NOW)
+        list_to_del = []
+        top_node.traverse_tree(list_to_del)
+        self.assertEqual(list_to_del, [])
+
+    def make_random_tree(self):
+        random.seed(1)
+        tree = namespacetree.NamespaceTree('random')
+        pending = [0]
+        # The shape does not use random, so the size is the same for every Python version
+        while pending and len(tree) < 3000:
+            index = pending.pop(0)
+            tree.add_children(index, ['d%i' % num for num in range((index * 7 + 3) % 5)])
+            pending.extend(tree.children(index))
+
+        file_parents = [random.randrange(len(tree)) for _ in range(5000)]
+        file_mtimes = [listdeletable.NOW - random.randint(0, 200) for _ in file_parents]
+        file_sizes = [random.randint(0, 1 << 40) for _ in file_parents]
+
+        for index in random.sample(range(len(tree)), min(50, len(tree))):
+            tree.flags[index] |= random.choice([namespacetree.PROTECTED, namespacetree.UPPER])
+
+        return tree, (file_parents, file_mtimes, file_sizes)
+
+    def test_numpy_aggregate(self):
+        if namespacetree.numpy is None:
+            return
+
+        results = []
+        min_nodes = namespacetree.NUMPY_MIN_NODES
+        for use_numpy in [False, True]:
+            namespacetree.NUMPY_MIN_NODES = 0 if use_numpy else float('inf')
+            tree, files = self.make_random_tree()
+            tree.add_files(*files)
+            tree.aggregate(listdeletable.NOW, listdeletable.config.MIN_AGE)
+            results.append((list(tree.latest), list(tree.size), list(tree.nsubfiles),
+                            list(tree.nsubnodes), list(tree.flags), list(tree.deletable())))
+
+        namespacetree.NUMPY_MIN_NODES = min_nodes
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(results[0][-1])
+
+    def test_parallel_error(self):
+        node = listdeletable.DataNode('does/not/exist')
+        self.assertRaises(OSError, node.fill, threads=4)
+
+    def test_native_files(self):
+        index = listdeletable.compile_protected(listdeletable.PROTECTED_LIST)
+        cutoff = listdeletable.NOW - listdeletable.config.MIN_AGE
+        from_find = sorted(
+            path for path in (os.path.join(parent, name)
+                              for parent, _, names in os.walk(unmerged_location)
+                              for name in names)
+            if os.path.getmtime(path) <= cutoff and
+            index.lookup(listdeletable.pfn_to_lfn(path)) is None)
+        self.assertTrue(len(from_find) > 10)
+
+        for threads in [1, 4]:
+            self.assertEqual(sorted(listdeletable.get_unmerged_files(threads)), from_find)
+
+        # Stopping early lets the workers finish
+        unmerged_files = listdeletable.get_unmerged_files(4)
+        next(unmerged_files)
+        unmerged_files.close()
+
+        listdeletable.config.WHICH_LIST = 'files'
+        self.assertEqual(self.get_deletions(), '\n'.join(from_find))
+
+    def walk_entries(self):
+        """Lists the test tree like an fsimage, with HDFS paths"""
+        entries = []
+        hdfs_root = listdeletable.config.LFN_TO_CLEAN
+        for path, dirs, files in os.walk(unmerged_location):
+            hdfs_path = hdfs_root + path[len(unmerged_location):]
+            for name in dirs + files:
+                info = os.stat(os.path.join(path, name))
+                entries.append((os.path.join(hdfs_path, name), name in dirs,
+                                int(info.st_mtime), info.st_size))
+
+        return entries
+
+    def write_delimited(self, file_name):
+        with open(file_name, 'w') as output:
+            output.write('\t'.join(fsimage.DELIMITED_COLUMNS) + '\n')
+            # Something outside of the unmerged area
+            output.write('/store/mc/file.root\t3\t2017-01-01 10:00\t2017-01-01 10:00\t'
+                         '134217728\t1\t100\t0\t0\t-rw-r--r--\tcms\tcms\n')
+            for path, is_dir, mtime, size in self.walk_entries():
+                output.write('\t'.join([
+                    path, '0' if is_dir else '3',
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime)),
+                    '1970-01-01 00:00', '0' if is_dir else '134217728', '0' if is_dir else '1',
+                    '0' if is_dir else str(size), '-1', '-1',
+                    'drwxr-xr-x' if is_dir else '-rw-r--r--', 'cms', 'cms']) + '\n')
+
+    def write_xml(self, file_name):
+        inode_ids = {'/': 16385}
+        inodes = ['<inode><id>16385</id><type>DIRECTORY</type><name></name>'
+                  '<mtime>0</mtime></inode>']
+        children = {}
+
+        entries = [('/store', True, 0, 0), ('/store/mc', True, 0, 0)] + self.walk_entries()
+        entries.insert(2, (listdeletable.config.LFN_TO_CLEAN, True, 0, 0))
+        for path, is_dir, mtime, size in entries:
+            inode_id = len(inode_ids) + 16385
+            inode_ids[path] = inode_id
+            children.setdefault(inode_ids[os.path.dirname(path)], []).append(inode_id)
+            inodes.append(
+                '<inode><id>%i</id><type>%s</type><name>%s</name><mtime>%i</mtime>%s</inode>' %
+                (inode_id, 'DIRECTORY' if is_dir else 'FILE', os.path.basename(path),
+                 mtime * 1000, '' if is_dir else
+                 '<blocks><block><id>1</id><numBytes>%i</numBytes></block></blocks>' % size))
+
+        with open(file_name, 'w') as output:
+            output.write('<?xml version="1.0"?>\n<fsimage><INodeSection><lastInodeId>0'
+                         '</lastInodeId>%s</INodeSection><INodeDirectorySection>' % ''.join(inodes))
+            for parent, child_ids in children.items():
+                output.write('<directory><parent>%i</parent>%s</directory>' %
+                             (parent, ''.join('<child>%i</child>' % child for child in child_ids)))
+            output.write('</INodeDirectorySection></fsimage>\n')
+
+    def test_fsimage(self):
+        # The delimited format only has minutes
+        listdeletable.config.MIN_AGE = 200
+        image_name = os.path.join(os.path.dirname(listdeletable.config.DELETION_FILE), 'fsimage')
+
+        try:
+            for which in ['directories', 'files']:
+                listdeletable.config.WHICH_LIST = which
+                expected = self.get_deletions()
+                self.assertTrue(expected.count('\n') > 2)
+
+                for writer in [self.write_delimited, self.write_xml]:
+                    writer(image_name)
+                    self.assertEqual(self.get_deletions(fsimage_file=image_name), expected)
+
+        finally:
+            os.remove(image_name)
+
+    def write_dumps(self, dump_dir):
+        """Writes the test tree as dumps in each format, and returns the column mapping for each"""
+        # Use PFNs, LFNs, and times in milliseconds in different dumps
+        pfn_entries = [(unmerged_location + path[len(listdeletable.config.LFN_TO_CLEAN):],
+                        is_dir, mtime, size) for path, is_dir, mtime, size in self.walk_entries()]
+        outside = ('/store/mc/file.root', False, 0, 100)
+
+        dumps = {}
+
+        name = os.path.join(dump_dir, 'dump.csv')
+        with open(name, 'w') as output:
+            output.write('size,path,mtime,type\n')
+            for path, is_dir, mtime, size in [outside] + pfn_entries:
+                output.write('%i,"%s",%i,%s\n' % (size, path, mtime, 'd' if is_dir else 'f'))
+        dumps[name] = (None, None)
+
+        name = os.path.join(dump_dir, 'dump.tsv.gz')
+        with gzip.open(name, 'wb') as output:
+            for path, is_dir, mtime, size in [outside] + self.walk_entries():
+                output.write(('%s\t%s\t%i\t%i\n' % ('DIRECTORY' if is_dir else 'FILE', path,
+                                                   mtime * 1000, size)).encode('utf-8'))
+        dumps[name] = ('tsv', {'type': 0, 'path': 1, 'mtime': 2, 'size': 3})
+
+        # Without a type, only files are listed
+        name = os.path.join(dump_dir, 'dump.ndjson')
+        with open(name, 'w') as output:
+            for path, is_dir, mtime, size in [outside] + pfn_entries:
+                if not is_dir:
+                    output.write(json.dumps({'name': path, 'st_mtime': mtime, 'bytes': size}) + '\n')
+        dumps[name] = (None, {'path': 'name', 'mtime': 'st_mtime', 'size': 'bytes'})
+
+        return dumps
+
+    def test_dump(self):
+        dump_dir = os.path.dirname(listdeletable.config.DELETION_FILE)
+        if not os.path.exists(dump_dir):
+            os.makedirs(dump_dir)
+        dumps = self.write_dumps(dump_dir)
+
+        try:
+            for which in ['directories', 'files']:
+                listdeletable.config.WHICH_LIST = which
+                expected = sorted(self.get_deletions().split('\n'))
+                self.assertTrue(len(expected) > 2)
+
+                for name, (dump_format, columns) in dumps.items():
+                    listdeletable.config.DUMP_FORMAT = dump_format
+                    listdeletable.config.DUMP_COLUMNS = columns
+                    deletions = self.get_deletions(dump_file=name).split('\n')
+                    if which == 'directories' and columns and 'type' not in columns:
+                        # The empty directory is not in a dump of files
+                        deletions.append(self.tmpdir.getpath('empty'))
+                    self.assertEqual(sorted(deletions), expected, name)
+
+            self.assertRaises(ValueError, dumpfile.guess_format, 'dump.dat')
+            self.assertEqual(list(dumpfile.read_rows([], 'csv', {'path': 'path'})), [])
+
+        finally:
+            listdeletable.config.DUMP_FORMAT = None
+            listdeletable.config.DUMP_COLUMNS = None
+            for name in dumps:
+                os.remove(name)
+
+    def test_hadoop_delete(self):
+        bin_dir = os.path.join(os.path.dirname(listdeletable.config.DELETION_FILE), 'bin')
+        calls_log = os.path.join(bin_dir, 'calls')
+        if not os.path.exists(bin_dir):
+            os.makedirs(bin_dir)
+
+        # Stands in for hdfs, deleting local paths
+        with open(os.path.join(bin_dir, 'hdfs'), 'w') as script:
+            script.write('\n'.join([
+                '#! %s' % sys.executable,
+                'import os, shutil, sys',
+                'paths = [arg for arg in sys.argv[4:] if arg != "-skipTrash"]',
+                'open(%r, "a").write("%%i\\n" %% len(paths))' % calls_log,
+                'status = 0',
+                'for path in paths:',
+                '    if "flaky" in path and len(paths) > 1:',
+                '        print("rm: Failed to move to trash: hdfs://nn:8020" + path)',
+                '        status = 1',
+                '    elif not os.path.exists(path):',
+                '        sys.stderr.write("rm: `%s\': No such file or directory\\n" % path)',
+                '        status = 1',
+                '    else:',
+                '        shutil.rmtree(path)',
+                '        print("Deleted " + path)',
+                'sys.exit(status)',
+                ]) + '\n')
+        os.chmod(os.path.join(bin_dir, 'hdfs'), 0o755)
+
+        now = int(time.time())
+        os.utime(self.tmpdir.write('flaky/file.root', b'data'), (now - 1000, now - 1000))
+
+        path = os.environ['PATH']
+        max_length = backends.HDFS_MAX_ARG_LENGTH
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+
+        try:
+            expected = [line for line in self.get_deletions().split('\n') if line]
+            self.assertTrue(self.tmpdir.getpath('flaky') in expected)
+
+            # Something already gone is not a failure
+            os.makedirs(self.tmpdir.getpath('gone'))
+            with open(listdeletable.config.DELETION_FILE, 'a') as del_file:
+                del_file.write(self.tmpdir.getpath('gone') + '\n')
+            shutil.rmtree(self.tmpdir.getpath('gone'))
+
+            listdeletable.config.STORAGE_TYPE = 'hadoop'
+            listdeletable.config.DELETE_RATE = 0
+            backends.HDFS_MAX_ARG_LENGTH = 2 * len(expected[0]) + 10
+            stats = listdeletable.do_delete()
+
+            self.assertEqual((stats.deleted, stats.failed), (len(expected) + 1, 0))
+            for deleted in expected:
+                self.assertFalse(os.path.exists(deleted))
+            self.assertTrue(os.path.exists(self.tmpdir.getpath('dir/that/is/protected')))
+
+            # Several paths for each command, and the flaky one again alone
+            with open(calls_log, 'r') as calls:
+                paths_per_call = [int(line) for line in calls]
+            self.assertEqual(sum(paths_per_call), len(expected) + 2)
+            self.assertTrue(len(paths_per_call) < len(expected))
+
+        finally:
+            os.environ['PATH'] = path
+            backends.HDFS_MAX_ARG_LENGTH = max_length
+            listdeletable.config.STORAGE_TYPE = 'posix'
+            listdeletable.config.DELETE_RATE = None
+            shutil.rmtree(bin_dir)
+
+    def test_resume(self):
+        fill = listdeletable.DataNode.fill
+        checkpoint_name = '%s.checkpoint' % listdeletable.config.DELETION_FILE
+        now = listdeletable.NOW
+        filled = []
+
+        def failing_fill(node, *args, **kwargs):
+            if len(filled) == 3:
+                raise IOError('Lost the mount')
+            filled.append(node.path_name)
+            fill(node, *args, **kwargs)
+
+        def get_totals():
+            with testfixtures.LogCapture() as capture:
+                deletions = self.get_deletions(resume=True)
+            return deletions, [record.getMessage() for record in capture.records
+                               if record.getMessage().endswith('TOTALS')]
+
+        expected = get_totals()
+        self.assertFalse(os.path.exists(checkpoint_name))
+        num_tops = len(listdeletable.list_top_dirs())
+
+        try:
+            listdeletable.DataNode.fill = failing_fill
+            self.assertRaises(IOError, self.get_deletions)
+            self.assertTrue(os.path.exists(checkpoint_name))
+            with open(checkpoint_name, 'a') as partial:
+                partial.write('{"top": "no')
+
+            # Only the directories not in the checkpoint are listed again,
+            # with the time the first scan started
+            listdeletable.NOW = now + 100000
+            del filled[:]
+            listdeletable.DataNode.fill = lambda node, *args, **kwargs: \
+                (filled.append(node.path_name), fill(node, *args, **kwargs))
+            self.assertEqual(get_totals(), expected)
+            self.assertEqual(len(filled), num_tops - 3)
+            self.assertFalse(os.path.exists(checkpoint_name))
+
+            # A different protected list starts from the beginning
+            listdeletable.DataNode.fill = failing_fill
+            del filled[:]
+            self.assertRaises(IOError, self.get_deletions)
+
+            listdeletable.NOW = now
+            listdeletable.PROTECTED_LIST.append('/store/unmerged/dir/to')
+            del filled[:]
+            listdeletable.DataNode.fill = lambda node, *args, **kwargs: \
+                (filled.append(node.path_name), fill(node, *args, **kwargs))
+            deletions, _ = get_totals()
+            self.assertEqual(len(filled), num_tops)
+            self.assertFalse(self.tmpdir.getpath('dir/to') in deletions.split('\n'))
+
+        finally:
+            listdeletable.DataNode.fill = fill
+            if '/store/unmerged/dir/to' in listdeletable.PROTECTED_LIST:
+                listdeletable.PROTECTED_LIST.remove('/store/unmerged/dir/to')
+            if os.path.exists(checkpoint_name):
+                os.remove(checkpoint_name)
+
+    def test_memory_backend(self):
+        backend = backends.get_backend(listdeletable.config)
+        self.assertTrue(isinstance(backend, backends.PosixBackend))
+
+        # dCache does not delete directories yet
+        self.tmpdir.makedir('dcache/dir')
+        self.assertEqual(backends.DcacheBackend(listdeletable.config).delete_many(
+            [self.tmpdir.getpath('dcache/dir')], True), [(backends.FAILED, None)])
+        self.assertTrue(os.path.isdir(self.tmpdir.getpath('dcache/dir')))
+        shutil.rmtree(self.tmpdir.getpath('dcache'))
+
+        memory = backends.MemoryBackend(listdeletable.config)
+        for path, dirs, files in os.walk(unmerged_location):
+            for name in dirs + files:
+                info = os.stat(os.path.join(path, name))
+                memory.add(os.path.join(path, name), name in dirs, info.st_mtime, info.st_size)
+
+        try:
+            for which in ['directories', 'files']:
+                listdeletable.config.WHICH_LIST = which
+                listdeletable.config.STORAGE_TYPE = 'posix'
+                expected = sorted(self.get_deletions().split('\n'))
+
+                listdeletable.config.STORAGE_TYPE = 'memory'
+                listdeletable.BACKEND = memory
+                memory.storage_type = 'memory'
+                self.assertEqual(sorted(self.get_deletions().split('\n')), expected)
+
+            listdeletable.config.WHICH_LIST = 'directories'
+            listdeletable.config.DELETE_RATE = 0
+            expected = [line for line in self.get_deletions().split('\n') if line]
+            stats = listdeletable.do_delete()
+            self.assertEqual(stats.deleted, len(expected))
+
+            # Only the namespace in memory is changed
+            self.assertEqual(self.get_deletions(), '\n')
+            self.assertEqual(memory.stat_many([self.tmpdir.getpath('dir/to'),
+                                               self.tmpdir.getpath('new/file_0.root')])[0], None)
+            self.assertTrue(os.path.exists(self.tmpdir.getpath('dir/to')))
+
+        finally:
+            listdeletable.config.STORAGE_TYPE = 'posix'
+            listdeletable.config.DELETE_RATE = None
+
+        # Backends can also come from other modules
+        listdeletable.config.STORAGE_TYPE = 'cmstoolbox.unmergedcleaner.backends.MemoryBackend'
+        try:
+            self.assertTrue(isinstance(listdeletable.storage(), backends.MemoryBackend))
+            listdeletable.config.STORAGE_TYPE = 'no_such_storage'
+            self.assertRaises(ValueError, listdeletable.storage)
+            listdeletable.config.STORAGE_TYPE = 'no.such.Storage'
+            self.assertRaises(ValueError, listdeletable.storage)
+        finally:
+            listdeletable.config.STORAGE_TYPE = 'posix'
+
+    def test_deletion_journal(self):
+        memory = backends.MemoryBackend(listdeletable.config)
+        for path, dirs, files in os.walk(unmerged_location):
+            for name in dirs + files:
+                info = os.stat(os.path.join(path, name))
+                memory.add(os.path.join(path, name), name in dirs, info.st_mtime, info.st_size)
+
+        journal_name = '%s.journal' % listdeletable.config.DELETION_FILE
+        delete_many = memory.delete_many
+        deleted = []
+
+        def failing_delete(pfns, recursive):
+            if expected[0] in pfns:
+                raise IOError('Lost the mount')
+            deleted.extend(pfns)
+            return delete_many(pfns, recursive)
+
+        def summary():
+            with open(journal_name, 'r') as journal_file:
+                return json.loads(journal_file.readlines()[-1])['summary']
+
+        try:
+            listdeletable.config.STORAGE_TYPE = 'memory'
+            listdeletable.config.DELETE_RATE = 0
+            listdeletable.BACKEND = memory
+            memory.storage_type = 'memory'
+
+            expected = [line for line in self.get_deletions().split('\n') if line]
+            expected_bytes = sum(os.path.getsize(os.path.join(path, name))
+                                 for deletion in expected
+                                 for path, _, files in os.walk(deletion)
+                                 for name in files)
+
+            memory.delete_many = failing_delete
+            with testfixtures.LogCapture():
+                stats = listdeletable.do_delete()
+            self.assertEqual((stats.deleted, stats.failed), (len(expected) - 1, 1))
+            self.assertEqual((summary()['deleted'], summary()['failed']), (len(expected) - 1, 1))
+
+            # A restart only tries the failed entry again
+            with open(journal_name, 'a') as partial:
+                partial.write('{"line": 0, "pa')
+            del deleted[:]
+            memory.delete_many = lambda pfns, recursive: \
+                (deleted.extend(pfns), delete_many(pfns, recursive))[1]
+            stats = listdeletable.do_delete()
+            self.assertEqual(deleted, expected[:1])
+            self.assertEqual((stats.deleted, stats.failed), (1, 0))
+            self.assertEqual(summary(), dict(summary(), deleted=len(expected), missing=0, failed=0,
+                                             bytes=expected_bytes, resumed=len(expected) - 1,
+                                             interrupted=False))
+
+            # Nothing is left to do
+            del deleted[:]
+            stats = listdeletable.do_delete()
+            self.assertEqual((deleted, stats.deleted), ([], 0))
+
+            # A new deletion file starts a new journal, and missing entries are not failures
+            with open(listdeletable.config.DELETION_FILE, 'w') as del_file:
+                del_file.write('\n'.join(expected[:2] + expected[:1]) + '\n')
+            stats = listdeletable.do_delete()
+            self.assertEqual(deleted, expected[:2] + expected[:1])
+            self.assertEqual((summary()['deleted'], summary()['missing']), (0, 3))
+
+        finally:
+            memory.delete_many = delete_many
+            listdeletable.config.STORAGE_TYPE = 'posix'
+            listdeletable.config.DELETE_RATE = None
+            if os.path.exists(journal_name):
+                os.remove(journal_name)
+
+    def test_metrics(self):
+        results_dir = os.path.dirname(listdeletable.config.DELETION_FILE)
+        prom_file = os.path.join(results_dir, 'unmerged.prom')
+        json_file = os.path.join(results_dir, 'unmerged.json')
+        if not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+
+        def read_prom():
+            samples = {}
+            with open(prom_file, 'r') as prom:
+                for line in prom:
+                    if not line.startswith('#'):
+                        name, value = line.rsplit(' ', 1)
+                        samples[name] = float(value)
+            return samples
+
+        def read_json():
+            with open(json_file, 'r') as status:
+                return json.load(status)
+
+        try:
+            listdeletable.config.METRICS_PROM_FILE = prom_file
+            listdeletable.config.METRICS_JSON_FILE = json_file
+            listdeletable.config.METRICS_INTERVAL = 0.01
+
+            expected = [line for line in self.get_deletions().split('\n') if line]
+            status = read_json()
+            self.assertEqual((status['phase'], status['progress'], status['current_top']),
+                             ('scan', 1.0, None))
+            self.assertTrue(status['files'] > 0)
+            # Every directory filled is listed once, along with the unmerged location itself
+            self.assertEqual(status['storage_calls']['list_dir']['calls'],
+                             status['directories'] + 1)
+
+            samples = read_prom()
+            self.assertEqual(samples['unmerged_cleaner_files_total{phase="scan"}'],
+                             status['files'])
+            self.assertEqual(samples['unmerged_cleaner_storage_calls_total'
+                                     '{phase="scan",operation="list_dir"}'],
+                             status['directories'] + 1)
+
+            listdeletable.config.DELETE_RATE = 0
+            with testfixtures.LogCapture():
+                listdeletable.do_delete()
+            status = read_json()
+            self.assertEqual((status['phase'], status['progress']), ('delete', 1.0))
+            self.assertEqual(status['deletions'], {'deleted': len(expected)})
+            self.assertEqual(status['storage_calls']['delete_many']['calls'], len(expected))
+            self.assertEqual(read_prom()['unmerged_cleaner_deletions_total'
+                                         '{phase="delete",outcome="deleted"}'], len(expected))
+
+            # Labels are escaped
+            metrics_obj = metrics.Metrics('scan')
+            metrics_obj.set_progress(0.5, 'a "quoted"\nname')
+            self.assertTrue('top="a \\"quoted\\"\\nname"' in metrics_obj.prometheus_text())
+
+        finally:
+            listdeletable.config.METRICS_PROM_FILE = None
+            listdeletable.config.METRICS_JSON_FILE = None
+            listdeletable.config.DELETE_RATE = None
+            for name in (prom_file, json_file):
+                if os.path.exists(name):
+                    os.remove(name)
+            journal_name = '%s.journal' % listdeletable.config.DELETION_FILE
+            if os.path.exists(journal_name):
+                os.remove(journal_name)
+
+    def test_manifest(self):
+        results_dir = os.path.dirname(listdeletable.config.DELETION_FILE)
+        journal_name = '%s.journal' % listdeletable.config.DELETION_FILE
+        if not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+
+        def contents(path):
+            sizes = [os.path.getsize(os.path.join(root, name))
+                     for root, _, files in os.walk(path) for name in files]
+            return sum(sizes), len(sizes)
+
+        try:
+            for name in ('manifest.json', 'manifest.sqlite'):
+                listdeletable.config.MANIFEST_FILE = os.path.join(results_dir, name)
+                expected = [line for line in self.get_deletions().split('\n') if line]
+
+                listing = manifest.open_manifest(listdeletable.config.MANIFEST_FILE,
+                                                 listdeletable.config.DELETION_FILE)
+                entries = list(listing.entries())
+                self.assertEqual([entry.path for entry in entries], sorted(expected))
+                self.assertEqual([entry.path for entry in listing.entries('file')], expected)
+                for entry in entries:
+                    self.assertEqual((entry.size, entry.files), contents(entry.path))
+                self.assertEqual(listing.totals()[:3],
+                                 (len(expected), sum(entry.size for entry in entries),
+                                  sum(entry.files for entry in entries)))
+
+                largest = [entry.path for entry in listing.entries('largest')]
+                self.assertEqual(largest, [entry.path for entry in sorted(
+                    entries, key=lambda entry: (-entry.size, entry.path))])
+                listing.close()
+
+                # The report groups by the top of the path, without the storage
+                groups = {}
+                for entry in entries:
+                    top = entry.path[len(unmerged_location) + 1:].split('/')[0]
+                    groups[top] = groups.get(top, 0) + entry.size
+                rows = listdeletable.report(1, 2)
+                self.assertEqual([(row[0], row[2]) for row in rows],
+                                 sorted(groups.items(), key=lambda item: (item[1], item[0]),
+                                        reverse=True)[:2])
+
+            # Deletions follow the DELETE_ORDER, and the progress ends at everything removed
+            listdeletable.config.DELETE_ORDER = 'largest'
+            listdeletable.config.DELETE_RATE = 0
+            with testfixtures.LogCapture():
+                listdeletable.do_delete()
+            with open(journal_name, 'r') as journal_file:
+                self.assertEqual([json.loads(line).get('path') for line in journal_file][1:-1],
+                                 largest)
+            self.assertEqual(listdeletable.METRICS.progress, 1.0)
+
+            # The manifest is not used for a different deletion file
+            with open(listdeletable.config.DELETION_FILE, 'w') as del_file:
+                del_file.write(expected[0] + '\n')
+            with testfixtures.LogCapture() as logs:
+                listdeletable.do_delete()
+            self.assertTrue('is for an older deletion file' in str(logs))
+
+        finally:
+            listdeletable.config.MANIFEST_FILE = None
+            listdeletable.config.DELETE_ORDER = 'file'
+            listdeletable.config.DELETE_RATE = None
+            for name in ('manifest.json', 'manifest.sqlite', journal_name):
+                if os.path.exists(os.path.join(results_dir, name)):
+                    os.remove(os.path.join(results_dir, name))
+
+    def test_estimate(self):
+        expected = [line for line in self.get_deletions().split('\n') if line]
+        bytes_files_dirs = [0, 0, 0]
+        for deletion in expected:
+            for path, dirs, files in os.walk(deletion):
+                bytes_files_dirs[0] += sum(os.path.getsize(os.path.join(path, name))
+                                           for name in files)
+                bytes_files_dirs[1] += len(files)
+                bytes_files_dirs[2] += 1
+
+        with testfixtures.LogCapture():
+            result = listdeletable.estimate_deletions(fraction=1.0, seed=0)
+        self.assertEqual([result.values[field] for field in ['bytes', 'files', 'directories']],
+                         bytes_files_dirs)
+        self.assertEqual(listdeletable.METRICS.phase, 'estimate')
+        self.assertEqual(len(result.summary()), 2 + 6)
+
+        listdeletable.config.WHICH_LIST = 'files'
+        self.assertRaises(listdeletable.SuspiciousConditions, listdeletable.estimate_deletions)
+
+    def test_shards(self):
+        def run(func, *args, **kwargs):
+            with testfixtures.LogCapture() as logs:
+                func(*args, **kwargs)
+            with open(listdeletable.config.DELETION_FILE, 'r') as del_file:
+                # The summary table, without the timing
+                return del_file.read(), [record.getMessage() for record in logs.records
+                                         if record.getMessage().startswith('  ')]
+
+        now = listdeletable.NOW
+        single = run(listdeletable.main)
+        self.assertTrue(single[1])
+
+        # Each top level directory is in exactly one shard
+        top_dirs = listdeletable.list_top_dirs()
+        self.assertEqual(top_dirs, sorted(top_dirs))
+        self.assertEqual(sorted(sum([listdeletable.list_top_dirs((index, 3))
+                                     for index in range(3)], [])), top_dirs)
+
+        os.remove(listdeletable.config.DELETION_FILE)
+        shard_files = [listdeletable.shard_file((index, 3)) for index in range(3)]
+        try:
+            for index in range(2):
+                listdeletable.main(shard=(index, 3), now=now)
+            self.assertFalse(os.path.exists(listdeletable.config.DELETION_FILE))
+            self.assertRaises(listdeletable.SuspiciousConditions, listdeletable.merge_shards, 3)
+
+            listdeletable.main(shard=(2, 3), now=now)
+            self.assertEqual(run(listdeletable.merge_shards, 3), single)
+
+            self.assertRaises(listdeletable.SuspiciousConditions, listdeletable.merge_shards, 2)
+            listdeletable.config.WHICH_LIST = 'files'
+            self.assertRaises(listdeletable.SuspiciousConditions, listdeletable.main, shard=(0, 3))
+
+        finally:
+            for file_name in shard_files:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    def test_trace_replay(self):
+        trace_file = os.path.join(os.path.dirname(listdeletable.config.DELETION_FILE),
+                                  'trace.json.gz')
+        location = listdeletable.config.UNMERGED_DIR_LOCATION
+        if not os.path.exists(os.path.dirname(trace_file)):
+            os.makedirs(os.path.dirname(trace_file))
+
+        try:
+            listdeletable.config.TRACE_FILE = trace_file
+            listdeletable.config.DELETE_RATE = 0
+            listdeletable.BACKEND = None
+
+            expected = {}
+            for which in ['files', 'directories']:
+                listdeletable.config.WHICH_LIST = which
+                expected[which] = sorted(self.get_deletions().split('\n'))
+            stats = listdeletable.do_delete()
+            self.assertEqual(stats.deleted, len([line for line in expected['directories']
+                                                 if line]))
+
+            # The replay is served from the trace, at another location
+            listdeletable.config.TRACE_FILE = None
+            listdeletable.config.STORAGE_TYPE = 'replay'
+            listdeletable.config.REPLAY_FILE = trace_file
+            listdeletable.config.REPLAY_LATENCY_SCALE = 0
+            listdeletable.config.UNMERGED_DIR_LOCATION = '/elsewhere/unmerged'
+
+            for which in ['files', 'directories']:
+                listdeletable.config.WHICH_LIST = which
+                self.assertEqual(sorted(self.get_deletions().split('\n')),
+                                 [line.replace(location, '/elsewhere/unmerged')
+                                  for line in expected[which]])
+
+            with testfixtures.LogCapture():
+                replayed = listdeletable.do_delete()
+            self.assertEqual((replayed.deleted, replayed.failed), (stats.deleted, 0))
+
+            # Calls wait as long as they took when recorded
+            replay = listdeletable.storage()
+            replay.scale = 1.0
+            replay.listings['%s/dir' % location]['latency'] = 0.2
+            start = time.time()
+            replay.list_dir('/elsewhere/unmerged/dir')
+            self.assertTrue(time.time() - start >= 0.2)
+            self.assertRaises(OSError, replay.list_dir, '/elsewhere/unmerged/not_recorded')
+
+        finally:
+            listdeletable.config.TRACE_FILE = None
+            listdeletable.config.STORAGE_TYPE = 'posix'
+            listdeletable.config.UNMERGED_DIR_LOCATION = location
+            listdeletable.config.WHICH_LIST = 'directories'
+            listdeletable.config.DELETE_RATE = None
+            listdeletable.BACKEND = None
+            if os.path.exists(trace_file):
+                os.remove(trace_file)
+
+    def test_webhdfs(self):
+        server = ThreadingServer(('127.0.0.1', 0), WebHdfsStandIn)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        listdeletable.config.WEBHDFS_URL = 'http://127.0.0.1:%i' % server.server_address[1]
+        sleep_time = listdeletable.config.SLEEP_TIME
+
+        try:
+            expected = {}
+            for which in ['directories', 'files']:
+                listdeletable.config.WHICH_LIST = which
+                expected[which] = sorted(self.get_deletions().split('\n'))
+
+            listdeletable.config.STORAGE_TYPE = 'webhdfs'
+            for which in ['directories', 'files']:
+                listdeletable.config.WHICH_LIST = which
+                for threads in [1, 4]:
+                    listdeletable.config.SCAN_THREADS = threads
+                    self.assertEqual(sorted(self.get_deletions().split('\n')), expected[which])
+
+            # Connections are reused between requests
+            self.assertTrue(WebHdfsStandIn.connections <= 5)
+            self.assertTrue(WebHdfsStandIn.requests > 50)
+
+            listdeletable.config.WHICH_LIST = 'directories'
+            self.get_deletions()
+            listdeletable.config.SLEEP_TIME = 0
+            listdeletable.do_delete()
+
+            self.assertFalse(os.path.exists(self.tmpdir.getpath('dir/to')))
+            self.assertTrue(os.path.exists(self.tmpdir.getpath('dir/that/is/protected')))
+            self.assertEqual(self.get_deletions(), '\n')
+
+            self.assertRaises(webhdfs.WebHdfsError, listdeletable.scan_folder,
+                              os.path.join(unmerged_location, 'not/here'))
+
+            # A path that fails does not stop the rest of the batch
+            self.assertEqual(listdeletable.storage().delete_many(
+                [os.path.join(unmerged_location, name) for name in ['forbidden', 'not/here']],
+                True), [(backends.FAILED, None), (backends.MISSING, 0)])
+
+        finally:
+            listdeletable.storage().close()
+            listdeletable.config.STORAGE_TYPE = 'posix'
+            listdeletable.config.SLEEP_TIME = sleep_time
+            server.shutdown()
+            server.server_close()
+
+        # A server that cannot be reached gives the same error, with no status
+        client = webhdfs.WebHdfsClient('http://localhost:%i' % server.server_address[1],
+                                       timeout=1)
+        try:
+            client.get_file_status('/store/unmerged')
+        except webhdfs.WebHdfsError as err:
+            self.assertEqual(err.status, 0)
+        else:
+            self.fail('An unreachable server did not raise WebHdfsError')
+        client.close()
+
+    def test_streaming(self):
+        expected = self.get_deletions()
+        previous = []
+
+        def fill_tops():
+            for subdir in listdeletable.list_top_dirs():
+                top_node = listdeletable.DataNode(subdir)
+
+                # The last tree is released before the next one is filled
+                gc.collect()
+                self.assertFalse([tree for tree in previous if tree() is not None])
+
+                top_node.fill()
+                previous.append(weakref.ref(top_node.tree))
+                yield top_node
+
+        listdeletable.write_deletions(fill_tops())
+        self.assertTrue(len(previous) > 3)
+        with open(listdeletable.config.DELETION_FILE, 'r') as del_file:
+            self.assertEqual(del_file.read(), expected)
+
+    def send_daemon(self, command):
+        for _ in range(100):
+            if os.path.exists(listdeletable.config.DAEMON_SOCKET):
+                break
+            time.sleep(0.1)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(listdeletable.config.DAEMON_SOCKET)
+        client.sendall((command + '\n').encode())
+        reply = client.recv(64).decode()
+        client.close()
+        return reply
+
+    def test_daemon(self):
+        if not sys.platform.startswith('linux'):
+            return
+
+        expected = self.get_deletions()
+        os.remove(listdeletable.config.DELETION_FILE)
+
+        listdeletable.config.DAEMON_SOCKET = os.path.join(
+            os.path.dirname(listdeletable.config.DELETION_FILE), 'daemon.sock')
+        daemon = threading.Thread(target=listdeletable.run_daemon)
+        daemon.start()
+
+        try:
+            self.assertTrue(self.send_daemon('write').startswith('ok'))
+            with open(listdeletable.config.DELETION_FILE, 'r') as del_file:
+                self.assertEqual(del_file.read(), expected)
+
+            # The change is seen without listing the whole tree again
+            self.tmpdir.write('dir/to/delete/new.root', b'new')
+            self.assertTrue(self.send_daemon('write').startswith('ok'))
+            with open(listdeletable.config.DELETION_FILE, 'r') as del_file:
+                deletions = del_file.read()
+
+            self.assertFalse(os.path.join(unmerged_location, 'dir/to\n') in deletions)
+            self.assertEqual(deletions, self.get_deletions())
+
+            self.assertTrue(self.send_daemon('bad').startswith('error'))
+
+            # A client that sends nothing times out without holding up other requests
+            listdeletable.daemon.CLIENT_TIMEOUT = 0.5
+            silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            silent.connect(listdeletable.config.DAEMON_SOCKET)
+            self.assertTrue(self.send_daemon('write').startswith('ok'))
+            self.assertTrue(silent.recv(64).decode().startswith('error'))
+            silent.close()
+
+        finally:
+            self.send_daemon('stop')
+            daemon.join()
+            listdeletable.config.DAEMON_SOCKET = None
+            listdeletable.daemon.CLIENT_TIMEOUT = 5
+
+        self.assertFalse(os.path.exists(os.path.join(
+            os.path.dirname(listdeletable.config.DELETION_FILE), 'daemon.sock')))
+
+    def test_watched_listings(self):
+        if not sys.platform.startswith('linux'):
+            return
+
+        listings = residentscan.WatchedListings(unmerged_location, 3600)
+        try:
+            self.assertEqual(listings.get('dir/to'), None)
+            listings.put('dir/to', None, 10, 20, 1, ['delete'])
+            self.assertEqual(listings.get('dir/to'), (10, 20, 1, ['delete']))
+
+            self.tmpdir.write('dir/to/other.root', b'new')
+            self.assertTrue(listings.process_events())
+            self.assertEqual(listings.get('dir/to'), None)
+            self.assertEqual(listings.take_dirty(), set(['dir']))
+            self.assertEqual(listings.take_dirty(), set())
+
+        finally:
+            listings.close()
+
+
 class TestConditions(unittest.TestCase):
 
     def test_no_protected(self):